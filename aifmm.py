@@ -1,152 +1,164 @@
+import time
+STARTUP_STARTED = time.perf_counter()
+import json
 import sys
+import threading
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
-                             QLabel, QLineEdit, QPushButton, QTextEdit, QTabWidget, 
+                             QLabel, QLineEdit, QPushButton, QPlainTextEdit, QTabWidget, 
                              QFileDialog, QMessageBox, QDoubleSpinBox, QSpinBox, QComboBox, 
-                             QGroupBox, QFormLayout, QSlider, QSizePolicy, QListWidget, QProgressBar)
+                             QGroupBox, QFormLayout, QSlider, QSizePolicy, QTableView, QHeaderView,
+                             QAbstractItemView, QProgressBar, QCheckBox)
 from PyQt6.QtCore import Qt, QThread, pyqtSignal
 import os
-import tempfile
-import json
 import configparser
-from api_services import get_service, get_available_services
+from api_services import get_service, get_available_services, register_endpoints
+from response_cache import ResponseCache, DEFAULT_CACHE_SIZE_MB
+from config import (load_api_config, save_api_config, get_base_url, get_connection_settings, DEFAULT_MODEL,
+                    DEFAULT_TEMPERATURE, DEFAULT_CONCURRENCY, MAX_CONCURRENCY)
+from pipeline import FrontMatterPipeline
+from batch_runner import BatchRunner
+from gui_models import FileQueueModel, LogBuffer
+from routing import routed_service, RoutedService
+from discovery import discover_files, input_roots, split_patterns, DEFAULT_INCLUDE
+from dedup import DEFAULT_DEDUP_THRESHOLD
+from watcher import WatchRunner
+from packing import DEFAULT_PACK_MAX_BYTES
+
+# Time from launching the module to the window's first paint that startup should stay within
+STARTUP_BUDGET_MS = 1000
+# When set, each startup appends its timings as a JSON line to this file
+STARTUP_TRACE_ENV = 'AIFMM_STARTUP_TRACE'
+# Saved configs with more files than this keep the file list in a separate manifest next to the .ini
+MANIFEST_THRESHOLD = 100
+
+class StartupTrace:
+    def __init__(self, started: float = STARTUP_STARTED):
+        self.started = started
+        self.marks = []
+
+    def mark(self, name: str):
+        self.marks.append((name, (time.perf_counter() - self.started) * 1000))
+
+    def total_ms(self) -> float:
+        return self.marks[-1][1] if self.marks else 0.0
+
+    def describe(self) -> str:
+        steps = ", ".join(f"{name} {elapsed:.0f}ms" for name, elapsed in self.marks)
+        status = "over budget" if self.total_ms() > STARTUP_BUDGET_MS else "within budget"
+        return f"Startup: {steps} ({status}, budget {STARTUP_BUDGET_MS}ms)"
+
+    def save(self):
+        path = os.environ.get(STARTUP_TRACE_ENV)
+        if not path:
+            return
+        entry = {'time': time.time(), 'budget_ms': STARTUP_BUDGET_MS,
+                 'marks': {name: round(elapsed, 1) for name, elapsed in self.marks}}
+        try:
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            print(f"Could not write startup trace: {e}")
 
-# Constants
-API_CONFIG_FILE = 'api_config.json'
-DEFAULT_MODEL = "claude-3-opus-20240229"
-DEFAULT_MAX_TOKENS = 4096
-DEFAULT_TEMPERATURE = 0.0
+STARTUP_TRACE = StartupTrace()
+STARTUP_TRACE.mark("imports")
 
 def handle_error(error_code, message):
     print(f"Error {error_code}: {message}")
     return error_code
 
-def load_api_config():
-    default_config = {
-        'anthropic_api_key': '',
-        'openai_api_key': '',
-        'temperature': DEFAULT_TEMPERATURE,
-        'service': 'Anthropic',
-        'model': DEFAULT_MODEL
-    }
-    if not os.path.exists(API_CONFIG_FILE):
-        # If the file doesn't exist, create it with default values
-        with open(API_CONFIG_FILE, 'w') as f:
-            json.dump(default_config, f)
-        return default_config
-    else:
-        # If the file exists, load it and use saved values
-        with open(API_CONFIG_FILE, 'r') as f:
-            return json.load(f)
-
-def save_api_config(anthropic_api_key: str, openai_api_key: str, temperature: float, service: str, model: str):
-    current_config = load_api_config()
-    # Only update non-empty values
-    if anthropic_api_key:
-        current_config['anthropic_api_key'] = anthropic_api_key
-    if openai_api_key:
-        current_config['openai_api_key'] = openai_api_key
-    current_config['temperature'] = temperature
-    current_config['service'] = service
-    current_config['model'] = model
-    
-    with open(API_CONFIG_FILE, 'w') as f:
-        json.dump(current_config, f)
+# Largest files listed in the log by the Estimate button
+ESTIMATE_LOGGED_FILES = 10
 
 class ProcessThread(QThread):
-    log_signal = pyqtSignal(str)
+    progress_signal = pyqtSignal(int, int)
+    metrics_signal = pyqtSignal(object)
     finished_signal = pyqtSignal()
 
-    def __init__(self, gui, prompt_file, text_files, output_dir):
+    def __init__(self, gui, prompt_file, text_files, output_dir, estimate_only=False):
         super().__init__()
-        self.gui = gui
         self.prompt_file = prompt_file
-        self.text_files = text_files
+        self.estimate_only = estimate_only
+        self.inputs = text_files
+        include = split_patterns(gui.include_entry.text()) or DEFAULT_INCLUDE
+        exclude = split_patterns(gui.exclude_entry.text())
+        # Directories in the queue are walked lazily while the first files are processed
+        self.text_files = discover_files(text_files, include, exclude)
+        if not input_roots(text_files):
+            # Without folders, files can be ordered largest first
+            self.text_files = list(self.text_files)
         self.output_dir = output_dir
-        self.reference = gui.reference_entry.text()
-        self.model = gui.model_combo.currentText()
-        self.max_tokens = min(gui.max_tokens_slider.value(), 4096)
-        self.temperature = gui.temperature_slider.value() / 100
-        self.service = get_service(gui.service_combo.currentText(), gui.get_current_api_key())
+        self.batch_mode = gui.batch_checkbox.isChecked()
+        service_name = gui.service_combo.currentText()
+        # The response cache scans its directory when opened, so that happens in run(), off the UI thread
+        self.cache_size_mb = None if gui.bypass_cache_checkbox.isChecked() else gui.cache_size_spinbox.value()
+        service = gui.get_routed_service()
+        service.scheduler.set_limits(gui.rpm_spinbox.value() or None, gui.tpm_spinbox.value() or None)
+        self.pipeline = FrontMatterPipeline(
+            service=service,
+            service_name=service_name,
+            model=gui.model_combo.currentText(),
+            max_tokens=gui.max_tokens_slider.value(),
+            temperature=gui.temperature_slider.value() / 100,
+            reference=gui.reference_entry.text(),
+            concurrency=gui.concurrency_spinbox.value(),
+            resume=gui.resume_checkbox.isChecked(),
+            incremental=gui.incremental_checkbox.isChecked(),
+            stream=gui.stream_checkbox.isChecked(),
+            input_roots=input_roots(text_files),
+            dedup_threshold=gui.dedup_threshold_spinbox.value() if gui.dedup_checkbox.isChecked() else None,
+            spend_cap=gui.spend_cap_spinbox.value() or None,
+            pack_size=gui.pack_size_spinbox.value(),
+            pack_max_bytes=gui.api_config.get('pack_max_bytes') or DEFAULT_PACK_MAX_BYTES,
+            search_index=gui.search_index_checkbox.isChecked(),
+            log=gui.log_buffer.append,
+            progress=self.progress_signal.emit,
+            metrics=self.metrics_signal.emit
+        )
+        self.watch_runner = None
+        if gui.watch_checkbox.isChecked() and not estimate_only:
+            self.watch_runner = WatchRunner(self.pipeline, include, exclude)
+
+    def stop(self):
+        if self.watch_runner:
+            self.watch_runner.stop()
 
     def run(self):
-        if not self.validate_input(self.prompt_file, self.text_files, self.output_dir):
-            return
-
-        self.log_signal.emit("Processing started...")
         try:
-            for text_file in self.text_files:
-                self.log_signal.emit(f"Processing file: {text_file}")
-                self.process_single_file(self.prompt_file, text_file, self.output_dir)
-            self.log_signal.emit("Processing complete!")
+            if self.cache_size_mb is not None:
+                self.pipeline.cache = ResponseCache(max_bytes=self.cache_size_mb * 1024 * 1024)
+            if self.estimate_only:
+                self.log_estimate()
+            elif self.watch_runner:
+                self.watch_runner.run(self.prompt_file, self.inputs, self.output_dir)
+            elif self.batch_mode:
+                BatchRunner(self.pipeline).run(self.prompt_file, self.text_files, self.output_dir)
+            else:
+                self.pipeline.run(self.prompt_file, self.text_files, self.output_dir)
+            if isinstance(self.pipeline.service, RoutedService):
+                self.pipeline.log(self.pipeline.service.describe())
         except Exception as e:
-            self.log_signal.emit(f"Error: {str(e)}")
+            self.pipeline.log(f"Error: {str(e)}")
         finally:
             self.finished_signal.emit()
 
-    def process_single_file(self, prompt_file, text_file, output_dir):
-        with tempfile.NamedTemporaryFile(mode='w+', encoding='utf-8', delete=False) as temp_file:
-            merged_content = self.merge_prompt_and_text(prompt_file, text_file)
-            temp_file.write(merged_content)
-            temp_file.flush()
-
-            api_response = self.call_api(temp_file.name)
-
-        markdown_content = self.convert_to_markdown(api_response)
-        if markdown_content:
-            base_name = os.path.splitext(os.path.basename(text_file))[0]
-            output_file = os.path.join(output_dir, f"{base_name}.md")
-            self.append_markdown_to_file(markdown_content, text_file, output_file)
-            self.log_signal.emit(f"Markdown content appended to {output_file}")
-        else:
-            self.log_signal.emit("No valid content found in the API response.")
-
-        os.unlink(temp_file.name)
-
-    def merge_prompt_and_text(self, prompt_path: str, text_path: str) -> str:
-        with open(prompt_path, 'r', encoding='utf-8') as f:
-            prompt = f.read()
-        
-        with open(text_path, 'r', encoding='utf-8') as f:
-            text = f.read()
-        
-        return prompt.replace('{{TEXT}}', text)
-
-    def call_api(self, input_file: str) -> str:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            content = f.read()
-
-        return self.service.call_api(content, self.model, self.max_tokens, self.temperature)
-
-    def convert_to_markdown(self, content: str) -> str:
-        return content.strip()
-
-    def append_markdown_to_file(self, markdown_content: str, original_file: str, output_file: str):
-        with open(original_file, 'r', encoding='utf-8') as original:
-            original_content = original.read()
-        
-        with open(output_file, 'w', encoding='utf-8') as output:
-            output.write(markdown_content + "\n\n")
-            if self.reference and self.reference.strip():
-                output.write(f"Reference: {self.reference.strip()}\n\n")
-            output.write(original_content)
-
-    def validate_input(self, prompt_file, text_files, output_dir):
-        if not prompt_file or not text_files or not output_dir:
-            QMessageBox.critical(self.gui, "Error", "Please select all required files and directories.")
-            return False
-        if not os.path.exists(prompt_file):
-            QMessageBox.critical(self.gui, "Error", f"Prompt file not found: {prompt_file}")
-            return False
-        for text_file in text_files:
-            if not os.path.exists(text_file):
-                QMessageBox.critical(self.gui, "Error", f"Text file not found: {text_file}")
-                return False
-        if not os.path.exists(output_dir):
-            QMessageBox.critical(self.gui, "Error", f"Output directory not found: {output_dir}")
-            return False
-        return True
+    def log_estimate(self):
+        log = self.pipeline.log
+        plan = self.pipeline.plan(self.prompt_file, list(self.text_files))
+        log(plan.describe())
+        for issue in plan.issues:
+            log(f"Warning: {issue}")
+        for file_plan in plan.files[:ESTIMATE_LOGGED_FILES]:
+            if file_plan.error:
+                log(f"  {file_plan.text_file}: {file_plan.error}")
+            else:
+                log(f"  {file_plan.text_file}: {file_plan.input_tokens} tokens in {file_plan.requests} request(s)")
+        if len(plan.files) > ESTIMATE_LOGGED_FILES:
+            log(f"  ... and {len(plan.files) - ESTIMATE_LOGGED_FILES} smaller file(s)")
 
 class AIFrontMatterMaker(QMainWindow):  # Changed class name
+    # (service name, models) from a background model list refresh, delivered on the UI thread
+    models_updated = pyqtSignal(str, list)
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("AI Front-Matter Maker")  # Updated window title
@@ -164,16 +176,59 @@ class AIFrontMatterMaker(QMainWindow):  # Changed class name
         self.tab_widget.addTab(self.main_tab, "Main")
         self.tab_widget.addTab(self.settings_tab, "Settings")
 
+        self.api_config = load_api_config()
+        # Endpoints from api_config.json are listed as services next to the built-in providers
+        register_endpoints(self.api_config.get('endpoints'))
+        self.models_updated.connect(self.on_models_updated)
+        self.first_paint_done = False
+        self.process_thread = None
         self.setup_main_tab()
         self.setup_settings_tab()
 
-        api_config = load_api_config()
+        api_config = self.api_config
         self.api_key_entry.setText(api_config.get('anthropic_api_key', ''))
         self.openai_api_key_entry.setText(api_config.get('openai_api_key', ''))
         self.temperature_slider.setValue(int(api_config.get('temperature', DEFAULT_TEMPERATURE) * 100))
+        self.concurrency_spinbox.setValue(int(api_config.get('concurrency', DEFAULT_CONCURRENCY)))
+        self.bypass_cache_checkbox.setChecked(bool(api_config.get('bypass_cache', False)))
+        self.cache_size_spinbox.setValue(int(api_config.get('cache_size_mb', DEFAULT_CACHE_SIZE_MB)))
+        self.rpm_spinbox.setValue(int(api_config.get('requests_per_minute', 0)))
+        self.tpm_spinbox.setValue(int(api_config.get('tokens_per_minute', 0)))
+        self.stream_checkbox.setChecked(bool(api_config.get('stream', True)))
+        self.dedup_checkbox.setChecked(bool(api_config.get('dedup', False)))
+        self.dedup_threshold_spinbox.setValue(float(api_config.get('dedup_threshold', DEFAULT_DEDUP_THRESHOLD)))
+        self.spend_cap_spinbox.setValue(float(api_config.get('spend_cap', 0)))
+        self.pack_size_spinbox.setValue(int(api_config.get('pack_size', 0)))
+        self.search_index_checkbox.setChecked(bool(api_config.get('search_index', True)))
+        # Fill the model list once, from the cached or built-in models; a fresh list arrives via models_updated
+        self.service_combo.blockSignals(True)
         self.service_combo.setCurrentText(api_config.get('service', 'Anthropic'))
+        self.service_combo.blockSignals(False)
         self.update_available_models()
         self.model_combo.setCurrentText(api_config.get('model', DEFAULT_MODEL))
+        STARTUP_TRACE.mark("window built")
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.first_paint_done:
+            self.first_paint_done = True
+            STARTUP_TRACE.mark("first paint")
+            self.log(STARTUP_TRACE.describe())
+            STARTUP_TRACE.save()
+            self.warm_up_client()
+
+    def warm_up_client(self):
+        # Import the SDK and build the client in the background, so the first run doesn't pay for it
+        service = self.get_current_service()
+
+        def build_client():
+            try:
+                service.client
+            except Exception:
+                # A client that can't be built is reported when a run starts
+                pass
+
+        threading.Thread(target=build_client, name="client-warm-up", daemon=True).start()
 
     def setup_main_tab(self):
         layout = QVBoxLayout(self.main_tab)
@@ -187,19 +242,40 @@ class AIFrontMatterMaker(QMainWindow):  # Changed class name
         prompt_layout.addWidget(self.prompt_button)
         layout.addLayout(prompt_layout)
 
-        # Use QListWidget for displaying selected files
-        self.text_list_widget = QListWidget()
-        self.text_list_widget.setSelectionMode(QListWidget.SelectionMode.MultiSelection)
-        layout.addWidget(self.text_list_widget)
+        # Model/view file queue: only visible rows are rendered, so large batches stay responsive
+        self.file_queue = FileQueueModel(self)
+        self.file_table = QTableView()
+        self.file_table.setModel(self.file_queue)
+        self.file_table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.file_table.setSelectionMode(QAbstractItemView.SelectionMode.MultiSelection)
+        self.file_table.setWordWrap(False)
+        self.file_table.verticalHeader().setVisible(False)
+        self.file_table.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        self.file_table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        layout.addWidget(self.file_table)
 
         # Add buttons for adding and removing files
         file_buttons_layout = QHBoxLayout()
         self.add_file_button = QPushButton("Add Files")
+        self.add_folder_button = QPushButton("Add Folder")
         self.remove_file_button = QPushButton("Remove Selected")
         file_buttons_layout.addWidget(self.add_file_button)
+        file_buttons_layout.addWidget(self.add_folder_button)
         file_buttons_layout.addWidget(self.remove_file_button)
         layout.addLayout(file_buttons_layout)
 
+        # Filters for files found in queued folders, e.g. "*.txt; *.md" and "drafts; *.bak"
+        filter_layout = QHBoxLayout()
+        self.include_entry = QLineEdit("; ".join(DEFAULT_INCLUDE))
+        self.include_entry.setToolTip("Glob patterns of files to use from folders, separated by ;")
+        self.exclude_entry = QLineEdit()
+        self.exclude_entry.setToolTip("Glob patterns of files or subfolders to skip, separated by ;")
+        filter_layout.addWidget(QLabel("Include:"))
+        filter_layout.addWidget(self.include_entry)
+        filter_layout.addWidget(QLabel("Exclude:"))
+        filter_layout.addWidget(self.exclude_entry)
+        layout.addLayout(filter_layout)
+
         output_layout = QHBoxLayout()
         self.output_label = QLabel("Output Directory:")
         self.output_entry = QLineEdit()
@@ -216,16 +292,38 @@ class AIFrontMatterMaker(QMainWindow):  # Changed class name
         reference_layout.addWidget(self.reference_entry)
         layout.addLayout(reference_layout)
 
+        run_mode_layout = QHBoxLayout()
+        self.resume_checkbox = QCheckBox("Resume previous run")
+        self.resume_checkbox.setToolTip("Skip files the output directory's journal records as finished")
+        self.incremental_checkbox = QCheckBox("Incremental (only changed files)")
+        self.incremental_checkbox.setToolTip("Skip files whose text and prompt are unchanged since their .md was written")
+        run_mode_layout.addWidget(self.resume_checkbox)
+        run_mode_layout.addWidget(self.incremental_checkbox)
+        self.batch_checkbox = QCheckBox("Batch API (slower, discounted)")
+        self.batch_checkbox.setToolTip("Submit all files to the provider's asynchronous batch API and poll for results")
+        run_mode_layout.addWidget(self.batch_checkbox)
+        self.watch_checkbox = QCheckBox("Watch folders")
+        self.watch_checkbox.setToolTip("Keep running and process new and changed files in the queued folders as they "
+                                       "arrive, until stopped")
+        run_mode_layout.addWidget(self.watch_checkbox)
+        layout.addLayout(run_mode_layout)
+
+        process_layout = QHBoxLayout()
+        self.estimate_button = QPushButton("Estimate")
+        self.estimate_button.setToolTip("Count tokens and estimate the cost of the run without calling the API")
         self.process_button = QPushButton("Process")
-        layout.addWidget(self.process_button)
+        process_layout.addWidget(self.estimate_button)
+        process_layout.addWidget(self.process_button)
+        layout.addLayout(process_layout)
 
         # Add a progress bar
         self.progress_bar = QProgressBar()
         layout.addWidget(self.progress_bar)
 
-        self.log_window = QTextEdit()
+        self.log_window = QPlainTextEdit()
         self.log_window.setReadOnly(True)
         layout.addWidget(self.log_window)
+        self.log_buffer = LogBuffer(self.log_window)
 
         button_layout = QHBoxLayout()
         self.save_config_button = QPushButton("Save Config")
@@ -237,35 +335,42 @@ class AIFrontMatterMaker(QMainWindow):  # Changed class name
         # Connect signals
         self.prompt_button.clicked.connect(self.browse_prompt)
         self.add_file_button.clicked.connect(self.browse_text)
+        self.add_folder_button.clicked.connect(self.browse_folder)
         self.remove_file_button.clicked.connect(self.remove_selected_files)
         self.output_button.clicked.connect(self.browse_output)
         self.process_button.clicked.connect(self.start_process)
+        self.estimate_button.clicked.connect(self.start_estimate)
         self.save_config_button.clicked.connect(self.save_config)
         self.load_config_button.clicked.connect(self.load_config)
 
         # Enable drag-and-drop
-        self.text_list_widget.setAcceptDrops(True)
-        self.text_list_widget.dragEnterEvent = self.dragEnterEvent
-        self.text_list_widget.dropEvent = self.dropEvent
+        self.file_table.setAcceptDrops(True)
+        self.file_table.setDragDropMode(QAbstractItemView.DragDropMode.DropOnly)
+        self.file_table.dragEnterEvent = self.dragEnterEvent
+        self.file_table.dragMoveEvent = self.dragEnterEvent
+        self.file_table.dropEvent = self.dropEvent
 
     def dragEnterEvent(self, event):
         if event.mimeData().hasUrls():
             event.acceptProposedAction()
 
     def dropEvent(self, event):
-        for url in event.mimeData().urls():
-            file_path = url.toLocalFile()
-            if os.path.isfile(file_path):
-                self.text_list_widget.addItem(file_path)
+        # Folders are queued as they are and searched when processing starts
+        file_paths = [url.toLocalFile() for url in event.mimeData().urls()]
+        self.file_queue.add_files(file_path for file_path in file_paths if os.path.exists(file_path))
 
     def browse_text(self):
-        filenames, _ = QFileDialog.getOpenFileNames(self, "Select Text File(s)", "", "Text Files (*.txt)")
+        filenames, _ = QFileDialog.getOpenFileNames(self, "Select Text File(s)", "", "Text Files (*.txt);;All Files (*)")
         if filenames:
-            self.text_list_widget.addItems(filenames)
+            self.file_queue.add_files(filenames)
+
+    def browse_folder(self):
+        directory = QFileDialog.getExistingDirectory(self, "Select Folder")
+        if directory:
+            self.file_queue.add_files([directory])
 
     def remove_selected_files(self):
-        for item in self.text_list_widget.selectedItems():
-            self.text_list_widget.takeItem(self.text_list_widget.row(item))
+        self.file_queue.remove_rows(index.row() for index in self.file_table.selectionModel().selectedRows())
 
     def browse_prompt(self):
         filename, _ = QFileDialog.getOpenFileName(self, "Select Prompt File", "", "Text Files (*.txt)")
@@ -277,26 +382,65 @@ class AIFrontMatterMaker(QMainWindow):  # Changed class name
         if directory:
             self.output_entry.setText(directory)
 
-    def start_process(self):
-        self.process_button.setEnabled(False)
+    def start_estimate(self):
+        self.start_process(estimate_only=True)
+
+    def start_process(self, estimate_only=False):
+        if self.process_thread and self.process_thread.watch_runner and self.process_thread.isRunning():
+            self.process_thread.stop()
+            self.process_button.setEnabled(False)
+            return
         prompt_file = self.prompt_entry.text()
-        text_files = [self.text_list_widget.item(i).text() for i in range(self.text_list_widget.count())]
+        text_files = self.file_queue.files()
         output_dir = self.output_entry.text()
-        self.process_thread = ProcessThread(self, prompt_file, text_files, output_dir)
-        self.process_thread.log_signal.connect(self.log)
+        error = FrontMatterPipeline.validate_input(prompt_file, text_files, output_dir)
+        if error:
+            QMessageBox.critical(self, "Error", error)
+            return
+        self.process_button.setEnabled(False)
+        self.estimate_button.setEnabled(False)
+        self.run_tokens = 0
+        self.run_cost = 0.0
+        if not estimate_only:
+            self.file_queue.reset_status()
+        try:
+            self.process_thread = ProcessThread(self, prompt_file, text_files, output_dir, estimate_only)
+        except ValueError as e:
+            QMessageBox.critical(self, "Error", str(e))
+            self.process_button.setEnabled(True)
+            self.estimate_button.setEnabled(True)
+            return
+        self.process_thread.progress_signal.connect(self.update_progress)
+        self.process_thread.metrics_signal.connect(self.update_metrics)
         self.process_thread.finished_signal.connect(self.on_process_finished)
         self.process_thread.start()
+        if self.process_thread.watch_runner:
+            self.process_button.setText("Stop Watching")
+            self.process_button.setEnabled(True)
 
     def on_process_finished(self):
+        self.process_button.setText("Process")
         self.process_button.setEnabled(True)
+        self.estimate_button.setEnabled(True)
         self.progress_bar.setValue(0)
+        self.progress_bar.setFormat("%p%")
 
     def log(self, message):
-        self.log_window.append(message)
-        # Update progress bar based on log messages
-        if "Processing file:" in message:
-            current_value = self.progress_bar.value()
-            self.progress_bar.setValue(current_value + 1)
+        self.log_buffer.append(message)
+
+    def update_progress(self, completed: int, total: int):
+        self.progress_bar.setMaximum(max(total, 1))
+        self.progress_bar.setValue(completed)
+
+    def update_metrics(self, file_metrics):
+        # Files found in a queued folder get a row once they have been handled
+        self.file_queue.add_files([file_metrics.text_file], discovered=True)
+        self.file_queue.set_status(file_metrics.text_file, file_metrics.status, file_metrics.duration)
+        self.run_tokens += file_metrics.input_tokens + file_metrics.output_tokens
+        if self.run_cost is not None:
+            self.run_cost = None if file_metrics.cost is None else self.run_cost + file_metrics.cost
+        cost = f"${self.run_cost:.2f}" if self.run_cost is not None else "cost unknown"
+        self.progress_bar.setFormat(f"%v/%m files - {self.run_tokens} tokens, {cost}")
 
     def setup_settings_tab(self):
         layout = QVBoxLayout(self.settings_tab)
@@ -352,6 +496,70 @@ class AIFrontMatterMaker(QMainWindow):  # Changed class name
         self.temperature_display = QLabel(str(self.temperature_slider.value() / 100))
         params_layout.addRow("Temperature:", self.temperature_slider)
         params_layout.addRow("Temperature Value:", self.temperature_display)
+
+        self.concurrency_spinbox = QSpinBox()
+        self.concurrency_spinbox.setRange(1, MAX_CONCURRENCY)
+        self.concurrency_spinbox.setValue(DEFAULT_CONCURRENCY)
+        params_layout.addRow("Concurrent Requests:", self.concurrency_spinbox)
+
+        self.bypass_cache_checkbox = QCheckBox("Bypass response cache")
+        params_layout.addRow("Response Cache:", self.bypass_cache_checkbox)
+
+        self.cache_size_spinbox = QSpinBox()
+        self.cache_size_spinbox.setRange(1, 100000)
+        self.cache_size_spinbox.setValue(DEFAULT_CACHE_SIZE_MB)
+        self.cache_size_spinbox.setSuffix(" MB")
+        params_layout.addRow("Cache Size Limit:", self.cache_size_spinbox)
+
+        # 0 leaves the limit to be learned from the provider's rate-limit headers
+        self.rpm_spinbox = QSpinBox()
+        self.rpm_spinbox.setRange(0, 1000000)
+        self.rpm_spinbox.setSpecialValueText("From API headers")
+        params_layout.addRow("Requests/Minute Limit:", self.rpm_spinbox)
+
+        self.tpm_spinbox = QSpinBox()
+        self.tpm_spinbox.setRange(0, 2000000000)
+        self.tpm_spinbox.setSpecialValueText("From API headers")
+        params_layout.addRow("Tokens/Minute Limit:", self.tpm_spinbox)
+
+        self.stream_checkbox = QCheckBox("Write responses as they stream in")
+        self.stream_checkbox.setChecked(True)
+        params_layout.addRow("Streaming:", self.stream_checkbox)
+
+        dedup_layout = QHBoxLayout()
+        self.dedup_checkbox = QCheckBox("Reuse front matter for duplicates, from similarity")
+        self.dedup_checkbox.setToolTip("Documents that repeat an earlier one in the run, apart from spacing or small "
+                                       "edits, get its front matter instead of their own API call")
+        self.dedup_threshold_spinbox = QDoubleSpinBox()
+        self.dedup_threshold_spinbox.setRange(0.5, 1.0)
+        self.dedup_threshold_spinbox.setSingleStep(0.05)
+        self.dedup_threshold_spinbox.setValue(DEFAULT_DEDUP_THRESHOLD)
+        dedup_layout.addWidget(self.dedup_checkbox)
+        dedup_layout.addWidget(self.dedup_threshold_spinbox)
+        params_layout.addRow("Duplicates:", dedup_layout)
+
+        self.spend_cap_spinbox = QDoubleSpinBox()
+        self.spend_cap_spinbox.setRange(0, 100000)
+        self.spend_cap_spinbox.setDecimals(2)
+        self.spend_cap_spinbox.setPrefix("$")
+        self.spend_cap_spinbox.setSpecialValueText("No cap")
+        self.spend_cap_spinbox.setToolTip("Runs estimated above this are refused, and no new files are started once "
+                                          "it is spent")
+        params_layout.addRow("Spend Cap per Run:", self.spend_cap_spinbox)
+
+        self.pack_size_spinbox = QSpinBox()
+        self.pack_size_spinbox.setRange(0, 32)
+        self.pack_size_spinbox.setSpecialValueText("Off")
+        self.pack_size_spinbox.setSuffix(" per request")
+        self.pack_size_spinbox.setToolTip("Send several small documents (up to 4 KB) in one request, so the prompt "
+                                          "is sent once for all of them")
+        params_layout.addRow("Pack Small Documents:", self.pack_size_spinbox)
+
+        self.search_index_checkbox = QCheckBox("Index front matter for search")
+        self.search_index_checkbox.setChecked(True)
+        self.search_index_checkbox.setToolTip("Keep the fields of every output in a searchable database in the "
+                                              "output directory (python -m search_index query)")
+        params_layout.addRow("Search Index:", self.search_index_checkbox)
         
         params_group.setLayout(params_layout)
         form_layout.addRow(params_group)
@@ -363,9 +571,6 @@ class AIFrontMatterMaker(QMainWindow):  # Changed class name
         self.save_settings_button.clicked.connect(self.save_settings)
         layout.addWidget(self.save_settings_button)
 
-        # Initialize available models
-        self.update_available_models()
-
     def update_max_tokens_display(self):
         self.max_tokens_display.setText(str(self.max_tokens_slider.value()))
 
@@ -373,7 +578,7 @@ class AIFrontMatterMaker(QMainWindow):  # Changed class name
         self.temperature_display.setText(str(self.temperature_slider.value() / 100))
 
     def update_max_tokens(self):
-        service = get_service(self.service_combo.currentText(), self.get_current_api_key())
+        service = self.get_current_service()
         model = self.model_combo.currentText()
         max_tokens = service.get_max_tokens(model)
         
@@ -383,14 +588,44 @@ class AIFrontMatterMaker(QMainWindow):  # Changed class name
 
     def on_service_changed(self, service: str):
         self.update_available_models()
-        self.update_max_tokens()
+        if self.first_paint_done:
+            self.warm_up_client()
 
     def update_available_models(self):
         self.model_combo.clear()
-        service = get_service(self.service_combo.currentText(), self.get_current_api_key())
-        self.model_combo.addItems(service.get_available_models())
+        service = self.get_current_service()
+        service_name = self.service_combo.currentText()
+        self.model_combo.addItems(service.get_available_models(
+            lambda models: self.models_updated.emit(service_name, models)))
         self.update_max_tokens()
 
+    def on_models_updated(self, service_name: str, models: list):
+        if service_name != self.service_combo.currentText():
+            return
+        current_model = self.model_combo.currentText()
+        self.model_combo.blockSignals(True)
+        self.model_combo.clear()
+        self.model_combo.addItems(models)
+        if current_model in models:
+            self.model_combo.setCurrentText(current_model)
+        self.model_combo.blockSignals(False)
+        self.update_max_tokens()
+
+    def get_current_service(self):
+        # get_service hands back the shared client for this service, key and endpoint, so UI events
+        # and runs reuse one connection pool instead of building a new client each time
+        service_name = self.service_combo.currentText()
+        pool_size, timeout = get_connection_settings(self.api_config)
+        return get_service(service_name, self.get_current_api_key(), get_base_url(self.api_config, service_name),
+                           pool_size, timeout)
+
+    def get_routed_service(self):
+        # Runs are spread over the routes in api_config.json, if any, with the selected service first
+        service_name = self.service_combo.currentText()
+        pool_size, timeout = get_connection_settings(self.api_config)
+        return routed_service(self.api_config, self.get_current_service(), service_name, self.get_current_api_key(),
+                              get_base_url(self.api_config, service_name), pool_size, timeout)
+
     def get_current_api_key(self) -> str:
         if self.service_combo.currentText() == "Anthropic":
             return self.api_key_entry.text()
@@ -400,11 +635,14 @@ class AIFrontMatterMaker(QMainWindow):  # Changed class name
 
     def save_config(self):
         config = configparser.ConfigParser()
+        text_files = self.file_queue.files()
         config['Paths'] = {
             'prompt_file': self.prompt_entry.text(),
-            'text_files': ';'.join([self.text_list_widget.item(i).text() for i in range(self.text_list_widget.count())]),
+            'text_files': ';'.join(text_files) if len(text_files) <= MANIFEST_THRESHOLD else '',
             'output_dir': self.output_entry.text(),
-            'reference': self.reference_entry.text()
+            'reference': self.reference_entry.text(),
+            'include': self.include_entry.text(),
+            'exclude': self.exclude_entry.text()
         }
         config['API'] = {
             'anthropic_api_key': self.api_key_entry.text(),
@@ -412,7 +650,8 @@ class AIFrontMatterMaker(QMainWindow):  # Changed class name
             'service': self.service_combo.currentText(),
             'model': self.model_combo.currentText(),
             'max_tokens': str(self.max_tokens_slider.value()),
-            'temperature': str(self.temperature_slider.value() / 100)
+            'temperature': str(self.temperature_slider.value() / 100),
+            'concurrency': str(self.concurrency_spinbox.value())
         }
         config['Reference'] = {
             'reference': self.reference_entry.text()
@@ -420,6 +659,12 @@ class AIFrontMatterMaker(QMainWindow):  # Changed class name
         
         filename, _ = QFileDialog.getSaveFileName(self, "Save Config", "", "INI Files (*.ini)")
         if filename:
+            if len(text_files) > MANIFEST_THRESHOLD:
+                # One path per line next to the .ini, stored relative to it
+                manifest_file = os.path.splitext(filename)[0] + '.files.txt'
+                with open(manifest_file, 'w', encoding='utf-8') as f:
+                    f.writelines(path + "\n" for path in text_files)
+                config['Paths']['text_files_manifest'] = os.path.basename(manifest_file)
             with open(filename, 'w') as configfile:
                 config.write(configfile)
             self.log(f"Configuration saved to {filename}")
@@ -432,10 +677,21 @@ class AIFrontMatterMaker(QMainWindow):  # Changed class name
             
             # Update only the main tab fields
             self.prompt_entry.setText(config['Paths'].get('prompt_file', ''))
-            self.text_list_widget.clear()
-            self.text_list_widget.addItems(config['Paths'].get('text_files', '').split(';'))
+            self.file_queue.clear()
+            manifest_file = config['Paths'].get('text_files_manifest')
+            if manifest_file:
+                manifest_path = os.path.join(os.path.dirname(filename), manifest_file)
+                try:
+                    with open(manifest_path, 'r', encoding='utf-8') as f:
+                        self.file_queue.add_files(line.rstrip('\n') for line in f)
+                except OSError as e:
+                    self.log(f"Could not read file list {manifest_path}: {str(e)}")
+            else:
+                self.file_queue.add_files(config['Paths'].get('text_files', '').split(';'))
             self.output_entry.setText(config['Paths'].get('output_dir', ''))
             self.reference_entry.setText(config['Paths'].get('reference', ''))
+            self.include_entry.setText(config['Paths'].get('include', "; ".join(DEFAULT_INCLUDE)))
+            self.exclude_entry.setText(config['Paths'].get('exclude', ''))
             
             # Log the configuration load
             self.log(f"Configuration loaded from {filename}")
@@ -446,10 +702,25 @@ class AIFrontMatterMaker(QMainWindow):  # Changed class name
         temperature = self.temperature_slider.value() / 100
         service = self.service_combo.currentText()
         model = self.model_combo.currentText()
-        save_api_config(anthropic_api_key, openai_api_key, temperature, service, model)
+        concurrency = self.concurrency_spinbox.value()
+        bypass_cache = self.bypass_cache_checkbox.isChecked()
+        cache_size_mb = self.cache_size_spinbox.value()
+        requests_per_minute = self.rpm_spinbox.value()
+        tokens_per_minute = self.tpm_spinbox.value()
+        stream = self.stream_checkbox.isChecked()
+        save_api_config(anthropic_api_key, openai_api_key, temperature, service, model, concurrency,
+                        bypass_cache, cache_size_mb, requests_per_minute, tokens_per_minute, stream,
+                        dedup=self.dedup_checkbox.isChecked(), dedup_threshold=self.dedup_threshold_spinbox.value(),
+                        spend_cap=self.spend_cap_spinbox.value(), pack_size=self.pack_size_spinbox.value(),
+                        search_index=self.search_index_checkbox.isChecked())
+        self.api_config = load_api_config()
         self.log("Settings saved")
 
     def closeEvent(self, event):
+        if self.process_thread and self.process_thread.watch_runner:
+            # Lets the files in progress finish and their journal entries be written
+            self.process_thread.stop()
+            self.process_thread.wait()
         self.save_settings()
         super().closeEvent(event)
 
@@ -0,0 +1,189 @@
+import argparse
+import os
+import signal
+import sys
+from config import (load_api_config, get_api_key, get_base_url, get_connection_settings, get_dedup_threshold,
+                    get_spend_cap, API_CONFIG_FILE, DEFAULT_MAX_TOKENS, DEFAULT_CONCURRENCY, DEFAULT_RETRIES)
+from response_cache import ResponseCache, CACHE_DIR, DEFAULT_CACHE_SIZE_MB
+from discovery import discover_files, input_roots, DEFAULT_INCLUDE
+from dedup import DEFAULT_DEDUP_THRESHOLD
+from packing import DEFAULT_PACK_MAX_BYTES
+from sharding import parse_shard, shard_files, default_node_id
+
+# Headless entry point: `python -m aifmm_cli --prompt prompt.txt --output-dir out "texts/*.txt"`.
+# Nothing here may import PyQt6, and the provider SDKs are only loaded once a service is built.
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="aifmm_cli", description="Generate front matter for text files without the GUI.")
+    parser.add_argument("inputs", nargs="+", help="Text files, directories (searched recursively) or glob patterns (quote globs, ** is supported)")
+    parser.add_argument("--include", action="append", help=f"Glob for files to use from directories, repeatable (default: {' '.join(DEFAULT_INCLUDE)})")
+    parser.add_argument("--exclude", action="append", default=[], help="Glob for files or subdirectories to skip in directories, repeatable")
+    parser.add_argument("--prompt", required=True, help="Prompt template containing {{TEXT}}")
+    parser.add_argument("--output-dir", required=True, help="Directory for the generated markdown files")
+    parser.add_argument("--config", default=API_CONFIG_FILE, help="API config file with keys and defaults (default: %(default)s)")
+    parser.add_argument("--service", help="API service, or the name of an endpoint in the config file (defaults to the config file)")
+    parser.add_argument("--endpoint", help="Use the OpenAI-compatible server at this URL, e.g. http://localhost:8000/v1 (needs --model)")
+    parser.add_argument("--model", help="Model name (defaults to the config file)")
+    parser.add_argument("--api-key", help="API key (defaults to the config file, then ANTHROPIC_API_KEY / OPENAI_API_KEY)")
+    parser.add_argument("--base-url", help="API endpoint override (defaults to the config file, then the provider's)")
+    parser.add_argument("--max-tokens", type=int, default=DEFAULT_MAX_TOKENS)
+    parser.add_argument("--temperature", type=float, help="Sampling temperature (defaults to the config file)")
+    parser.add_argument("--concurrency", type=int, help="Concurrent requests (defaults to the config file)")
+    parser.add_argument("--rpm", type=int, help="Requests per minute to stay under (defaults to the config file, then response headers)")
+    parser.add_argument("--tpm", type=int, help="Tokens per minute to stay under (defaults to the config file, then response headers)")
+    parser.add_argument("--pool-size", type=int, help="HTTP keep-alive connections to the API (defaults to the config file, then the SDK's)")
+    parser.add_argument("--timeout", type=float, help="Request timeout in seconds (defaults to the config file, then the SDK's)")
+    parser.add_argument("--hedge", action="store_true", help="Send a duplicate request when a call is slower than its route's p95 latency")
+    parser.add_argument("--reference", default="", help="Reference line written below the front matter")
+    parser.add_argument("--bypass-cache", action="store_true", help="Always call the API instead of the response cache")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--cache-size-mb", type=int, help="Response cache size limit (defaults to the config file)")
+    parser.add_argument("--resume", action="store_true", help="Skip files the output journal records as finished")
+    parser.add_argument("--incremental", action="store_true", help="Only process files whose text or prompt changed")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help="Retry rounds for failed files (default: %(default)s)")
+    parser.add_argument("--dedup", action="store_true", help="Reuse the front matter of an earlier document for its duplicates and near-duplicates")
+    parser.add_argument("--dedup-threshold", type=float, help="Similarity (0-1) from which documents count as near-duplicates, 1 for exact only (implies --dedup)")
+    parser.add_argument("--spend-cap", type=float, help="Refuse runs estimated above this many US dollars and stop starting files once it is spent, 0 for no cap (defaults to the config file)")
+    parser.add_argument("--dry-run", action="store_true", help="Print the token and cost estimate per file without calling the API")
+    parser.add_argument("--in-order", action="store_true", help="Process files in the given order instead of largest first")
+    parser.add_argument("--pack", type=int, help="Send up to this many small documents in one request, 0 for off (defaults to the config file)")
+    parser.add_argument("--pack-max-bytes", type=int, help="Largest document that is packed (defaults to the config file, then 4096)")
+    parser.add_argument("--chunk-tokens", type=int, help="Split documents above this many tokens (default: from the model's context window)")
+    parser.add_argument("--no-stream", action="store_true", help="Wait for complete responses instead of streaming them")
+    parser.add_argument("--no-index", action="store_true", help="Don't update the front matter search index in the output directory")
+    parser.add_argument("--watch", action="store_true", help="Keep running and process new and changed files in the input directories as they arrive (Ctrl+C to stop)")
+    parser.add_argument("--debounce", type=float, help="Seconds a file must stay unchanged before it is processed in watch mode (default: 2)")
+    parser.add_argument("--shard", help="Process only slice K of N (e.g. 2/4) of the inputs, for running N nodes over a shared filesystem")
+    parser.add_argument("--lease", action="store_true", help="Share the inputs with other nodes by claiming files through lease files in the output directory")
+    parser.add_argument("--lease-seconds", type=float, default=300, help="Seconds without renewal after which another node takes over a lease (default: %(default)s)")
+    parser.add_argument("--node-id", help="Name of this node in a sharded run, for its journal and report (default: the shard, or the host name)")
+    parser.add_argument("--batch", action="store_true", help="Use the provider's asynchronous, discounted batch API")
+    parser.add_argument("--poll-interval", type=float, default=60, help="Seconds between batch status polls (default: %(default)s)")
+    parser.add_argument("--report", help="JSON run report with per-file metrics (default: .aifmm_report.json in the output directory)")
+    parser.add_argument("--prometheus", help="Also write the run summary as a Prometheus textfile to this path")
+    return parser
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    config = load_api_config(args.config)
+
+    # Configured endpoints are registered before the service is looked up; get_service knows them by name
+    from api_services import get_service, register_endpoints, register_endpoint, Endpoint
+    register_endpoints(config.get('endpoints'))
+    service_name = args.service or config.get('service', 'Anthropic')
+    if args.endpoint:
+        if not args.model:
+            print("Error: --endpoint needs --model.", file=sys.stderr)
+            return 2
+        service_name = register_endpoint(Endpoint(args.endpoint))
+    # Keys from the environment only go to their own provider, never to another endpoint
+    env_var = {"Anthropic": "ANTHROPIC_API_KEY", "OpenAI": "OPENAI_API_KEY"}.get(service_name)
+    api_key = args.api_key or get_api_key(config, service_name) or (os.environ.get(env_var, "") if env_var else "")
+    temperature = args.temperature if args.temperature is not None else config.get('temperature', 0.0)
+    concurrency = args.concurrency or config.get('concurrency', DEFAULT_CONCURRENCY)
+
+    cache = None
+    if not (args.bypass_cache or config.get('bypass_cache', False)):
+        cache_size_mb = args.cache_size_mb or config.get('cache_size_mb', DEFAULT_CACHE_SIZE_MB)
+        cache = ResponseCache(args.cache_dir, max_bytes=cache_size_mb * 1024 * 1024)
+
+    dedup_threshold = get_dedup_threshold(config)
+    if args.dedup_threshold is not None:
+        if not 0.0 <= args.dedup_threshold <= 1.0:
+            print("Error: --dedup-threshold must be between 0 and 1.", file=sys.stderr)
+            return 2
+        dedup_threshold = args.dedup_threshold
+    elif args.dedup and dedup_threshold is None:
+        dedup_threshold = config.get('dedup_threshold', DEFAULT_DEDUP_THRESHOLD)
+
+    spend_cap = get_spend_cap(config) if args.spend_cap is None else args.spend_cap or None
+
+    # Found lazily while the first files are already being processed
+    text_files = discover_files(args.inputs, args.include or DEFAULT_INCLUDE, args.exclude)
+    node_id = args.node_id
+    if args.shard or args.lease:
+        if args.watch or (args.lease and args.batch):
+            print("Error: Sharded runs don't support --watch, and leases don't support --batch.", file=sys.stderr)
+            return 2
+        if args.shard:
+            try:
+                shard_index, shard_count = parse_shard(args.shard)
+            except ValueError as e:
+                print(f"Error: {str(e)}", file=sys.stderr)
+                return 2
+            text_files = shard_files(text_files, shard_index, shard_count, input_roots(args.inputs))
+            node_id = node_id or f"shard-{shard_index}-of-{shard_count}"
+        node_id = node_id or default_node_id()
+    if not input_roots(args.inputs):
+        # Only directories are walked lazily; files and globs can be ordered largest first
+        text_files = list(text_files)
+
+    from pipeline import FrontMatterPipeline
+    from routing import routed_service, RoutedService
+    base_url = args.base_url or get_base_url(config, service_name)
+    pool_size, timeout = get_connection_settings(config)
+    pool_size, timeout = args.pool_size or pool_size, args.timeout or timeout
+    service = get_service(service_name, api_key, base_url, pool_size, timeout)
+    if args.hedge:
+        config['hedge_requests'] = True
+    # Spreads the run over the routes configured in the config file, if any
+    service = routed_service(config, service, service_name, api_key, base_url, pool_size, timeout)
+    service.scheduler.set_limits(args.rpm or config.get('requests_per_minute') or None,
+                                 args.tpm or config.get('tokens_per_minute') or None)
+    pipeline = FrontMatterPipeline(
+        service=service,
+        service_name=service_name,
+        model=args.model or config.get('model'),
+        max_tokens=args.max_tokens,
+        temperature=temperature,
+        reference=args.reference,
+        concurrency=concurrency,
+        cache=cache,
+        resume=args.resume,
+        incremental=args.incremental,
+        retries=args.retries,
+        chunk_tokens=args.chunk_tokens,
+        stream=not (args.no_stream or not config.get('stream', True)),
+        report_file=args.report,
+        prometheus_file=args.prometheus,
+        input_roots=input_roots(args.inputs),
+        dedup_threshold=dedup_threshold,
+        spend_cap=spend_cap,
+        largest_first=not args.in_order,
+        pack_size=args.pack if args.pack is not None else config.get('pack_size', 0),
+        pack_max_bytes=args.pack_max_bytes or config.get('pack_max_bytes') or DEFAULT_PACK_MAX_BYTES,
+        node_id=node_id,
+        leases=args.lease,
+        lease_seconds=args.lease_seconds,
+        search_index=not (args.no_index or not config.get('search_index', True)),
+        progress=lambda completed, total: print(f"[{completed}/{total}]", file=sys.stderr)
+    )
+    if args.dry_run:
+        text_files = list(text_files)
+        error = pipeline.validate_input(args.prompt, text_files, args.output_dir)
+        if error:
+            print(f"Error: {error}", file=sys.stderr)
+            return 1
+        plan = pipeline.plan(args.prompt, text_files)
+        print(plan.table())
+        print(plan.describe())
+        for issue in plan.issues:
+            print(f"Warning: {issue}", file=sys.stderr)
+        return 1 if plan.over_spend_cap() or plan.totals()['errors'] else 0
+    if args.watch:
+        from watcher import WatchRunner, WATCH_DEBOUNCE_SECONDS
+        runner = WatchRunner(pipeline, args.include or DEFAULT_INCLUDE, args.exclude,
+                             args.debounce if args.debounce is not None else WATCH_DEBOUNCE_SECONDS)
+        signal.signal(signal.SIGTERM, lambda signum, frame: runner.stop())
+        ok = runner.run(args.prompt, args.inputs, args.output_dir)
+    elif args.batch:
+        from batch_runner import BatchRunner
+        ok = BatchRunner(pipeline, poll_interval=args.poll_interval).run(args.prompt, text_files, args.output_dir)
+    else:
+        ok = pipeline.run(args.prompt, text_files, args.output_dir)
+    if isinstance(service, RoutedService):
+        print(service.describe(), file=sys.stderr)
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
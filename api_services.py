@@ -1,47 +1,596 @@
 import abc
-from typing import List, Dict, Any
-import anthropic
-import openai
-from model_cache import load_cached_models, save_cached_models
+import asyncio
+import inspect
+import json
+import math
+import random
+import re
+import threading
+import time
+import weakref
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import List, Dict, Any, Awaitable, Callable, Mapping, Optional, Tuple, Union
+from model_cache import get_model_cache
+
+DEFAULT_MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+# Retries may add at most this fraction of extra requests (plus a small floor), so an outage
+# fails the batch's calls quickly instead of multiplying the load on the provider
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_MIN = 10
+RETRYABLE_STATUS_CODES = (408, 409, 429)
+CONNECT_TIMEOUT_SECONDS = 10.0
+
+# Status values returned by get_batch_status, normalized across providers
+BATCH_IN_PROGRESS = "in_progress"
+BATCH_ENDED = "ended"
+BATCH_FAILED = "failed"
+
+# Rough local estimate used when no tokenizer is available; errs towards overcounting
+CHARS_PER_TOKEN = 3.5
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+@dataclass
+class APIResponse:
+    text: str
+    input_tokens: int = 0
+    output_tokens: int = 0
+    # Prompt tokens served from / written to the provider's prefix cache
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+    retries: int = 0
+    # Set when the response's price differs from the run's model, e.g. when it was routed elsewhere
+    cost: Optional[float] = None
+
+@dataclass
+class ModelPricing:
+    # US dollars per million tokens, from the providers' published list prices
+    input: float
+    output: float
+    cache_read: float
+    cache_write: float
+
+    def cost(self, response: APIResponse) -> float:
+        # input_tokens includes the cached prompt tokens, which are billed at their own rates
+        uncached = max(0, response.input_tokens - response.cache_read_tokens - response.cache_write_tokens)
+        return (uncached * self.input + response.cache_read_tokens * self.cache_read
+                + response.cache_write_tokens * self.cache_write + response.output_tokens * self.output) / 1e6
+
+def lookup_pricing(prices: Dict[str, Tuple[float, float]], model: str, cache_read_ratio: float,
+                   cache_write_ratio: float) -> Optional[ModelPricing]:
+    # Dated snapshots share the price of their family, so match the longest known prefix
+    matches = [name for name in prices if model.startswith(name)]
+    if not matches:
+        return None
+    input_price, output_price = prices[max(matches, key=len)]
+    return ModelPricing(input_price, output_price, input_price * cache_read_ratio, input_price * cache_write_ratio)
+
+class APIServiceError(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None, retryable: bool = False,
+                 retry_after: Optional[float] = None, headers: Optional[Mapping[str, str]] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.headers = headers or {}
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    # Handles plain seconds ("2", "0.5"), OpenAI-style durations ("6m0s", "20ms") and timestamps
+    # (RFC 3339 from Anthropic, HTTP dates in Retry-After)
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if parts and "".join(number + unit for number, unit in parts) == value:
+        scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        return sum(float(number) * scale[unit] for number, unit in parts)
+    try:
+        moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        try:
+            moment = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return max(0.0, (moment - datetime.now(timezone.utc)).total_seconds())
+
+def service_error(provider: str, error: Exception) -> APIServiceError:
+    status_code = getattr(error, 'status_code', None)
+    response = getattr(error, 'response', None)
+    headers = dict(response.headers) if response is not None else {}
+    retry_after = None
+    if 'retry-after-ms' in headers:
+        retry_after = (parse_duration(headers['retry-after-ms']) or 0) / 1000
+    elif 'retry-after' in headers:
+        retry_after = parse_duration(headers['retry-after'])
+    # No status code means the request never got an answer (connection reset, timeout)
+    retryable = status_code is None or status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+    return APIServiceError(f"{provider} API error: {error}", status_code, retryable, retry_after, headers)
+
+class TokenBucket:
+    # Capacity is a per-minute allowance that refills continuously. reserve() takes the amount up front
+    # and returns how long the caller must wait, so concurrent callers queue up instead of stampeding.
+    def __init__(self, per_minute: Optional[float] = None):
+        self.lock = threading.Lock()
+        self.capacity = None
+        self.level = 0.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.set_limit(per_minute)
+
+    def set_limit(self, per_minute: Optional[float]):
+        with self.lock:
+            if per_minute and per_minute > 0:
+                if self.capacity is None:
+                    self.level = float(per_minute)
+                self.capacity = float(per_minute)
+            else:
+                self.capacity = None
+
+    def _refill(self, now: float):
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0.0, self.blocked_until - now)
+            if self.capacity is not None:
+                self.level -= min(amount, self.capacity)
+                if self.level < 0:
+                    wait = max(wait, -self.level * 60 / self.capacity)
+            return wait
+
+    def observe(self, limit: Optional[float], remaining: Optional[float], reset: Optional[float]):
+        if limit:
+            self.set_limit(limit)
+        with self.lock:
+            self._refill(time.monotonic())
+            if remaining is not None and self.capacity is not None:
+                self.level = min(self.level, remaining)
+        if remaining is not None and remaining <= 0 and reset:
+            self.pause(reset)
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class RetryBudget:
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, minimum: int = RETRY_BUDGET_MIN):
+        self.lock = threading.Lock()
+        self.ratio = ratio
+        self.balance = float(minimum)
+
+    def deposit(self):
+        with self.lock:
+            self.balance += self.ratio
+
+    def withdraw(self) -> bool:
+        with self.lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+# (limit, remaining, reset) header names for requests and tokens, per provider
+RATE_LIMIT_HEADERS = {
+    'requests': [
+        ('anthropic-ratelimit-requests-limit', 'anthropic-ratelimit-requests-remaining',
+         'anthropic-ratelimit-requests-reset'),
+        ('x-ratelimit-limit-requests', 'x-ratelimit-remaining-requests', 'x-ratelimit-reset-requests')
+    ],
+    'tokens': [
+        ('anthropic-ratelimit-tokens-limit', 'anthropic-ratelimit-tokens-remaining',
+         'anthropic-ratelimit-tokens-reset'),
+        ('x-ratelimit-limit-tokens', 'x-ratelimit-remaining-tokens', 'x-ratelimit-reset-tokens')
+    ]
+}
+
+class RequestScheduler:
+    # Paces calls per model with request and token buckets. Limits start from the configured values
+    # (or unlimited) and are corrected from the providers' rate-limit headers on every response.
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None,
+                 max_retries: int = DEFAULT_MAX_RETRIES, sleep: Callable[[float], None] = time.sleep):
+        self.lock = threading.Lock()
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.sleep = sleep
+        self.budget = RetryBudget()
+        self.buckets = {}
+
+    def set_limits(self, requests_per_minute: Optional[int], tokens_per_minute: Optional[int]):
+        with self.lock:
+            self.requests_per_minute = requests_per_minute
+            self.tokens_per_minute = tokens_per_minute
+            buckets = list(self.buckets.values())
+        for requests, tokens in buckets:
+            requests.set_limit(requests_per_minute)
+            tokens.set_limit(tokens_per_minute)
+
+    def buckets_for(self, model: str) -> Tuple[TokenBucket, TokenBucket]:
+        with self.lock:
+            if model not in self.buckets:
+                self.buckets[model] = (TokenBucket(self.requests_per_minute), TokenBucket(self.tokens_per_minute))
+            return self.buckets[model]
+
+    def observe_headers(self, model: str, headers: Mapping[str, str]):
+        if not headers:
+            return
+        headers = {key.lower(): value for key, value in headers.items()}
+        for bucket, names in zip(self.buckets_for(model), (RATE_LIMIT_HEADERS['requests'], RATE_LIMIT_HEADERS['tokens'])):
+            for limit_name, remaining_name, reset_name in names:
+                if limit_name in headers or remaining_name in headers:
+                    limit = parse_duration(headers.get(limit_name))
+                    remaining = parse_duration(headers.get(remaining_name))
+                    bucket.observe(limit, remaining, parse_duration(headers.get(reset_name)))
+
+    def wait_time(self, model: str, estimated_tokens: int) -> float:
+        requests, tokens = self.buckets_for(model)
+        return max(requests.reserve(1), tokens.reserve(estimated_tokens))
+
+    def retry_delay(self, model: str, error: APIServiceError, attempt: int) -> Optional[float]:
+        # Seconds to wait before retrying, or None when the error has to be raised
+        self.observe_headers(model, error.headers)
+        if not error.retryable or attempt >= self.max_retries or not self.budget.withdraw():
+            return None
+        # Full jitter keeps many workers that failed together from retrying in lockstep
+        delay = error.retry_after
+        if delay is None:
+            delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+        if error.status_code == 429:
+            self.buckets_for(model)[0].pause(delay)
+        return delay
+
+    def execute(self, model: str, estimated_tokens: int, send: Callable[[], Tuple[Any, Mapping[str, str]]]):
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            wait = self.wait_time(model, estimated_tokens)
+            if wait > 0:
+                self.sleep(wait)
+            try:
+                result, headers = send()
+            except APIServiceError as e:
+                delay = self.retry_delay(model, e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                self.sleep(delay)
+                continue
+            self.observe_headers(model, headers)
+            return result, attempt
+
+    async def aexecute(self, model: str, estimated_tokens: int,
+                       send: Callable[[], Awaitable[Tuple[Any, Mapping[str, str]]]]):
+        # execute() for coroutines: waits with asyncio.sleep, so other requests on the loop keep going
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            wait = self.wait_time(model, estimated_tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                result, headers = await send()
+            except APIServiceError as e:
+                delay = self.retry_delay(model, e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self.observe_headers(model, headers)
+            return result, attempt
+
+class StreamSink(abc.ABC):
+    # Receives a streamed response. begin() is called at the start of every attempt, so output
+    # written by an attempt that failed part-way (and is then retried) can be discarded.
+    @abc.abstractmethod
+    def begin(self):
+        pass
+
+    @abc.abstractmethod
+    def write(self, text: str):
+        pass
 
 class APIService(abc.ABC):
+    scheduler: RequestScheduler
+    _client = None
+    _client_lock: threading.Lock
+    _async_clients: weakref.WeakKeyDictionary
+
+    # SDK clients are built on first use, so a service can be created (e.g. on the UI thread to look up
+    # models and limits) without importing the SDK or opening connections
     @abc.abstractmethod
-    def call_api(self, content: str, model: str, max_tokens: int, temperature: float) -> str:
+    def create_client(self):
         pass
 
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self.create_client()
+        return self._client
+
+    # Only needed by services that override acall_api and astream_api with native async calls
+    def create_async_client(self):
+        raise NotImplementedError(f"{type(self).__name__} has no async client")
+
+    @property
+    def async_client(self):
+        # An async client's connections belong to the event loop it was created in, so there is one per loop
+        loop = asyncio.get_running_loop()
+        with self._client_lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = self._async_clients[loop] = self.create_async_client()
+        return client
+
+    # `prefix` is the static part of the prompt (everything before {{TEXT}}). It is sent first and
+    # marked cacheable where the provider supports it; `content` is the per-document remainder.
+    @abc.abstractmethod
+    def call_api(self, content: str, model: str, max_tokens: int, temperature: float,
+                 prefix: str = "") -> APIResponse:
+        pass
+
+    # Returns immediately with the cached (possibly expired) or built-in list. A newer list fetched in the
+    # background is passed to on_update, from the background thread.
     @abc.abstractmethod
-    def get_available_models(self) -> List[str]:
+    def get_available_models(self, on_update: Optional[Callable[[List[str]], None]] = None) -> List[str]:
         pass
 
+    # Maximum number of output tokens a single response may contain
     @abc.abstractmethod
     def get_max_tokens(self, model: str) -> int:
         pass
 
+    # Total tokens (prompt plus output) the model accepts in one request
+    @abc.abstractmethod
+    def get_context_window(self, model: str) -> int:
+        pass
+
+    def count_tokens(self, text: str, model: str) -> int:
+        return estimate_tokens(text)
+
+    # Used for cost estimates in the run report; None when the model's price is unknown
+    def get_pricing(self, model: str) -> Optional[ModelPricing]:
+        return None
+
+    # Streams the response text into `sink` as it arrives. The returned APIResponse carries the
+    # token usage but no text. Services without a streaming endpoint deliver the text in one piece.
+    def stream_api(self, content: str, model: str, max_tokens: int, temperature: float, sink: StreamSink,
+                   prefix: str = "") -> APIResponse:
+        sink.begin()
+        response = self.call_api(content, model, max_tokens, temperature, prefix)
+        sink.write(response.text)
+        response.text = ""
+        return response
+
+    # Coroutine versions of call_api and stream_api, for sending many requests from one event loop. By
+    # default they run the blocking call in a worker thread; services with an async SDK client override them.
+    async def acall_api(self, content: str, model: str, max_tokens: int, temperature: float,
+                        prefix: str = "") -> APIResponse:
+        return await asyncio.to_thread(self.call_api, content, model, max_tokens, temperature, prefix)
+
+    async def astream_api(self, content: str, model: str, max_tokens: int, temperature: float, sink: StreamSink,
+                          prefix: str = "") -> APIResponse:
+        return await asyncio.to_thread(self.stream_api, content, model, max_tokens, temperature, sink, prefix)
+
+    # Asynchronous batch endpoints. `requests` is a list of (custom_id, content) pairs and
+    # get_batch_results maps each custom_id to its response text, or None if that request failed.
+    def submit_batch(self, requests: List[Tuple[str, str]], model: str, max_tokens: int, temperature: float,
+                     prefix: str = "") -> str:
+        raise NotImplementedError(f"{type(self).__name__} does not support batch requests")
+
+    def get_batch_status(self, batch_id: str) -> str:
+        raise NotImplementedError(f"{type(self).__name__} does not support batch requests")
+
+    def get_batch_results(self, batch_id: str) -> Dict[str, Optional[str]]:
+        raise NotImplementedError(f"{type(self).__name__} does not support batch requests")
+
+def client_options(sdk, pool_size: Optional[int] = None, timeout: Optional[float] = None,
+                   asynchronous: bool = False) -> Dict[str, Any]:
+    # Extra SDK client arguments for a connection pool of pool_size keep-alive connections and a request
+    # timeout in seconds; None keeps the SDK's defaults. The pool is shared by every thread using the client,
+    # or by every task of the event loop for an async client.
+    options = {}
+    try:
+        import httpx
+    except ImportError:
+        return {'timeout': timeout} if timeout else options
+    if timeout:
+        options['timeout'] = httpx.Timeout(timeout, connect=min(timeout, CONNECT_TIMEOUT_SECONDS))
+    http_client = getattr(sdk, 'DefaultAsyncHttpxClient' if asynchronous else 'DefaultHttpxClient', None)
+    if pool_size and http_client:
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        options['http_client'] = http_client(limits=limits)
+    return options
+
+def transport_errors() -> Tuple[type, ...]:
+    # Connection errors raised while a stream is being read reach the caller as httpx errors, not SDK errors
+    try:
+        import httpx
+    except ImportError:
+        return ()
+    return (httpx.TransportError,)
+
+async def parse_raw(raw) -> Any:
+    # Depending on the SDK and its version, an async raw response parses synchronously or asynchronously
+    parsed = raw.parse()
+    return await parsed if inspect.isawaitable(parsed) else parsed
+
+# The provider SDKs are imported inside the services so that importing this module
+# (e.g. from the headless CLI) stays cheap until a client is actually needed.
 class AnthropicService(APIService):
-    def __init__(self, api_key: str):
-        # Ensure the API key is passed correctly
-        self.client = anthropic.Anthropic(api_key=api_key)
+    def __init__(self, api_key: str, base_url: Optional[str] = None, pool_size: Optional[int] = None,
+                 timeout: Optional[float] = None):
+        self.client_args = (api_key, base_url, pool_size, timeout)
+        self._client_lock = threading.Lock()
+        self._async_clients = weakref.WeakKeyDictionary()
+        self.scheduler = RequestScheduler()
 
-    def call_api(self, content: str, model: str, max_tokens: int, temperature: float) -> str:
-        try:
-            message = self.client.messages.create(
-                model=model,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                messages=[
-                    {"role": "user", "content": content}
-                ]
-            )
-            return message.content[0].text if message.content else ""
-        except anthropic.APIConnectionError as e:
-            print(f"Error calling Anthropic API: {e}")
-            return "I apologize, but I'm having trouble connecting to my knowledge base right now. Please try again later."
-
-    def get_available_models(self) -> List[str]:
-        cached_models = load_cached_models('Anthropic')
-        if cached_models:
-            return cached_models
+    def create_client(self):
+        import anthropic
+        api_key, base_url, pool_size, timeout = self.client_args
+        # Ensure the API key is passed correctly; retries are handled by the scheduler instead of the SDK
+        return anthropic.Anthropic(api_key=api_key, base_url=base_url, max_retries=0,
+                                   **client_options(anthropic, pool_size, timeout))
+
+    def create_async_client(self):
+        import anthropic
+        api_key, base_url, pool_size, timeout = self.client_args
+        return anthropic.AsyncAnthropic(api_key=api_key, base_url=base_url, max_retries=0,
+                                        **client_options(anthropic, pool_size, timeout, asynchronous=True))
+
+    @staticmethod
+    def build_content(content: str, prefix: str):
+        if not prefix:
+            return content
+        # The cache breakpoint sits after the static instructions, so every document reuses them
+        blocks = [{"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}}]
+        # A prompt without {{TEXT}} has no content, and empty text blocks are rejected
+        if content:
+            blocks.append({"type": "text", "text": content})
+        return blocks
+
+    def request_args(self, content: str, model: str, max_tokens: int, temperature: float,
+                     prefix: str) -> Dict[str, Any]:
+        return {
+            "model": model,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "messages": [
+                {"role": "user", "content": self.build_content(content, prefix)}
+            ]
+        }
+
+    @staticmethod
+    def build_response(message, retries: int, text: str = "") -> APIResponse:
+        usage = message.usage
+        cache_read_tokens = getattr(usage, 'cache_read_input_tokens', 0) or 0
+        cache_write_tokens = getattr(usage, 'cache_creation_input_tokens', 0) or 0
+        # Anthropic reports cached prompt tokens separately from input_tokens; OpenAI includes them
+        return APIResponse(
+            text=text,
+            input_tokens=usage.input_tokens + cache_read_tokens + cache_write_tokens,
+            output_tokens=usage.output_tokens,
+            cache_read_tokens=cache_read_tokens,
+            cache_write_tokens=cache_write_tokens,
+            retries=retries
+        )
+
+    def call_api(self, content: str, model: str, max_tokens: int, temperature: float,
+                 prefix: str = "") -> APIResponse:
+        import anthropic
+
+        def send():
+            try:
+                raw = self.client.messages.with_raw_response.create(
+                    **self.request_args(content, model, max_tokens, temperature, prefix))
+            except anthropic.APIError as e:
+                raise service_error("Anthropic", e) from e
+            return raw.parse(), raw.headers
+
+        message, retries = self.scheduler.execute(model, estimate_tokens(prefix + content) + max_tokens, send)
+        return self.build_response(message, retries, message.content[0].text if message.content else "")
+
+    async def acall_api(self, content: str, model: str, max_tokens: int, temperature: float,
+                        prefix: str = "") -> APIResponse:
+        import anthropic
+
+        async def send():
+            try:
+                raw = await self.async_client.messages.with_raw_response.create(
+                    **self.request_args(content, model, max_tokens, temperature, prefix))
+                return await parse_raw(raw), raw.headers
+            except anthropic.APIError as e:
+                raise service_error("Anthropic", e) from e
+
+        message, retries = await self.scheduler.aexecute(model, estimate_tokens(prefix + content) + max_tokens,
+                                                         send)
+        return self.build_response(message, retries, message.content[0].text if message.content else "")
+
+    def stream_api(self, content: str, model: str, max_tokens: int, temperature: float, sink: StreamSink,
+                   prefix: str = "") -> APIResponse:
+        import anthropic
+
+        def send():
+            sink.begin()
+            try:
+                with self.client.messages.stream(
+                        **self.request_args(content, model, max_tokens, temperature, prefix)) as stream:
+                    for text in stream.text_stream:
+                        sink.write(text)
+                    message = stream.get_final_message()
+                    response = getattr(stream, 'response', None)
+            except (anthropic.APIError,) + transport_errors() as e:
+                raise service_error("Anthropic", e) from e
+            return message, response.headers if response is not None else {}
+
+        message, retries = self.scheduler.execute(model, estimate_tokens(prefix + content) + max_tokens, send)
+        return self.build_response(message, retries)
+
+    async def astream_api(self, content: str, model: str, max_tokens: int, temperature: float, sink: StreamSink,
+                          prefix: str = "") -> APIResponse:
+        import anthropic
+
+        async def send():
+            sink.begin()
+            try:
+                async with self.async_client.messages.stream(
+                        **self.request_args(content, model, max_tokens, temperature, prefix)) as stream:
+                    async for text in stream.text_stream:
+                        sink.write(text)
+                    message = await stream.get_final_message()
+                    response = getattr(stream, 'response', None)
+            except (anthropic.APIError,) + transport_errors() as e:
+                raise service_error("Anthropic", e) from e
+            return message, response.headers if response is not None else {}
 
+        message, retries = await self.scheduler.aexecute(model, estimate_tokens(prefix + content) + max_tokens,
+                                                         send)
+        return self.build_response(message, retries)
+
+    def submit_batch(self, requests: List[Tuple[str, str]], model: str, max_tokens: int, temperature: float,
+                     prefix: str = "") -> str:
+        batch = self.client.messages.batches.create(
+            requests=[
+                {
+                    "custom_id": custom_id,
+                    "params": self.request_args(content, model, max_tokens, temperature, prefix)
+                }
+                for custom_id, content in requests
+            ]
+        )
+        return batch.id
+
+    def get_batch_status(self, batch_id: str) -> str:
+        batch = self.client.messages.batches.retrieve(batch_id)
+        return BATCH_ENDED if batch.processing_status == "ended" else BATCH_IN_PROGRESS
+
+    def get_batch_results(self, batch_id: str) -> Dict[str, Optional[str]]:
+        results = {}
+        for entry in self.client.messages.batches.results(batch_id):
+            text = None
+            if entry.result.type == "succeeded" and entry.result.message.content:
+                text = entry.result.message.content[0].text
+            results[entry.custom_id] = text
+        return results
+
+    def get_available_models(self, on_update: Optional[Callable[[List[str]], None]] = None) -> List[str]:
         models = [
             "claude-3-opus-20240229",
             "claude-3-sonnet-20240229",
@@ -50,67 +599,269 @@ class AnthropicService(APIService):
             "claude-2.0",
             "claude-instant-1.2"
         ]
-        save_cached_models('Anthropic', models)
-        return models
+        return get_model_cache().get_or_refresh('Anthropic', self.list_models, models, on_update)
+
+    def list_models(self) -> List[str]:
+        return sorted(model.id for model in self.client.models.list() if model.id.startswith("claude-"))
 
     def get_max_tokens(self, model: str) -> int:
-        # Ensure all Anthropic models are set to 4096
-        return 4096
+        # Output limits by model family; dated snapshots share the limit of their family
+        max_tokens = {
+            "claude-3-5-sonnet": 8192,
+            "claude-3-5-haiku": 8192,
+            "claude-3-7-sonnet": 64000,
+            "claude-sonnet-4": 64000,
+            "claude-opus-4": 32000
+        }
+        matches = [name for name in max_tokens if model.startswith(name)]
+        return max_tokens[max(matches, key=len)] if matches else 4096
+
+    def get_context_window(self, model: str) -> int:
+        context_windows = {
+            "claude-2.0": 100000,
+            "claude-instant-1.2": 100000
+        }
+        return context_windows.get(model, 200000)
+
+    def get_pricing(self, model: str) -> Optional[ModelPricing]:
+        prices = {
+            "claude-3-opus": (15.0, 75.0),
+            "claude-3-sonnet": (3.0, 15.0),
+            "claude-3-5-sonnet": (3.0, 15.0),
+            "claude-3-haiku": (0.25, 1.25),
+            "claude-3-5-haiku": (0.8, 4.0),
+            "claude-2": (8.0, 24.0),
+            "claude-instant": (0.8, 2.4)
+        }
+        # Cache reads cost a tenth of the input price, cache writes a quarter more
+        return lookup_pricing(prices, model, 0.1, 1.25)
 
 class OpenAIService(APIService):
-    def __init__(self, api_key: str):
-        # Ensure the API key is passed correctly
-        self.client = openai.OpenAI(api_key=api_key)
+    provider = "OpenAI"
 
-    def call_api(self, content: str, model: str, max_tokens: int, temperature: float) -> str:
-        try:
-            response = self.client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "user", "content": content}
-                ],
-                max_tokens=max_tokens,
-                temperature=temperature
-            )
-            return response.choices[0].message.content
-        except openai.APIConnectionError as e:
-            print(f"Error calling OpenAI API: {e}")
-            return "I apologize, but I'm having trouble connecting to my knowledge base right now. Please try again later."
-
-    def get_available_models(self) -> List[str]:
-        cached_models = load_cached_models('OpenAI')
-        if cached_models:
-            return cached_models
+    def __init__(self, api_key: str, base_url: Optional[str] = None, pool_size: Optional[int] = None,
+                 timeout: Optional[float] = None):
+        self.client_args = (api_key, base_url, pool_size, timeout)
+        self._client_lock = threading.Lock()
+        self._async_clients = weakref.WeakKeyDictionary()
+        self.scheduler = RequestScheduler()
 
-        try:
-            models = self.client.models.list()
-            chat_models = [model.id for model in models if model.id.startswith("gpt-")]
-            sorted_models = sorted(chat_models)
-            save_cached_models('OpenAI', sorted_models)
-            return sorted_models
-        except openai.APIConnectionError as e:
-            print(f"Error fetching models: {e}")
-            return [
-                "gpt-4-0125-preview",
-                "gpt-4-turbo-preview",
-                "gpt-4-1106-preview",
-                "gpt-4-vision-preview",
-                "gpt-4",
-                "gpt-4-0314",
-                "gpt-4-0613",
-                "gpt-4-32k",
-                "gpt-4-32k-0314",
-                "gpt-4-32k-0613",
-                "gpt-3.5-turbo",
-                "gpt-3.5-turbo-16k",
-                "gpt-3.5-turbo-0301",
-                "gpt-3.5-turbo-0613",
-                "gpt-3.5-turbo-1106",
-                "gpt-3.5-turbo-16k-0613"
-            ]
+    def create_client(self):
+        import openai
+        api_key, base_url, pool_size, timeout = self.client_args
+        # Ensure the API key is passed correctly; retries are handled by the scheduler instead of the SDK
+        return openai.OpenAI(api_key=api_key, base_url=base_url, max_retries=0,
+                             **client_options(openai, pool_size, timeout))
+
+    def create_async_client(self):
+        import openai
+        api_key, base_url, pool_size, timeout = self.client_args
+        return openai.AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0,
+                                  **client_options(openai, pool_size, timeout, asynchronous=True))
+
+    @staticmethod
+    def request_args(content: str, model: str, max_tokens: int, temperature: float, prefix: str) -> Dict[str, Any]:
+        # OpenAI caches long prompt prefixes automatically; keeping the static
+        # instructions first and byte-identical across requests is what makes them hit.
+        return {
+            "model": model,
+            "messages": [
+                {"role": "user", "content": prefix + content}
+            ],
+            "max_tokens": max_tokens,
+            "temperature": temperature
+        }
+
+    @staticmethod
+    def build_response(usage, retries: int, text: str = "") -> APIResponse:
+        details = getattr(usage, 'prompt_tokens_details', None) if usage else None
+        return APIResponse(
+            text=text,
+            input_tokens=usage.prompt_tokens if usage else 0,
+            output_tokens=usage.completion_tokens if usage else 0,
+            cache_read_tokens=(getattr(details, 'cached_tokens', 0) or 0) if details else 0,
+            retries=retries
+        )
+
+    def call_api(self, content: str, model: str, max_tokens: int, temperature: float,
+                 prefix: str = "") -> APIResponse:
+        import openai
+
+        def send():
+            try:
+                raw = self.client.chat.completions.with_raw_response.create(
+                    **self.request_args(content, model, max_tokens, temperature, prefix))
+            except openai.APIError as e:
+                raise service_error(self.provider, e) from e
+            return raw.parse(), raw.headers
+
+        response, retries = self.scheduler.execute(model, estimate_tokens(prefix + content) + max_tokens, send)
+        return self.build_response(response.usage, retries, response.choices[0].message.content or "")
+
+    async def acall_api(self, content: str, model: str, max_tokens: int, temperature: float,
+                        prefix: str = "") -> APIResponse:
+        import openai
+
+        async def send():
+            try:
+                raw = await self.async_client.chat.completions.with_raw_response.create(
+                    **self.request_args(content, model, max_tokens, temperature, prefix))
+                return await parse_raw(raw), raw.headers
+            except openai.APIError as e:
+                raise service_error(self.provider, e) from e
+
+        response, retries = await self.scheduler.aexecute(model, estimate_tokens(prefix + content) + max_tokens,
+                                                          send)
+        return self.build_response(response.usage, retries, response.choices[0].message.content or "")
+
+    def stream_api(self, content: str, model: str, max_tokens: int, temperature: float, sink: StreamSink,
+                   prefix: str = "") -> APIResponse:
+        import openai
+
+        def send():
+            sink.begin()
+            usage = None
+            try:
+                # Closed on errors too, so a dropped stream doesn't hold on to its pooled connection
+                with self.client.chat.completions.create(
+                        **self.request_args(content, model, max_tokens, temperature, prefix),
+                        stream=True,
+                        stream_options={"include_usage": True}) as stream:
+                    for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            sink.write(chunk.choices[0].delta.content)
+                        if chunk.usage:
+                            usage = chunk.usage
+            except (openai.APIError,) + transport_errors() as e:
+                raise service_error(self.provider, e) from e
+            response = getattr(stream, 'response', None)
+            return usage, response.headers if response is not None else {}
+
+        usage, retries = self.scheduler.execute(model, estimate_tokens(prefix + content) + max_tokens, send)
+        return self.build_response(usage, retries)
+
+    async def astream_api(self, content: str, model: str, max_tokens: int, temperature: float, sink: StreamSink,
+                          prefix: str = "") -> APIResponse:
+        import openai
+
+        async def send():
+            sink.begin()
+            usage = None
+            try:
+                async with await self.async_client.chat.completions.create(
+                        **self.request_args(content, model, max_tokens, temperature, prefix),
+                        stream=True,
+                        stream_options={"include_usage": True}) as stream:
+                    async for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            sink.write(chunk.choices[0].delta.content)
+                        if chunk.usage:
+                            usage = chunk.usage
+            except (openai.APIError,) + transport_errors() as e:
+                raise service_error(self.provider, e) from e
+            response = getattr(stream, 'response', None)
+            return usage, response.headers if response is not None else {}
+
+        usage, retries = await self.scheduler.aexecute(model, estimate_tokens(prefix + content) + max_tokens, send)
+        return self.build_response(usage, retries)
+
+    def submit_batch(self, requests: List[Tuple[str, str]], model: str, max_tokens: int, temperature: float,
+                     prefix: str = "") -> str:
+        lines = []
+        for custom_id, content in requests:
+            lines.append(json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": self.request_args(content, model, max_tokens, temperature, prefix)
+            }))
+        batch_file = self.client.files.create(
+            file=("batch_requests.jsonl", ("\n".join(lines) + "\n").encode('utf-8')),
+            purpose="batch"
+        )
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        return batch.id
+
+    def get_batch_status(self, batch_id: str) -> str:
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status == "completed":
+            return BATCH_ENDED
+        if batch.status in ("failed", "expired", "cancelled"):
+            # Expired and cancelled batches can still carry partial results
+            return BATCH_ENDED if batch.output_file_id else BATCH_FAILED
+        return BATCH_IN_PROGRESS
+
+    def get_batch_results(self, batch_id: str) -> Dict[str, Optional[str]]:
+        batch = self.client.batches.retrieve(batch_id)
+        results = {}
+        if not batch.output_file_id:
+            return results
+        for line in self.client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            response = entry.get("response") or {}
+            text = None
+            if response.get("status_code") == 200:
+                text = response["body"]["choices"][0]["message"]["content"]
+            results[entry["custom_id"]] = text
+        return results
+
+    def get_available_models(self, on_update: Optional[Callable[[List[str]], None]] = None) -> List[str]:
+        models = [
+            "gpt-4-0125-preview",
+            "gpt-4-turbo-preview",
+            "gpt-4-1106-preview",
+            "gpt-4-vision-preview",
+            "gpt-4",
+            "gpt-4-0314",
+            "gpt-4-0613",
+            "gpt-4-32k",
+            "gpt-4-32k-0314",
+            "gpt-4-32k-0613",
+            "gpt-3.5-turbo",
+            "gpt-3.5-turbo-16k",
+            "gpt-3.5-turbo-0301",
+            "gpt-3.5-turbo-0613",
+            "gpt-3.5-turbo-1106",
+            "gpt-3.5-turbo-16k-0613"
+        ]
+        return get_model_cache().get_or_refresh('OpenAI', self.list_models, models, on_update)
+
+    def list_models(self) -> List[str]:
+        return sorted(model.id for model in self.client.models.list() if model.id.startswith("gpt-"))
 
     def get_max_tokens(self, model: str) -> int:
+        # Output limits only; the older models share a single budget with the prompt (see get_context_window)
         max_tokens = {
+            "gpt-4-0125-preview": 4096,
+            "gpt-4-turbo-preview": 4096,
+            "gpt-4-1106-preview": 4096,
+            "gpt-4-vision-preview": 4096,
+            "gpt-4": 8192,
+            "gpt-4-0314": 8192,
+            "gpt-4-0613": 8192,
+            "gpt-4-32k": 32768,
+            "gpt-4-32k-0314": 32768,
+            "gpt-4-32k-0613": 32768,
+            "gpt-3.5-turbo": 4096,
+            "gpt-3.5-turbo-16k": 16384,
+            "gpt-3.5-turbo-0301": 4096,
+            "gpt-3.5-turbo-0613": 4096,
+            "gpt-3.5-turbo-1106": 4096,
+            "gpt-3.5-turbo-16k-0613": 16384,
+            "gpt-4o": 16384,
+            "gpt-4o-mini": 16384,
+            "gpt-4-turbo": 4096
+        }
+        return max_tokens.get(model, 4096)  # Default to 4096 if model not found
+
+    def get_context_window(self, model: str) -> int:
+        context_windows = {
             "gpt-4-0125-preview": 128000,
             "gpt-4-turbo-preview": 128000,
             "gpt-4-1106-preview": 128000,
@@ -121,23 +872,169 @@ class OpenAIService(APIService):
             "gpt-4-32k": 32768,
             "gpt-4-32k-0314": 32768,
             "gpt-4-32k-0613": 32768,
-            "gpt-3.5-turbo": 4096,
-            "gpt-3.5-turbo-16k": 16384,
+            "gpt-3.5-turbo": 16385,
+            "gpt-3.5-turbo-16k": 16385,
             "gpt-3.5-turbo-0301": 4096,
             "gpt-3.5-turbo-0613": 4096,
-            "gpt-3.5-turbo-1106": 16384,
-            "gpt-3.5-turbo-16k-0613": 16384
+            "gpt-3.5-turbo-1106": 16385,
+            "gpt-3.5-turbo-16k-0613": 16385,
+            "gpt-4o": 128000,
+            "gpt-4o-mini": 128000,
+            "gpt-4-turbo": 128000
         }
-        # Set all OpenAI models to their maximum values
-        return max_tokens.get(model, 128000)  # Default to 128000 if model not found
+        return context_windows.get(model, 128000)
+
+    def get_pricing(self, model: str) -> Optional[ModelPricing]:
+        prices = {
+            "gpt-4o": (2.5, 10.0),
+            "gpt-4o-mini": (0.15, 0.6),
+            "gpt-4-turbo": (10.0, 30.0),
+            "gpt-4-0125-preview": (10.0, 30.0),
+            "gpt-4-1106-preview": (10.0, 30.0),
+            "gpt-4-vision-preview": (10.0, 30.0),
+            "gpt-4": (30.0, 60.0),
+            "gpt-4-32k": (60.0, 120.0),
+            "gpt-3.5-turbo": (0.5, 1.5)
+        }
+        # Cached prompt tokens are billed at half price and writing the cache costs nothing extra
+        return lookup_pricing(prices, model, 0.5, 1.0)
+
+    def count_tokens(self, text: str, model: str) -> int:
+        # tiktoken is optional; without it fall back to the character estimate
+        try:
+            import tiktoken
+            encoding = tiktoken.encoding_for_model(model)
+        except (ImportError, KeyError):
+            return estimate_tokens(text)
+        return len(encoding.encode(text, disallowed_special=()))
+
+# Limits assumed for OpenAI-compatible endpoints that don't configure their own
+DEFAULT_ENDPOINT_MAX_TOKENS = 4096
+DEFAULT_ENDPOINT_CONTEXT_WINDOW = 8192
+
+def lookup_limit(limits: Union[int, Dict[str, int], None], model: str, default: int) -> int:
+    # One value for every model, or values by model name; names match their dated and tagged variants
+    if isinstance(limits, dict):
+        matches = [name for name in limits if model.startswith(name)]
+        return int(limits[max(matches, key=len)]) if matches else default
+    return int(limits) if limits else default
+
+@dataclass
+class Endpoint:
+    # A server speaking OpenAI's chat completions API, e.g. vLLM, llama.cpp, Ollama, LM Studio, a hosted
+    # provider or fake_llm_server. Models and limits are configured, since such servers don't use OpenAI's.
+    base_url: str
+    name: str = ""
+    api_key: str = ""
+    # Empty for the models the server lists
+    models: List[str] = field(default_factory=list)
+    max_tokens: Union[int, Dict[str, int], None] = None
+    context_window: Union[int, Dict[str, int], None] = None
+    # US dollars per million tokens, 0 for a local server; None when the cost is unknown
+    input_price: Optional[float] = None
+    output_price: Optional[float] = None
+
+    def __post_init__(self):
+        self.base_url = self.base_url.rstrip('/')
+        self.name = self.name or f"OpenAI-compatible @ {self.base_url}"
+
+def parse_endpoints(entries) -> List[Endpoint]:
+    # The "endpoints" list in api_config.json, e.g.
+    # [{"name": "Local vLLM", "base_url": "http://localhost:8000/v1", "models": ["llama-3.1-8b"],
+    #   "max_tokens": 4096, "context_window": 32768, "input_price": 0, "output_price": 0}]
+    endpoints = []
+    for entry in entries or []:
+        if not entry.get('base_url'):
+            continue
+        endpoints.append(Endpoint(entry['base_url'], entry.get('name') or "", entry.get('api_key') or "",
+                                  list(entry.get('models') or []), entry.get('max_tokens') or None,
+                                  entry.get('context_window') or None, entry.get('input_price'),
+                                  entry.get('output_price')))
+    return endpoints
+
+class OpenAICompatibleService(OpenAIService):
+    def __init__(self, endpoint: Endpoint, api_key: str = "", base_url: Optional[str] = None,
+                 pool_size: Optional[int] = None, timeout: Optional[float] = None):
+        # Local servers mostly ignore the key, but the SDK needs one
+        super().__init__(api_key or endpoint.api_key or "none", base_url or endpoint.base_url, pool_size, timeout)
+        self.endpoint = endpoint
+        self.provider = endpoint.name
+
+    def get_available_models(self, on_update: Optional[Callable[[List[str]], None]] = None) -> List[str]:
+        if self.endpoint.models:
+            return list(self.endpoint.models)
+        return get_model_cache().get_or_refresh(self.endpoint.name, self.list_models, [], on_update)
+
+    def list_models(self) -> List[str]:
+        return sorted(model.id for model in self.client.models.list())
+
+    def get_max_tokens(self, model: str) -> int:
+        return lookup_limit(self.endpoint.max_tokens, model, DEFAULT_ENDPOINT_MAX_TOKENS)
+
+    def get_context_window(self, model: str) -> int:
+        return lookup_limit(self.endpoint.context_window, model, DEFAULT_ENDPOINT_CONTEXT_WINDOW)
+
+    def get_pricing(self, model: str) -> Optional[ModelPricing]:
+        if self.endpoint.input_price is None or self.endpoint.output_price is None:
+            return None
+        input_price = float(self.endpoint.input_price)
+        return ModelPricing(input_price, float(self.endpoint.output_price), input_price, input_price)
+
+    def count_tokens(self, text: str, model: str) -> int:
+        # The server's tokenizer is unknown, so tiktoken's counts would be no better than the estimate
+        return estimate_tokens(text)
+
+    # Few compatible servers implement OpenAI's files and batches endpoints
+    submit_batch = APIService.submit_batch
+    get_batch_status = APIService.get_batch_status
+    get_batch_results = APIService.get_batch_results
+
+# Service name -> factory taking (api_key, base_url, pool_size, timeout)
+ServiceFactory = Callable[[str, Optional[str], Optional[int], Optional[float]], APIService]
+
+_providers: Dict[str, ServiceFactory] = {}
+_endpoints: Dict[str, Endpoint] = {}
+_services = {}
+_services_lock = threading.Lock()
+
+def register_service(service_name: str, factory: ServiceFactory):
+    # Registering a name again replaces its factory and drops the services it built
+    with _services_lock:
+        _providers[service_name] = factory
+        for key in [key for key in _services if key[0] == service_name]:
+            del _services[key]
+
+def register_endpoint(endpoint: Endpoint) -> str:
+    with _services_lock:
+        if _endpoints.get(endpoint.name) == endpoint:
+            return endpoint.name
+        _endpoints[endpoint.name] = endpoint
+    register_service(endpoint.name, lambda api_key, base_url, pool_size, timeout:
+                     OpenAICompatibleService(endpoint, api_key, base_url, pool_size, timeout))
+    return endpoint.name
+
+def register_endpoints(entries) -> List[str]:
+    # Makes the endpoints configured in api_config.json available as services; returns their names
+    return [register_endpoint(endpoint) for endpoint in parse_endpoints(entries)]
+
+register_service("Anthropic", AnthropicService)
+register_service("OpenAI", OpenAIService)
 
-def get_service(service_name: str, api_key: str) -> APIService:
-    if service_name == "Anthropic":
-        return AnthropicService(api_key)
-    elif service_name == "OpenAI":
-        return OpenAIService(api_key)
-    else:
-        raise ValueError(f"Unknown service: {service_name}")
+def get_service(service_name: str, api_key: str, base_url: Optional[str] = None, pool_size: Optional[int] = None,
+                timeout: Optional[float] = None) -> APIService:
+    # Services are shared process-wide, so every caller with the same key and endpoint reuses one client
+    # (and its keep-alive connections) and one scheduler (and its view of the rate limits)
+    key = (service_name, api_key, base_url, pool_size or None, timeout or None)
+    with _services_lock:
+        service = _services.get(key)
+        if service is None:
+            factory = _providers.get(service_name)
+            if factory is None:
+                raise ValueError(f"Unknown service: {service_name}")
+            service = factory(api_key, base_url, pool_size, timeout)
+            _services[key] = service
+        return service
 
 def get_available_services() -> List[str]:
-    return ["Anthropic", "OpenAI"]
\ No newline at end of file
+    with _services_lock:
+        return list(_providers)
@@ -0,0 +1,217 @@
+import json
+import os
+import tempfile
+import time
+from typing import Callable, Iterable, List, Optional
+from api_services import BATCH_ENDED, BATCH_FAILED
+from journal import RunJournal, hash_file
+from metrics import FileMetrics, RunReport
+from response_cache import make_cache_key
+from pipeline import FrontMatterPipeline
+
+BATCH_CHECKPOINT_FILE = '.aifmm_batch.json'
+NODE_BATCH_CHECKPOINT_FILE = '.aifmm_batch.{node}.json'
+# Both providers cap a batch well above this; smaller batches start returning results sooner
+BATCH_MAX_REQUESTS = 10000
+DEFAULT_POLL_INTERVAL = 60
+
+class BatchRunner:
+    # Runs a FrontMatterPipeline through the provider's asynchronous batch endpoint. Submitted batch ids
+    # are checkpointed in the output directory, so an interrupted run picks up polling where it left off.
+    def __init__(self, pipeline: FrontMatterPipeline, poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 max_requests: int = BATCH_MAX_REQUESTS, sleep: Callable[[float], None] = time.sleep):
+        self.pipeline = pipeline
+        self.poll_interval = poll_interval
+        self.max_requests = max(1, max_requests)
+        self.sleep = sleep
+        self.log = pipeline.log
+
+    def run(self, prompt_file: str, text_files: Iterable[str], output_dir: str) -> bool:
+        # A batch is submitted as a whole, so discovery has to finish first
+        text_files = list(text_files)
+        error = self.pipeline.validate_input(prompt_file, text_files, output_dir)
+        if error:
+            self.log(f"Error: {error}")
+            return False
+        pipeline = self.pipeline
+        pipeline.apply_output_limit()
+        if pipeline.spend_cap is not None:
+            # Batch prices are discounted, so this estimate is on the safe side
+            plan = pipeline.plan(prompt_file, text_files)
+            self.log(plan.describe())
+            if plan.over_spend_cap():
+                self.log(f"Error: The expected cost is above the spend cap of ${pipeline.spend_cap:.2f}.")
+                return False
+
+        node_id = self.pipeline.node_id
+        self.journal = RunJournal(output_dir, node_id)
+        self.checkpoint_path = os.path.join(output_dir, NODE_BATCH_CHECKPOINT_FILE.format(node=node_id) if node_id
+                                            else BATCH_CHECKPOINT_FILE)
+        self.checkpoint = self.load_checkpoint()
+        checkpointed = (self.checkpoint.get('service'), self.checkpoint.get('model'))
+        if self.checkpoint['batches'] and checkpointed != (pipeline.service_name, pipeline.model):
+            # Collecting them would write another model's answers
+            self.log(f"Error: {self.checkpoint_path} holds batches submitted to {checkpointed[0]} with "
+                     f"{checkpointed[1]}; resume with that service and model, or delete the checkpoint.")
+            return False
+        if self.checkpoint['batches']:
+            self.log(f"Resuming {len(self.checkpoint['batches'])} submitted batch(es) from {self.checkpoint_path}")
+        self.total = len(text_files)
+        self.completed = 0
+        self.failed = []
+        self.report = RunReport(self.pipeline.service_name, self.pipeline.model, mode='batch')
+        self.pipeline.progress(0, self.total)
+        pipeline.open_index(output_dir)
+
+        try:
+            self.submit(prompt_file, text_files, output_dir)
+            self.collect(output_dir)
+        except Exception as e:
+            self.log(f"Error: {str(e)}. Re-run in batch mode to resume from the checkpoint.")
+            return False
+        finally:
+            self.pipeline.close_index()
+            self.pipeline.finish_report(self.report, output_dir)
+
+        try:
+            os.remove(self.checkpoint_path)
+        except FileNotFoundError:
+            # Nothing was submitted, e.g. every file was cached or already done
+            pass
+        if self.failed:
+            self.log(f"Batch processing finished with {len(self.failed)} failed file(s): " + ", ".join(self.failed))
+            return False
+        self.log("Batch processing complete!")
+        return True
+
+    def load_checkpoint(self) -> dict:
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return {'service': self.pipeline.service_name, 'model': self.pipeline.model, 'batches': []}
+
+    def save_checkpoint(self):
+        directory = os.path.dirname(self.checkpoint_path)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(self.checkpoint, f)
+        os.replace(temp_path, self.checkpoint_path)
+
+    def submit(self, prompt_file: str, text_files: List[str], output_dir: str):
+        pipeline = self.pipeline
+        submitted = {entry['file'] for batch in self.checkpoint['batches'] for entry in batch['requests'].values()}
+        for batch in self.checkpoint['batches']:
+            if batch['collected']:
+                self.completed += len(batch['requests'])
+        next_id = sum(len(batch['requests']) for batch in self.checkpoint['batches'])
+        template = pipeline.read_prompt_template(prompt_file)
+        prompt_hash = template.hash
+        requests = []
+        entries = {}
+        self.prefix = template.prefix
+
+        for text_file in text_files:
+            if text_file in submitted:
+                continue
+            input_hash = hash_file(text_file)
+            if (pipeline.incremental and self.journal.is_unchanged(text_file, input_hash, prompt_hash)) or \
+                    (pipeline.resume and self.journal.is_done(text_file)):
+                pipeline.index_skipped(self.journal, text_file, input_hash)
+                self.mark_completed(FileMetrics(text_file, status='skipped'))
+                continue
+
+            body = template.build_body(pipeline.read_text(text_file))
+            cache_key = make_cache_key((self.prefix, body), pipeline.service_name, pipeline.model,
+                                       pipeline.temperature, pipeline.max_tokens)
+            cached = pipeline.cache.get(cache_key) if pipeline.cache else None
+            if cached is not None:
+                pipeline.log(f"Using cached response for {text_file}")
+                self.finish_file(text_file, cached, input_hash, prompt_hash, output_dir, from_cache=True)
+                continue
+
+            custom_id = f"doc-{next_id}"
+            next_id += 1
+            requests.append((custom_id, body))
+            entries[custom_id] = {'file': text_file, 'input_hash': input_hash, 'prompt_hash': prompt_hash,
+                                  'cache_key': cache_key}
+            if len(requests) >= self.max_requests:
+                self.submit_requests(requests, entries)
+                requests, entries = [], {}
+
+        if requests:
+            self.submit_requests(requests, entries)
+
+    def submit_requests(self, requests, entries):
+        pipeline = self.pipeline
+        batch_id = pipeline.service.submit_batch(requests, pipeline.model, pipeline.max_tokens, pipeline.temperature,
+                                                 self.prefix)
+        self.checkpoint['batches'].append({'id': batch_id, 'requests': entries, 'collected': False})
+        self.save_checkpoint()
+        for entry in entries.values():
+            self.journal.record(entry['file'], 'submitted', entry['input_hash'], entry['prompt_hash'])
+        self.log(f"Submitted batch {batch_id} with {len(requests)} request(s)")
+
+    def collect(self, output_dir: str):
+        service = self.pipeline.service
+        while True:
+            for batch in self.checkpoint['batches']:
+                if batch['collected']:
+                    continue
+                try:
+                    status = service.get_batch_status(batch['id'])
+                except Exception as e:
+                    self.log(f"Could not poll batch {batch['id']}: {str(e)}")
+                    continue
+                if status == BATCH_ENDED:
+                    results = service.get_batch_results(batch['id'])
+                    for custom_id, entry in batch['requests'].items():
+                        self.finish_file(entry['file'], results.get(custom_id), entry['input_hash'],
+                                         entry['prompt_hash'], output_dir, entry['cache_key'])
+                elif status == BATCH_FAILED:
+                    self.log(f"Batch {batch['id']} failed")
+                    for entry in batch['requests'].values():
+                        self.finish_file(entry['file'], None, entry['input_hash'], entry['prompt_hash'], output_dir)
+                else:
+                    continue
+                batch['collected'] = True
+                self.save_checkpoint()
+
+            remaining = sum(not batch['collected'] for batch in self.checkpoint['batches'])
+            if not remaining:
+                return
+            self.log(f"Waiting for {remaining} batch(es) to finish...")
+            self.sleep(self.poll_interval)
+
+    def finish_file(self, text_file: str, api_response: Optional[str], input_hash: str, prompt_hash: str,
+                    output_dir: str, cache_key: Optional[str] = None, from_cache: bool = False):
+        pipeline = self.pipeline
+        # Batch results carry no usage, so only cache hits have a known (zero) cost
+        file_metrics = FileMetrics(text_file, cached_response=from_cache, requests=0 if from_cache else 1,
+                                   cost=0.0 if from_cache else None)
+        output_file = None
+        error = "No result returned for this request"
+        if api_response:
+            if pipeline.cache and cache_key:
+                pipeline.cache.put(cache_key, api_response)
+            try:
+                output_file = pipeline.write_output(api_response, text_file, output_dir)
+            except OSError as e:
+                error = str(e)
+        if output_file:
+            self.journal.record(text_file, 'done', input_hash, prompt_hash, output_file)
+            pipeline.index_output(text_file, input_hash, prompt_hash, output_file)
+            file_metrics.status = 'done'
+            file_metrics.bytes_in = os.path.getsize(text_file)
+            file_metrics.bytes_out = os.path.getsize(output_file)
+        else:
+            self.log(f"Error processing {text_file}: {error}")
+            self.journal.record(text_file, 'failed', input_hash, prompt_hash, error=error)
+            self.failed.append(text_file)
+            file_metrics.status = 'failed'
+            file_metrics.error = error
+        self.mark_completed(file_metrics)
+
+    def mark_completed(self, file_metrics: FileMetrics):
+        self.pipeline.emit_metrics(self.report, file_metrics)
+        self.completed += 1
+        self.pipeline.progress(self.completed, self.total)
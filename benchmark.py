@@ -0,0 +1,210 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+from typing import List, Optional
+
+# Offline throughput benchmark: `python -m benchmark --files 1000 --latency lognormal:0.8,0.5`.
+# Runs the headless pipeline against fake_llm_server.py in a subprocess, so no API credits are used and
+# the server's work does not count towards the pipeline's CPU time or peak RSS. Results are appended to
+# a JSON lines file together with the commit, so runs with the same options compare across commits.
+
+BENCH_CORPUS_DIR = 'bench_corpus'
+BENCH_RESULTS_FILE = 'benchmark_results.jsonl'
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# "OpenAI-compatible" drives the server through a configured endpoint, as for a local inference server
+DEFAULT_MODELS = {"Anthropic": "claude-3-haiku-20240307", "OpenAI": "gpt-4o-mini", "OpenAI-compatible": "local-model"}
+
+CORPUS_WORDS = ("archive author century chapter church city climate colony commerce council culture "
+                "democracy economy empire engine essay evidence family farmer freedom frontier garden "
+                "government harbor history industry journey justice labor language letter library market "
+                "memory method mountain nation nature ocean painting parliament philosophy poetry policy "
+                "railway reform religion republic revolution river science settlement society soldier "
+                "spirit state story theory tradition treaty village voyage war water wisdom writer").split()
+
+def generate_corpus(directory: str, files: int, min_bytes: int, max_bytes: int, seed: int) -> List[str]:
+    # Sizes are log-uniform between min_bytes and max_bytes, so a corpus mixes notes, articles and books.
+    # A finished corpus is reused when the same options are asked for again.
+    manifest_path = os.path.join(directory, '.corpus.json')
+    params = {'files': files, 'min_bytes': min_bytes, 'max_bytes': max_bytes, 'seed': seed}
+    names = [f"doc-{index:06d}.txt" for index in range(files)]
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            if json.load(f) == params:
+                return [os.path.join(directory, name) for name in names]
+        shutil.rmtree(directory)
+    os.makedirs(directory, exist_ok=True)
+
+    rng = random.Random(seed)
+    paragraphs = []
+    for _ in range(256):
+        sentences = []
+        for _ in range(rng.randint(3, 8)):
+            words = rng.choices(CORPUS_WORDS, k=rng.randint(8, 24))
+            sentences.append(" ".join(words).capitalize() + ".")
+        paragraphs.append(" ".join(sentences) + "\n\n")
+    paragraph_bytes = "".join(paragraphs).encode('utf-8')
+    low, high = math.log(max(1, min_bytes)), math.log(max(min_bytes, max_bytes, 1))
+    for name in names:
+        size = int(math.exp(rng.uniform(low, high)))
+        start = rng.randrange(len(paragraph_bytes))
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(f"{rng.choice(CORPUS_WORDS).title()} {rng.choice(CORPUS_WORDS).title()}\n\n".encode('utf-8'))
+            while size > 0:
+                piece = paragraph_bytes[start:start + size]
+                f.write(piece)
+                size -= len(piece)
+                start = 0
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(params, f)
+    return [os.path.join(directory, name) for name in names]
+
+def peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def git_commit() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return {'commit': commit, 'dirty': dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+
+def start_server(args) -> subprocess.Popen:
+    command = [sys.executable, os.path.join(REPO_DIR, 'fake_llm_server.py'), '--port', '0',
+               '--latency', args.latency, '--error-rate', str(args.error_rate),
+               '--rate-limit-rate', str(args.rate_limit_rate), '--response-tokens', args.response_tokens,
+               '--tokens-per-second', args.tokens_per_second, '--seed', str(args.seed)]
+    return subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+
+def server_stats(base_url: str) -> dict:
+    try:
+        with urllib.request.urlopen(f"{base_url}/stats", timeout=5) as response:
+            return json.load(response)
+    except OSError:
+        return {}
+
+def warm_up(service, model: str):
+    # The SDK import, client, first connection and tokenizer are set up once before timing starts;
+    # otherwise the first file's latency is mostly import time and dominates p99 of short runs
+    from api_services import APIServiceError
+    service.count_tokens("warm-up", model)
+    try:
+        service.call_api("warm-up", model, 16, 0.0)
+    except APIServiceError as e:
+        print(f"Warm-up request failed: {str(e)}", file=sys.stderr)
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="benchmark", description="Benchmark the pipeline against a local fake LLM server.")
+    parser.add_argument("--files", type=int, default=1000, help="Synthetic documents in the corpus (default: %(default)s)")
+    parser.add_argument("--min-bytes", type=int, default=2000, help="Smallest document size (default: %(default)s)")
+    parser.add_argument("--max-bytes", type=int, default=200000, help="Largest document size (default: %(default)s)")
+    parser.add_argument("--corpus-dir", help=f"Where to keep the generated corpus (default: {BENCH_CORPUS_DIR}/<options>)")
+    parser.add_argument("--prompt", default=os.path.join(REPO_DIR, 'prompt.txt'))
+    parser.add_argument("--service", default="Anthropic", choices=sorted(DEFAULT_MODELS))
+    parser.add_argument("--model", help="Model name sent to the server (default: a priced model of the service)")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--no-stream", action="store_true")
+    parser.add_argument("--latency", default="lognormal:0.5,0.5", help="Server latency distribution (default: %(default)s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests failing with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests failing with a 429")
+    parser.add_argument("--response-tokens", default="uniform:300,800", help="Response size distribution (default: %(default)s)")
+    parser.add_argument("--tokens-per-second", default="0", help="Streaming speed distribution, 0 for no delay")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--results", default=BENCH_RESULTS_FILE, help="JSON lines file the result is appended to")
+    parser.add_argument("--label", default="", help="Free-form label stored with the result")
+    parser.add_argument("--verbose", action="store_true", help="Print the pipeline log")
+    return parser
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    corpus_dir = args.corpus_dir or os.path.join(
+        BENCH_CORPUS_DIR, f"{args.files}-{args.min_bytes}-{args.max_bytes}-{args.seed}")
+    started = time.perf_counter()
+    text_files = generate_corpus(corpus_dir, args.files, args.min_bytes, args.max_bytes, args.seed)
+    print(f"Corpus: {len(text_files)} files in {corpus_dir} ({time.perf_counter() - started:.1f}s)", file=sys.stderr)
+
+    from api_services import get_service, register_endpoint, Endpoint
+    from pipeline import FrontMatterPipeline
+
+    server = start_server(args)
+    output_dir = tempfile.mkdtemp(prefix='aifmm-bench-')
+    try:
+        base_url = server.stdout.readline().split(': ', 1)[1].strip()
+        service_url = base_url if args.service == "Anthropic" else f"{base_url}/v1"
+        service_name = args.service
+        if service_name == "OpenAI-compatible":
+            service_name = register_endpoint(Endpoint(service_url, max_tokens=4096, context_window=128000,
+                                                      input_price=0, output_price=0))
+            service_url = None
+        service = get_service(service_name, 'benchmark-key', service_url)
+        model = args.model or DEFAULT_MODELS[args.service]
+        warm_up(service, model)
+        errors = []
+        pipeline = FrontMatterPipeline(
+            service=service,
+            service_name=service_name,
+            model=model,
+            max_tokens=4096,
+            temperature=0.0,
+            concurrency=args.concurrency,
+            stream=not args.no_stream,
+            log=print if args.verbose else (lambda message: errors.append(message) if message.startswith('Error') else None)
+        )
+        pipeline.run(args.prompt, text_files, output_dir)
+        with open(os.path.join(output_dir, '.aifmm_report.json'), 'r', encoding='utf-8') as f:
+            summary = json.load(f)['summary']
+        stats = server_stats(base_url)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    result = dict(git_commit(), **{
+        'time': datetime.now().isoformat(),
+        'label': args.label,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {name: value for name, value in vars(args).items() if name not in ('results', 'label', 'verbose')},
+        'files': summary['files'],
+        'statuses': summary['statuses'],
+        'elapsed_seconds': summary['elapsed_seconds'],
+        'files_per_second': summary['files_per_second'],
+        'latency_p50': summary['latency_seconds']['p50'],
+        'latency_p99': summary['latency_seconds']['p99'],
+        'api_latency_p50': summary['api_latency_seconds']['p50'],
+        'queue_wait_p99': summary['queue_wait_seconds']['p99'],
+        'requests': summary['totals']['requests'],
+        'retries': summary['totals']['retries'],
+        'peak_rss_mb': peak_rss_mb(),
+        'server': stats,
+        'errors': len(errors)
+    })
+    with open(args.results, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(result) + "\n")
+
+    rss = f"{result['peak_rss_mb']:.0f} MB" if result['peak_rss_mb'] is not None else "n/a"
+    print(f"{result['files']} files in {result['elapsed_seconds']:.1f}s: {result['files_per_second']:.1f} files/s, "
+          f"p50 {result['latency_p50']:.3f}s, p99 {result['latency_p99']:.3f}s, peak RSS {rss}, "
+          f"{result['retries']} retries, {result['errors']} errors (appended to {args.results})")
+    return 0 if not errors else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+from typing import Callable, List
+
+DEFAULT_CHUNK_OVERLAP_TOKENS = 200
+# Headroom for tokenizer differences between the local estimate and the provider
+CONTEXT_SAFETY_MARGIN = 0.9
+
+REDUCE_INSTRUCTIONS = (
+    "The document was too long to analyze in one pass, so it was split into consecutive, slightly "
+    "overlapping parts and front matter was generated for each part. Below is the front matter of every "
+    "part, in order. Treat them together as the text of one document and produce a single front matter "
+    "block for the whole document, covering all parts, with one combined table of contents.\n\n"
+)
+
+def input_token_budget(context_window: int, max_output_tokens: int, template_tokens: int) -> int:
+    return int(context_window * CONTEXT_SAFETY_MARGIN) - max_output_tokens - template_tokens
+
+def split_into_chunks(text: str, max_chunk_tokens: int, overlap_tokens: int,
+                      count_tokens: Callable[[str], int]) -> List[str]:
+    total_tokens = count_tokens(text)
+    if total_tokens <= max_chunk_tokens:
+        return [text]
+
+    # Work in characters, using the document's own characters-per-token ratio, so a book is
+    # sliced in a single pass instead of re-tokenizing every candidate boundary.
+    chars_per_token = len(text) / max(total_tokens, 1)
+    chunk_chars = max(1, int(max_chunk_tokens * chars_per_token))
+    overlap_chars = min(int(overlap_tokens * chars_per_token), chunk_chars // 2)
+
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_chars, len(text))
+        if end < len(text):
+            end = _find_boundary(text, start + chunk_chars * 3 // 4, end)
+        chunks.append(text[start:end])
+        if end >= len(text):
+            break
+        next_start = end - overlap_chars
+        # Start the overlap at a word boundary and always make progress
+        space = text.find(' ', next_start, end)
+        start = space + 1 if space != -1 else end
+    return chunks
+
+def _find_boundary(text: str, low: int, high: int) -> int:
+    # Prefer ending a chunk at a paragraph, then a line, then a sentence, then a word
+    for separator in ("\n\n", "\n", ". ", " "):
+        position = text.rfind(separator, low, high)
+        if position != -1:
+            return position + len(separator)
+    return high
+
+def build_reduce_text(partials: List[str]) -> str:
+    parts = [f"Part {index} of {len(partials)}:\n\n{partial}" for index, partial in enumerate(partials, start=1)]
+    return REDUCE_INSTRUCTIONS + "\n\n".join(parts)
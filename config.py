@@ -0,0 +1,112 @@
+import os
+import json
+from response_cache import DEFAULT_CACHE_SIZE_MB
+from dedup import DEFAULT_DEDUP_THRESHOLD
+from packing import DEFAULT_PACK_MAX_BYTES
+
+# Constants
+API_CONFIG_FILE = 'api_config.json'
+DEFAULT_SERVICE = "Anthropic"
+DEFAULT_MODEL = "claude-3-opus-20240229"
+DEFAULT_MAX_TOKENS = 4096
+DEFAULT_TEMPERATURE = 0.0
+DEFAULT_CONCURRENCY = 4
+MAX_CONCURRENCY = 64
+DEFAULT_RETRIES = 2
+
+def load_api_config(config_file: str = API_CONFIG_FILE):
+    default_config = {
+        'anthropic_api_key': '',
+        'openai_api_key': '',
+        'temperature': DEFAULT_TEMPERATURE,
+        'service': DEFAULT_SERVICE,
+        'model': DEFAULT_MODEL,
+        'concurrency': DEFAULT_CONCURRENCY,
+        'bypass_cache': False,
+        'cache_size_mb': DEFAULT_CACHE_SIZE_MB,
+        'requests_per_minute': 0,
+        'tokens_per_minute': 0,
+        'stream': True,
+        # 0 keeps the provider SDK's connection pool size and request timeout
+        'pool_size': 0,
+        'request_timeout': 0,
+        # Reuse the front matter of an earlier document for (near-)duplicates of it
+        'dedup': False,
+        'dedup_threshold': DEFAULT_DEDUP_THRESHOLD,
+        # US dollars per run, 0 for no cap
+        'spend_cap': 0,
+        # Small documents sent together in one request, up to this many; 0 for off
+        'pack_size': 0,
+        'pack_max_bytes': DEFAULT_PACK_MAX_BYTES,
+        # OpenAI-compatible servers offered as services, see api_services.parse_endpoints
+        'endpoints': [],
+        # Front matter fields indexed for search in the output directory (python -m search_index query)
+        'search_index': True
+    }
+    if not os.path.exists(config_file):
+        # If the file doesn't exist, create it with default values
+        with open(config_file, 'w') as f:
+            json.dump(default_config, f)
+        return default_config
+    else:
+        # If the file exists, load it and use saved values
+        with open(config_file, 'r') as f:
+            return json.load(f)
+
+def save_api_config(anthropic_api_key: str, openai_api_key: str, temperature: float, service: str, model: str,
+                    concurrency: int = DEFAULT_CONCURRENCY, bypass_cache: bool = False,
+                    cache_size_mb: int = DEFAULT_CACHE_SIZE_MB, requests_per_minute: int = 0,
+                    tokens_per_minute: int = 0, stream: bool = True, config_file: str = API_CONFIG_FILE,
+                    dedup: bool = False, dedup_threshold: float = DEFAULT_DEDUP_THRESHOLD, spend_cap: float = 0,
+                    pack_size: int = 0, search_index: bool = True):
+    current_config = load_api_config(config_file)
+    # Only update non-empty values
+    if anthropic_api_key:
+        current_config['anthropic_api_key'] = anthropic_api_key
+    if openai_api_key:
+        current_config['openai_api_key'] = openai_api_key
+    current_config['temperature'] = temperature
+    current_config['service'] = service
+    current_config['model'] = model
+    current_config['concurrency'] = concurrency
+    current_config['bypass_cache'] = bypass_cache
+    current_config['cache_size_mb'] = cache_size_mb
+    # 0 means no configured limit; the scheduler then learns the limits from response headers
+    current_config['requests_per_minute'] = requests_per_minute
+    current_config['tokens_per_minute'] = tokens_per_minute
+    current_config['stream'] = stream
+    current_config['dedup'] = dedup
+    current_config['dedup_threshold'] = dedup_threshold
+    current_config['spend_cap'] = spend_cap
+    current_config['pack_size'] = pack_size
+    current_config['search_index'] = search_index
+    
+    with open(config_file, 'w') as f:
+        json.dump(current_config, f)
+
+def get_base_url(config: dict, service_name: str):
+    # Optional endpoint override, e.g. a proxy or the local fake_llm_server; configured endpoints bring their own
+    if service_name == "Anthropic":
+        return config.get('anthropic_base_url') or None
+    elif service_name == "OpenAI":
+        return config.get('openai_base_url') or None
+    return None
+
+def get_connection_settings(config: dict):
+    # (pool size, request timeout in seconds), None where the SDK default applies
+    return config.get('pool_size') or None, config.get('request_timeout') or None
+
+def get_dedup_threshold(config: dict):
+    # None when duplicate detection is off
+    return config.get('dedup_threshold', DEFAULT_DEDUP_THRESHOLD) if config.get('dedup') else None
+
+def get_spend_cap(config: dict):
+    # None when spending is not capped
+    return config.get('spend_cap') or None
+
+def get_api_key(config: dict, service_name: str) -> str:
+    if service_name == "Anthropic":
+        return config.get('anthropic_api_key', '')
+    elif service_name == "OpenAI":
+        return config.get('openai_api_key', '')
+    return ""
@@ -0,0 +1,160 @@
+import hashlib
+import threading
+from array import array
+from typing import List, Optional, Tuple
+
+# Share of matching MinHash bins (the estimated Jaccard similarity of the documents' word 5-grams) from
+# which a document counts as a near-duplicate; 1.0 only matches documents that are equal after normalizing
+DEFAULT_DEDUP_THRESHOLD = 0.9
+MINHASH_BINS = 64
+SHINGLE_WORDS = 5
+_HASH_MASK = (1 << 64) - 1
+
+def normalize_text(text: str) -> str:
+    # Re-exports of a document often differ only in case, line breaks and spacing
+    return " ".join(text.lower().split())
+
+def minhash_signature(words: List[str], bins: int = MINHASH_BINS) -> array:
+    # One-permutation MinHash: each shingle is hashed once and only the minimum per bin is kept, so a
+    # signature costs one pass over the document instead of one per bin. Empty bins borrow from the next
+    # filled bin. Python's str hash is salted per process, which is fine for an index that lives for one run.
+    if len(words) <= SHINGLE_WORDS:
+        shingles = [" ".join(words)]
+    else:
+        shingles = (" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1))
+    empty = _HASH_MASK
+    minimums = [empty] * bins
+    for shingle in shingles:
+        value = hash(shingle) & _HASH_MASK
+        slot = value % bins
+        value //= bins
+        if value < minimums[slot]:
+            minimums[slot] = value
+    filled = [slot for slot in range(bins) if minimums[slot] != empty]
+    if filled and len(filled) < bins:
+        for slot in range(bins):
+            if minimums[slot] == empty:
+                source = next((slot + step) % bins for step in range(1, bins)
+                              if minimums[(slot + step) % bins] != empty)
+                minimums[slot] = minimums[source]
+    return array('Q', minimums)
+
+def lsh_bands(threshold: float, bins: int = MINHASH_BINS) -> Tuple[int, int]:
+    # (bands, rows per band) whose S-curve turns at or just below the threshold, so candidates are
+    # rarely missed; every candidate is then checked against the threshold
+    best = (bins, 1)
+    for rows in range(1, bins + 1):
+        bands = bins // rows
+        if (1 / bands) ** (1 / rows) <= threshold:
+            best = (bands, rows)
+    return best
+
+def similarity(first: array, second: array) -> float:
+    return sum(a == b for a, b in zip(first, second)) / len(first)
+
+class DuplicateIndex:
+    # Finds documents that repeat one seen earlier in the run. Only the first of each group (its canonical
+    # document) is indexed; the others wait for its response and reuse it instead of calling the API.
+    # With max_documents, the oldest finished canonical documents are dropped beyond that many.
+    def __init__(self, threshold: float = DEFAULT_DEDUP_THRESHOLD, bins: int = MINHASH_BINS,
+                 max_documents: Optional[int] = None):
+        self.threshold = threshold
+        self.bins = bins
+        self.bands, self.rows = lsh_bands(threshold, bins)
+        self.max_documents = max_documents
+        self.lock = threading.Lock()
+        self.exact = {}
+        self.buckets = {}
+        self.signatures = {}
+        self.results = {}
+        # Per canonical document: the digests in exact that point to it (its own first) and its LSH keys
+        self.digests = {}
+        self.keys = {}
+
+    def add(self, text_file: str, text: str) -> Optional[Tuple[str, float]]:
+        # (canonical file, similarity) when text_file duplicates an indexed document, else None after
+        # indexing text_file as a canonical document
+        normalized = normalize_text(text)
+        digest = hashlib.sha256(normalized.encode('utf-8')).digest()
+        signature = None
+        keys = []
+        if self.threshold < 1.0:
+            signature = minhash_signature(normalized.split(' '), self.bins)
+            keys = [(band, hash(signature[band * self.rows:(band + 1) * self.rows].tobytes()))
+                    for band in range(self.bands)]
+        with self.lock:
+            if text_file in self.results:
+                if self.digests[text_file][0] == digest:
+                    # A canonical document retried after failing
+                    self.results[text_file] = (threading.Event(), [None])
+                    return None
+                # Changed since it was indexed: later documents must not match its old text
+                self.remove(text_file)
+            canonical = self.exact.get(digest)
+            if canonical is not None:
+                return canonical, 1.0
+            best, best_similarity = None, 0.0
+            for key in keys:
+                for candidate in self.buckets.get(key, ()):
+                    candidate_similarity = similarity(signature, self.signatures[candidate])
+                    if candidate_similarity > best_similarity:
+                        best, best_similarity = candidate, candidate_similarity
+            if best is not None and best_similarity >= self.threshold:
+                # Exact copies of this near-duplicate then match its canonical document directly
+                self.exact[digest] = best
+                self.digests[best].append(digest)
+                return best, best_similarity
+            self.exact[digest] = text_file
+            self.digests[text_file] = [digest]
+            if signature is not None:
+                self.signatures[text_file] = signature
+                self.keys[text_file] = keys
+                for key in keys:
+                    self.buckets.setdefault(key, []).append(text_file)
+            self.results[text_file] = (threading.Event(), [None])
+            if self.max_documents is not None:
+                self.evict()
+        return None
+
+    def remove(self, text_file: str):
+        # Called with the lock held. Duplicates still waiting for the document call the API themselves.
+        for digest in self.digests.pop(text_file, ()):
+            if self.exact.get(digest) == text_file:
+                del self.exact[digest]
+        for key in self.keys.pop(text_file, ()):
+            bucket = self.buckets.get(key)
+            if bucket and text_file in bucket:
+                bucket.remove(text_file)
+                if not bucket:
+                    del self.buckets[key]
+        self.signatures.pop(text_file, None)
+        event, _ = self.results.pop(text_file)
+        event.set()
+
+    def evict(self):
+        # Oldest first; documents whose response is still pending are kept, with the ones after them
+        while len(self.results) > self.max_documents:
+            oldest = next(iter(self.results))
+            if not self.results[oldest][0].is_set():
+                break
+            self.remove(oldest)
+
+    def resolve(self, canonical: str, response: Optional[str]):
+        # None when the canonical document failed; its duplicates then call the API themselves
+        with self.lock:
+            entry = self.results.get(canonical)
+        if entry is None:
+            return
+        event, result = entry
+        result[0] = response
+        event.set()
+
+    def wait(self, canonical: str) -> Optional[str]:
+        # None also when the canonical document changed or was dropped in the meantime
+        with self.lock:
+            entry = self.results.get(canonical)
+        if entry is None:
+            return None
+        event, result = entry
+        event.wait()
+        return result[0]
@@ -0,0 +1,77 @@
+import fnmatch
+import glob
+import os
+from typing import Iterable, Iterator, List, Optional, Sequence
+
+DEFAULT_INCLUDE = ('*.txt',)
+
+def split_patterns(text: str) -> List[str]:
+    # "*.txt; *.md" or "*.txt, *.md" as typed in the GUI
+    return [pattern.strip() for pattern in text.replace(',', ';').split(';') if pattern.strip()]
+
+def matches(relative_path: str, patterns: Sequence[str]) -> bool:
+    # Patterns without a slash match the file or directory name, others the path below the input directory
+    name = relative_path.rsplit('/', 1)[-1]
+    return any(fnmatch.fnmatch(relative_path if '/' in pattern else name, pattern) for pattern in patterns)
+
+def walk_directory(root: str, include: Sequence[str] = DEFAULT_INCLUDE, exclude: Sequence[str] = ()) -> Iterator[str]:
+    # Yields files as directories are read, so the first files can be processed before a large tree has
+    # been fully walked. Excluded directories are not entered, and symlinked directories are not followed.
+    stack = ['']
+    while stack:
+        relative_dir = stack.pop()
+        try:
+            with os.scandir(os.path.join(root, relative_dir)) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+            if exclude and matches(relative_path, exclude):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(relative_path)
+                elif entry.is_file() and (not include or matches(relative_path, include)):
+                    yield entry.path
+            except OSError:
+                continue
+        stack.extend(reversed(subdirs))
+
+def input_roots(inputs: Iterable[str]) -> List[str]:
+    # The directories among the inputs; outputs of files found below them mirror their subdirectories
+    return [os.path.abspath(path) for path in inputs if os.path.isdir(path)]
+
+def discover_files(inputs: Iterable[str], include: Sequence[str] = DEFAULT_INCLUDE,
+                   exclude: Sequence[str] = ()) -> Iterator[str]:
+    # Inputs are files, directories (walked recursively) or glob patterns (** is supported). Explicitly
+    # named files are always used; include and exclude only filter what is found in directories.
+    # A file named twice, or also found in a directory input, is yielded once; two workers on it would
+    # race on the same output file
+    seen = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            paths = walk_directory(pattern, include, exclude)
+        else:
+            paths = (path for path in sorted(glob.glob(pattern, recursive=True)) or [pattern]
+                     if not os.path.isdir(path))
+        for path in paths:
+            absolute = os.path.abspath(path)
+            if absolute not in seen:
+                seen.add(absolute)
+                yield path
+
+def mirrored_output_path(text_file: str, output_dir: str, roots: Optional[Sequence[str]] = None,
+                         extension: str = '.md') -> str:
+    # Files found below an input directory keep their subdirectory in the output directory; other files
+    # are written to the output directory itself
+    base_name = os.path.splitext(os.path.basename(text_file))[0] + extension
+    if roots:
+        text_dir = os.path.dirname(os.path.abspath(text_file))
+        containing = [root for root in roots if text_dir == root or text_dir.startswith(root.rstrip(os.sep) + os.sep)]
+        if containing:
+            relative_dir = os.path.relpath(text_dir, max(containing, key=len))
+            if relative_dir != os.curdir:
+                return os.path.join(output_dir, relative_dir, base_name)
+    return os.path.join(output_dir, base_name)
@@ -0,0 +1,449 @@
+import argparse
+import email
+import email.policy
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional, Tuple
+from packing import PACK_DOCUMENT_PATTERN
+
+# A local stand-in for the Anthropic and OpenAI endpoints the services use, so the pipeline and the
+# batch mode can be exercised without network access or API credits. Point the services at it with
+#   AnthropicService(key, base_url=server.anthropic_base_url) / OpenAIService(key, base_url=server.openai_base_url)
+
+def parse_distribution(spec: str) -> Callable[[random.Random], float]:
+    # "0.5" or "fixed:0.5", "uniform:LOW,HIGH", "lognormal:MEDIAN,SIGMA", "exponential:MEAN"
+    kind, _, args = spec.partition(':') if ':' in spec else ('fixed', '', spec)
+    values = [float(value) for value in args.split(',') if value.strip()]
+    if kind == 'fixed' and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == 'uniform' and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == 'lognormal' and len(values) == 2:
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1]) if values[0] > 0 else 0.0
+    if kind == 'exponential' and len(values) == 1:
+        return lambda rng: rng.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+    raise ValueError(f"Invalid distribution: {spec}")
+
+FILLER_WORDS = ("the document discusses its subject in some detail and relates it to the wider context of "
+                "the field with examples drawn from history literature and practice").split()
+
+def fake_front_matter(content: str, response_tokens: int = 0) -> str:
+    text = content.rsplit('---', 1)[-1]
+    words = re.findall(r"[A-Za-z][A-Za-z'-]+", text)
+    title = " ".join(words[:8]).title() or "Untitled"
+    long_words = list(dict.fromkeys(word.lower() for word in words if len(word) > 6))
+    keywords = ", ".join(long_words[:7])
+    # Pad the abstract so the response is about response_tokens long (at ~4 characters per token)
+    filler_count = max(0, (response_tokens * 4 - 420) // 6)
+    filler = " ".join(FILLER_WORDS[index % len(FILLER_WORDS)] for index in range(filler_count))
+    return (
+        "---\n\n"
+        f"Title:  \n{title}\n\n"
+        f"Keywords:  \n{keywords}\n\n"
+        "Surprise Factor Keywords:  \nsynthetic, offline, stand-in\n\n"
+        "---\n\n"
+        f"Abstract:  \nA synthetic abstract for a document of {len(words)} words.{' ' + filler if filler else ''}\n\n"
+        "Author and Affiliation:  \nUnknown\n\n"
+        "Surprise Factor:  \nGenerated locally by the fake LLM server.\n\n"
+        "Table of Contents:  \n1. Document\n\n"
+        "---"
+    )
+
+def _stream_pieces(text: str, size: int = 16):
+    return [text[index:index + size] for index in range(0, len(text), size)] or ['']
+
+def _timestamp(seconds: float) -> str:
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).isoformat().replace('+00:00', 'Z')
+
+class _HTTPServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections at the end of a run are expected, not worth a traceback
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class FakeLLMServer:
+    # latency, response_tokens and tokens_per_second take a distribution spec (see parse_distribution). A
+    # share of the message/chat requests fails with a 429 (rate_limit_rate) or a 500 (error_rate); the
+    # seed makes the injected latencies and failures repeatable.
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, batch_delay: float = 0.0, latency: str = '0',
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0, response_tokens: str = '0',
+                 tokens_per_second: str = '0', retry_after: float = 0.1, seed: Optional[int] = None):
+        self.batch_delay = batch_delay
+        self.latency = parse_distribution(latency)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.response_tokens = parse_distribution(response_tokens)
+        self.tokens_per_second = parse_distribution(tokens_per_second)
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.stats = {'requests': 0, 'rate_limited': 0, 'errors': 0}
+        self.lock = threading.Lock()
+        self.batches = {}
+        self.files = {}
+        self.cached_prefixes = set()
+        self.httpd = _HTTPServer((host, port), _make_handler(self))
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def anthropic_base_url(self) -> str:
+        return self.url
+
+    @property
+    def openai_base_url(self) -> str:
+        return f"{self.url}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def simulate(self) -> Tuple[Optional[int], float, int, float]:
+        # Draws the fate of one request: an injected error status (or None), the latency before the
+        # response starts, the response size in tokens and the streaming rate
+        with self.lock:
+            self.stats['requests'] += 1
+            draw = self.random.random()
+            status = None
+            if draw < self.rate_limit_rate:
+                status = 429
+                self.stats['rate_limited'] += 1
+            elif draw < self.rate_limit_rate + self.error_rate:
+                status = 500
+                self.stats['errors'] += 1
+            return (status, max(0.0, self.latency(self.random)), max(0, int(self.response_tokens(self.random))),
+                    max(0.0, self.tokens_per_second(self.random)))
+
+    def complete(self, content: str, response_tokens: int = 0):
+        documents = PACK_DOCUMENT_PATTERN.findall(content)
+        if documents and '=== DOCUMENT N ===' in content:
+            # A packed request: one answer per document, in the format the pipeline splits on
+            text = "\n\n".join(f"=== DOCUMENT {number} ===\n{fake_front_matter(document, response_tokens)}"
+                                for number, document in documents)
+        else:
+            text = fake_front_matter(content, response_tokens)
+        return text, max(1, len(content) // 4), max(1, len(text) // 4)
+
+    # Anthropic payloads
+
+    def anthropic_message(self, params: dict, response_tokens: int = 0) -> dict:
+        content = params['messages'][-1]['content']
+        cache_read_tokens = cache_write_tokens = 0
+        if isinstance(content, list):
+            # Simulate prompt caching: a cache_control block is written on first sight and read afterwards
+            for block in content:
+                if block.get('cache_control'):
+                    tokens = max(1, len(block['text']) // 4)
+                    with self.lock:
+                        if block['text'] in self.cached_prefixes:
+                            cache_read_tokens += tokens
+                        else:
+                            self.cached_prefixes.add(block['text'])
+                            cache_write_tokens += tokens
+            content = "".join(block.get('text', '') for block in content)
+        text, input_tokens, output_tokens = self.complete(content, response_tokens)
+        input_tokens -= cache_read_tokens + cache_write_tokens
+        return {
+            'id': f"msg_{uuid.uuid4().hex}",
+            'type': 'message',
+            'role': 'assistant',
+            'model': params.get('model', ''),
+            'content': [{'type': 'text', 'text': text}],
+            'stop_reason': 'end_turn',
+            'stop_sequence': None,
+            'usage': {'input_tokens': max(0, input_tokens), 'output_tokens': output_tokens,
+                      'cache_read_input_tokens': cache_read_tokens,
+                      'cache_creation_input_tokens': cache_write_tokens}
+        }
+
+    def create_anthropic_batch(self, body: dict) -> dict:
+        batch_id = f"msgbatch_{uuid.uuid4().hex}"
+        results = [
+            {'custom_id': request['custom_id'],
+             'result': {'type': 'succeeded', 'message': self.anthropic_message(request['params'])}}
+            for request in body['requests']
+        ]
+        with self.lock:
+            self.batches[batch_id] = {'kind': 'anthropic', 'created': time.time(), 'results': results}
+        return self.anthropic_batch(batch_id)
+
+    def anthropic_batch(self, batch_id: str) -> dict:
+        batch = self.batches[batch_id]
+        ended = time.time() >= batch['created'] + self.batch_delay
+        count = len(batch['results'])
+        return {
+            'id': batch_id,
+            'type': 'message_batch',
+            'processing_status': 'ended' if ended else 'in_progress',
+            'request_counts': {'processing': 0 if ended else count, 'succeeded': count if ended else 0,
+                               'errored': 0, 'canceled': 0, 'expired': 0},
+            'created_at': _timestamp(batch['created']),
+            'expires_at': _timestamp(batch['created'] + 86400),
+            'ended_at': _timestamp(time.time()) if ended else None,
+            'archived_at': None,
+            'cancel_initiated_at': None,
+            'results_url': f"{self.url}/v1/messages/batches/{batch_id}/results" if ended else None
+        }
+
+    def anthropic_stream_events(self, message: dict):
+        text = message['content'][0]['text']
+        start = dict(message, content=[], stop_reason=None,
+                     usage=dict(message['usage'], output_tokens=1))
+        yield 'message_start', json.dumps({'type': 'message_start', 'message': start})
+        yield 'content_block_start', json.dumps({'type': 'content_block_start', 'index': 0,
+                                                 'content_block': {'type': 'text', 'text': ''}})
+        for piece in _stream_pieces(text):
+            yield 'content_block_delta', json.dumps({'type': 'content_block_delta', 'index': 0,
+                                                     'delta': {'type': 'text_delta', 'text': piece}})
+        yield 'content_block_stop', json.dumps({'type': 'content_block_stop', 'index': 0})
+        yield 'message_delta', json.dumps({'type': 'message_delta',
+                                           'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                                           'usage': {'output_tokens': message['usage']['output_tokens']}})
+        yield 'message_stop', json.dumps({'type': 'message_stop'})
+
+    # OpenAI payloads
+
+    def openai_stream_events(self, completion: dict):
+        base = {'id': completion['id'], 'object': 'chat.completion.chunk', 'created': completion['created'],
+                'model': completion['model']}
+        for piece in _stream_pieces(completion['choices'][0]['message']['content']):
+            yield None, json.dumps(dict(base, choices=[{'index': 0, 'finish_reason': None,
+                                                        'delta': {'role': 'assistant', 'content': piece}}]))
+        yield None, json.dumps(dict(base, choices=[{'index': 0, 'finish_reason': 'stop', 'delta': {}}]))
+        yield None, json.dumps(dict(base, choices=[], usage=completion['usage']))
+        yield None, '[DONE]'
+
+    def openai_completion(self, body: dict, response_tokens: int = 0) -> dict:
+        content = body['messages'][-1]['content']
+        text, input_tokens, output_tokens = self.complete(content, response_tokens)
+        return {
+            'id': f"chatcmpl-{uuid.uuid4().hex}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', ''),
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'logprobs': None,
+                         'message': {'role': 'assistant', 'content': text}}],
+            'usage': {'prompt_tokens': input_tokens, 'completion_tokens': output_tokens,
+                      'total_tokens': input_tokens + output_tokens}
+        }
+
+    def create_openai_file(self, data: bytes, filename: str, purpose: str) -> dict:
+        file_id = f"file-{uuid.uuid4().hex}"
+        entry = {'id': file_id, 'object': 'file', 'bytes': len(data), 'created_at': int(time.time()),
+                 'filename': filename, 'purpose': purpose, 'status': 'processed'}
+        with self.lock:
+            self.files[file_id] = (entry, data)
+        return entry
+
+    def create_openai_batch(self, body: dict) -> dict:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        lines = []
+        for line in self.files[body['input_file_id']][1].decode('utf-8').splitlines():
+            if line.strip():
+                request = json.loads(line)
+                lines.append(json.dumps({
+                    'id': f"batch_req_{uuid.uuid4().hex}",
+                    'custom_id': request['custom_id'],
+                    'response': {'status_code': 200, 'request_id': uuid.uuid4().hex,
+                                 'body': self.openai_completion(request['body'])},
+                    'error': None
+                }))
+        output = self.create_openai_file(("\n".join(lines) + "\n").encode('utf-8'), 'batch_output.jsonl',
+                                         'batch_output')
+        with self.lock:
+            self.batches[batch_id] = {'kind': 'openai', 'created': time.time(), 'body': body,
+                                      'output_file_id': output['id'], 'count': len(lines)}
+        return self.openai_batch(batch_id)
+
+    def openai_batch(self, batch_id: str) -> dict:
+        batch = self.batches[batch_id]
+        ended = time.time() >= batch['created'] + self.batch_delay
+        count = batch['count']
+        return {
+            'id': batch_id,
+            'object': 'batch',
+            'endpoint': batch['body']['endpoint'],
+            'input_file_id': batch['body']['input_file_id'],
+            'completion_window': batch['body']['completion_window'],
+            'status': 'completed' if ended else 'in_progress',
+            'output_file_id': batch['output_file_id'] if ended else None,
+            'error_file_id': None,
+            'created_at': int(batch['created']),
+            'request_counts': {'total': count, 'completed': count if ended else 0, 'failed': 0}
+        }
+
+def _make_handler(server: FakeLLMServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Stream events go out as many small writes; without TCP_NODELAY they stall on delayed ACKs
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def read_body(self) -> bytes:
+            length = int(self.headers.get('Content-Length') or 0)
+            return self.rfile.read(length) if length else b''
+
+        def send_json(self, payload, status: int = 200):
+            self.send_bytes(json.dumps(payload).encode('utf-8'), 'application/json', status)
+
+        def send_bytes(self, data: bytes, content_type: str, status: int = 200):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_events(self, events, tokens_per_second: float = 0.0):
+            # Server-sent events over chunked transfer encoding, the way both providers stream
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for event, data in events:
+                payload = (f"event: {event}\n" if event else "") + f"data: {data}\n\n"
+                chunk = payload.encode('utf-8')
+                self.wfile.write(f"{len(chunk):x}\r\n".encode('ascii') + chunk + b"\r\n")
+                self.wfile.flush()
+                if tokens_per_second:
+                    # Each piece is _stream_pieces' 16 characters, about 4 tokens
+                    time.sleep(4 / tokens_per_second)
+            self.wfile.write(b"0\r\n\r\n")
+
+        def send_injected_error(self, status: int, anthropic: bool):
+            kind = 'rate_limit_error' if status == 429 else 'api_error'
+            message = f"Injected {status} from the fake LLM server"
+            payload = ({'type': 'error', 'error': {'type': kind, 'message': message}} if anthropic
+                       else {'error': {'type': kind, 'message': message, 'code': None, 'param': None}})
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            if status == 429:
+                self.send_header('Retry-After', str(server.retry_after))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            path = self.path.split('?', 1)[0]
+            body = self.read_body()
+            if path in ('/v1/messages', '/v1/chat/completions'):
+                status, latency, response_tokens, tokens_per_second = server.simulate()
+                time.sleep(latency)
+                if status:
+                    self.send_injected_error(status, path == '/v1/messages')
+                    return
+            if path == '/v1/messages':
+                params = json.loads(body)
+                message = server.anthropic_message(params, response_tokens)
+                if params.get('stream'):
+                    self.send_events(server.anthropic_stream_events(message), tokens_per_second)
+                else:
+                    self.send_json(message)
+            elif path == '/v1/messages/batches':
+                self.send_json(server.create_anthropic_batch(json.loads(body)))
+            elif path == '/v1/chat/completions':
+                params = json.loads(body)
+                completion = server.openai_completion(params, response_tokens)
+                if params.get('stream'):
+                    self.send_events(server.openai_stream_events(completion), tokens_per_second)
+                else:
+                    self.send_json(completion)
+            elif path == '/v1/batches':
+                self.send_json(server.create_openai_batch(json.loads(body)))
+            elif path == '/v1/files':
+                header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('utf-8')
+                message = email.message_from_bytes(header + body, policy=email.policy.HTTP)
+                data, filename, purpose = b'', 'upload', ''
+                for part in message.iter_parts():
+                    if part.get_param('name', header='content-disposition') == 'file':
+                        data = part.get_payload(decode=True)
+                        filename = part.get_filename() or filename
+                    else:
+                        purpose = part.get_content().strip()
+                self.send_json(server.create_openai_file(data, filename, purpose))
+            else:
+                self.send_json({'error': {'type': 'not_found', 'message': path}}, 404)
+
+        def do_GET(self):
+            path = self.path.split('?', 1)[0]
+            parts = path.strip('/').split('/')
+            try:
+                if parts[:3] == ['v1', 'messages', 'batches'] and len(parts) == 5 and parts[4] == 'results':
+                    results = server.batches[parts[3]]['results']
+                    data = "".join(json.dumps(result) + "\n" for result in results).encode('utf-8')
+                    self.send_bytes(data, 'application/binary')
+                elif parts[:3] == ['v1', 'messages', 'batches'] and len(parts) == 4:
+                    self.send_json(server.anthropic_batch(parts[3]))
+                elif parts[:2] == ['v1', 'batches'] and len(parts) == 3:
+                    self.send_json(server.openai_batch(parts[2]))
+                elif parts[:2] == ['v1', 'files'] and len(parts) == 4 and parts[3] == 'content':
+                    self.send_bytes(server.files[parts[2]][1], 'application/octet-stream')
+                elif parts[:2] == ['v1', 'files'] and len(parts) == 3:
+                    self.send_json(server.files[parts[2]][0])
+                elif parts == ['stats']:
+                    with server.lock:
+                        self.send_json(dict(server.stats))
+                elif parts == ['v1', 'models'] and self.headers.get('anthropic-version'):
+                    self.send_json({'data': [{'type': 'model', 'id': 'claude-fake', 'display_name': 'Claude Fake',
+                                              'created_at': _timestamp(0)}],
+                                    'has_more': False, 'first_id': 'claude-fake', 'last_id': 'claude-fake'})
+                elif parts == ['v1', 'models']:
+                    self.send_json({'object': 'list', 'data': [
+                        {'id': 'gpt-fake', 'object': 'model', 'created': 0, 'owned_by': 'fake'}]})
+                else:
+                    self.send_json({'error': {'type': 'not_found', 'message': path}}, 404)
+            except KeyError:
+                self.send_json({'error': {'type': 'not_found', 'message': path}}, 404)
+
+    return Handler
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve fake Anthropic/OpenAI endpoints for offline testing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--batch-delay", type=float, default=5.0, help="Seconds before a submitted batch ends")
+    parser.add_argument("--latency", default="0",
+                        help="Seconds before each response starts: N, uniform:LOW,HIGH, lognormal:MEDIAN,SIGMA or exponential:MEAN")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests failing with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests failing with a 429")
+    parser.add_argument("--retry-after", type=float, default=0.1, help="Retry-After seconds sent with a 429")
+    parser.add_argument("--response-tokens", default="0", help="Response size in tokens (same forms as --latency)")
+    parser.add_argument("--tokens-per-second", default="0", help="Streaming speed, 0 for no delay (same forms as --latency)")
+    parser.add_argument("--seed", type=int, help="Seed for repeatable latencies and failures")
+    args = parser.parse_args(argv)
+    server = FakeLLMServer(args.host, args.port, args.batch_delay, args.latency, args.error_rate, args.rate_limit_rate,
+                           args.response_tokens, args.tokens_per_second, args.retry_after, args.seed)
+    print(f"Anthropic base URL: {server.anthropic_base_url}")
+    print(f"OpenAI base URL:    {server.openai_base_url}", flush=True)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
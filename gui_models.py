@@ -0,0 +1,162 @@
+import os
+import threading
+from collections import deque
+from typing import Iterable, List, Optional
+from PyQt6.QtCore import Qt, QAbstractTableModel, QModelIndex, QTimer
+from PyQt6.QtWidgets import QPlainTextEdit
+
+# Lines kept in the log view; older lines are dropped
+LOG_MAX_LINES = 5000
+LOG_FLUSH_INTERVAL_MS = 200
+
+def format_size(size: Optional[int]) -> str:
+    if size is None:
+        return ""
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+class FileQueueModel(QAbstractTableModel):
+    # Backs the file queue view. Only the rows on screen are ever rendered, and file sizes are looked up
+    # when a row is first shown, so adding 100k files costs one list extend rather than 100k widgets.
+    COLUMNS = ("Path", "Size", "Status", "Duration")
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.paths = []
+        self.rows = {}
+        self.sizes = {}
+        self.statuses = {}
+        self.durations = {}
+        # Files found in a queued directory during a run; shown with their status but not queued themselves
+        self.discovered = set()
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.paths)
+
+    def columnCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.COLUMNS[section]
+        return None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        path = self.paths[index.row()]
+        column = index.column()
+        if role == Qt.ItemDataRole.DisplayRole:
+            if column == 0:
+                return path
+            if column == 1:
+                return "folder" if self.size(path) is None and os.path.isdir(path) else format_size(self.size(path))
+            if column == 2:
+                return self.statuses.get(path, "queued")
+            if column == 3:
+                duration = self.durations.get(path)
+                return f"{duration:.1f}s" if duration is not None else ""
+        elif role == Qt.ItemDataRole.ToolTipRole and column == 0:
+            return path
+        elif role == Qt.ItemDataRole.TextAlignmentRole and column in (1, 3):
+            return Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter
+        return None
+
+    def size(self, path: str) -> Optional[int]:
+        if path not in self.sizes:
+            try:
+                self.sizes[path] = None if os.path.isdir(path) else os.path.getsize(path)
+            except OSError:
+                self.sizes[path] = None
+        return self.sizes[path]
+
+    def files(self) -> List[str]:
+        return [path for path in self.paths if path not in self.discovered]
+
+    def add_files(self, paths: Iterable[str], discovered: bool = False):
+        new_paths = []
+        for path in paths:
+            if path and path not in self.rows:
+                self.rows[path] = len(self.paths) + len(new_paths)
+                new_paths.append(path)
+                if discovered:
+                    self.discovered.add(path)
+        if not new_paths:
+            return
+        self.beginInsertRows(QModelIndex(), len(self.paths), len(self.paths) + len(new_paths) - 1)
+        self.paths.extend(new_paths)
+        self.endInsertRows()
+
+    def remove_rows(self, rows: Iterable[int]):
+        removed = {self.paths[row] for row in rows}
+        if not removed:
+            return
+        self.beginResetModel()
+        self.paths = [path for path in self.paths if path not in removed]
+        self.rows = {path: row for row, path in enumerate(self.paths)}
+        for path in removed:
+            self.discovered.discard(path)
+            self.sizes.pop(path, None)
+            self.statuses.pop(path, None)
+            self.durations.pop(path, None)
+        self.endResetModel()
+
+    def clear(self):
+        self.beginResetModel()
+        self.paths = []
+        self.rows = {}
+        self.sizes = {}
+        self.statuses = {}
+        self.durations = {}
+        self.discovered = set()
+        self.endResetModel()
+
+    def reset_status(self):
+        self.statuses = {}
+        self.durations = {}
+        if self.paths:
+            self.dataChanged.emit(self.index(0, 2), self.index(len(self.paths) - 1, 3))
+
+    def set_status(self, path: str, status: str, duration: Optional[float] = None):
+        row = self.rows.get(path)
+        if row is None:
+            return
+        self.statuses[path] = status
+        if duration is not None:
+            self.durations[path] = duration
+        self.dataChanged.emit(self.index(row, 2), self.index(row, 3))
+
+class LogBuffer:
+    # Collects log lines from any thread and appends them to the view in batches a few times a second.
+    # The pending lines are a ring buffer too, so a burst of messages can't grow memory without limit.
+    def __init__(self, view: QPlainTextEdit, max_lines: int = LOG_MAX_LINES,
+                 interval_ms: int = LOG_FLUSH_INTERVAL_MS):
+        self.view = view
+        self.view.setMaximumBlockCount(max_lines)
+        self.pending = deque(maxlen=max_lines)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.timer = QTimer(view)
+        self.timer.setInterval(interval_ms)
+        self.timer.timeout.connect(self.flush)
+        self.timer.start()
+
+    def append(self, message: str):
+        with self.lock:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append(message)
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            lines = list(self.pending)
+            self.pending.clear()
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            lines = [f"... {dropped} earlier log line(s) not shown"] + lines[1:]
+        self.view.appendPlainText("\n".join(lines))
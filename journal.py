@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+from typing import List, Optional
+
+JOURNAL_FILE = '.aifmm_journal.jsonl'
+# Nodes of a sharded run keep separate journals, as appends from several hosts may interleave on NFS
+NODE_JOURNAL_FILE = '.aifmm_journal.{node}.jsonl'
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class RunJournal:
+    # Append-only JSON lines, one record per status change, so a crash can at worst tear the last line.
+    def __init__(self, output_dir: str, node_id: Optional[str] = None):
+        self.path = os.path.join(output_dir, NODE_JOURNAL_FILE.format(node=node_id) if node_id else JOURNAL_FILE)
+        self._lock = threading.Lock()
+        self._latest = {}
+        # Set when a crash tore the last line; the next record starts on a new line
+        self._torn = False
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                self._torn = not line.endswith("\n")
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self._latest[entry['file']] = entry
+
+    def record(self, text_file: str, status: str, input_hash: str = '', prompt_hash: str = '',
+               output_file: Optional[str] = None, error: Optional[str] = None):
+        entry = {
+            'file': os.path.abspath(text_file),
+            'status': status,
+            'input_hash': input_hash,
+            'prompt_hash': prompt_hash,
+            # Absolute like 'file', so the journal can be read from another working directory
+            'output_file': os.path.abspath(output_file) if output_file else None,
+            'error': error,
+            'time': datetime.now().isoformat()
+        }
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                if self._torn:
+                    f.write("\n")
+                    self._torn = False
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._latest[entry['file']] = entry
+
+    def last_entry(self, text_file: str) -> Optional[dict]:
+        with self._lock:
+            return self._latest.get(os.path.abspath(text_file))
+
+    def entries(self) -> List[dict]:
+        # The latest entry of every file
+        with self._lock:
+            return list(self._latest.values())
+
+    def is_done(self, text_file: str) -> bool:
+        entry = self.last_entry(text_file)
+        return bool(entry and entry['status'] == 'done' and entry['output_file']
+                    and os.path.exists(entry['output_file']))
+
+    def is_unchanged(self, text_file: str, input_hash: str, prompt_hash: str) -> bool:
+        entry = self.last_entry(text_file)
+        return (self.is_done(text_file) and entry['input_hash'] == input_hash
+                and entry['prompt_hash'] == prompt_hash)
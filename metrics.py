@@ -0,0 +1,247 @@
+import json
+import math
+import os
+import time
+import uuid
+from dataclasses import dataclass, asdict, field, fields
+from typing import Dict, List, Optional
+from api_services import APIResponse, ModelPricing
+
+REPORT_FILE = '.aifmm_report.json'
+# Each node of a sharded run writes its own report; they are merged into REPORT_FILE
+NODE_REPORT_FILE = '.aifmm_report.{node}.json'
+
+@dataclass
+class FileMetrics:
+    text_file: str
+    status: str = 'started'
+    # Seconds between the file being queued and a worker picking it up
+    queue_wait: float = 0.0
+    # Seconds the worker spent on the file, and the part of it spent waiting on the API
+    duration: float = 0.0
+    api_time: float = 0.0
+    first_token_time: Optional[float] = None
+    requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    retries: int = 0
+    cost: Optional[float] = 0.0
+    cached_response: bool = False
+    # The earlier document in the run whose response this file reused instead of calling the API
+    duplicate_of: Optional[str] = None
+    # Documents in the packed request this file's front matter came from
+    packed_with: Optional[int] = None
+    error: Optional[str] = None
+
+    def add_response(self, response: APIResponse, api_time: float, pricing: Optional[ModelPricing],
+                     requests: int = 1):
+        # A packed request's usage is shared by its documents, but counts as a request for one of them
+        self.requests += requests
+        self.api_time += api_time
+        self.input_tokens += response.input_tokens
+        self.output_tokens += response.output_tokens
+        self.cache_read_tokens += response.cache_read_tokens
+        self.cache_write_tokens += response.cache_write_tokens
+        self.retries += response.retries
+        cost = response.cost
+        if cost is None and pricing is not None:
+            cost = pricing.cost(response)
+        if cost is None:
+            self.cost = None
+        elif self.cost is not None:
+            self.cost += cost
+
+def percentile(values: List[float], fraction: float) -> float:
+    # Nearest-rank percentile; good enough for run summaries and stable across runs
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered), max(1, math.ceil(fraction * len(ordered)))) - 1]
+
+@dataclass
+class RunReport:
+    service_name: str
+    model: str
+    mode: str = 'sync'
+    started_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    events: List[FileMetrics] = field(default_factory=list)
+    # Usage of hedged duplicate requests that lost to the other request; not part of any file
+    hedge_overhead: FileMetrics = field(default_factory=lambda: FileMetrics('', status='hedge_overhead'))
+
+    def add(self, metrics: FileMetrics):
+        self.events.append(metrics)
+
+    def add_overhead(self, metrics: FileMetrics):
+        overhead = self.hedge_overhead
+        for name in ('requests', 'input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_write_tokens'):
+            setattr(overhead, name, getattr(overhead, name) + getattr(metrics, name))
+        overhead.cost = None if None in (overhead.cost, metrics.cost) else overhead.cost + metrics.cost
+
+    def finish(self):
+        self.finished_at = time.time()
+
+    def summary(self) -> Dict:
+        # A file retried in later rounds reports once per attempt: its last attempt decides its status,
+        # but tokens and cost add up over all attempts since they were spent either way.
+        final = {}
+        for event in self.events:
+            final[event.text_file] = event
+        statuses = {}
+        for event in final.values():
+            statuses[event.status] = statuses.get(event.status, 0) + 1
+        done = [event for event in final.values() if event.status == 'done']
+        elapsed = max((self.finished_at or time.time()) - self.started_at, 1e-9)
+        overhead = self.hedge_overhead
+        costs = [event.cost for event in self.events] + [overhead.cost]
+        durations = [event.duration for event in done]
+        api_times = [event.api_time for event in done if event.requests]
+        queue_waits = [event.queue_wait for event in self.events]
+        first_tokens = [event.first_token_time for event in done if event.first_token_time is not None]
+        # A duplicate saves the requests its canonical document needed (several for a split document)
+        duplicates = [event for event in done if event.duplicate_of]
+        calls_saved = sum(max(1, final[event.duplicate_of].requests) if event.duplicate_of in final else 1
+                          for event in duplicates)
+        packed = [event for event in done if event.packed_with]
+        totals = {name: sum(getattr(event, name) for event in self.events + [overhead])
+                  for name in ('requests', 'input_tokens', 'output_tokens', 'cache_read_tokens',
+                               'cache_write_tokens', 'bytes_in', 'bytes_out', 'retries')}
+        return {
+            'service': self.service_name,
+            'model': self.model,
+            'mode': self.mode,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'elapsed_seconds': elapsed,
+            'files': len(final),
+            'statuses': statuses,
+            'cached_responses': sum(event.cached_response for event in final.values()),
+            'duplicates': len(duplicates),
+            'calls_saved': calls_saved,
+            'packed_files': len(packed),
+            'packed_requests': sum(event.requests for event in packed),
+            'hedge_overhead': {'requests': overhead.requests, 'cost': overhead.cost},
+            'files_per_second': len(done) / elapsed,
+            'output_tokens_per_second': totals['output_tokens'] / elapsed,
+            'totals': totals,
+            # None when any request used a model without a known price
+            'estimated_cost': None if None in costs else sum(costs),
+            'latency_seconds': {
+                'p50': percentile(durations, 0.5),
+                'p95': percentile(durations, 0.95),
+                'p99': percentile(durations, 0.99),
+                'max': max(durations, default=0.0)
+            },
+            'api_latency_seconds': {
+                'p50': percentile(api_times, 0.5),
+                'p99': percentile(api_times, 0.99)
+            },
+            'first_token_seconds': {
+                'p50': percentile(first_tokens, 0.5),
+                'p99': percentile(first_tokens, 0.99)
+            },
+            'queue_wait_seconds': {
+                'p50': percentile(queue_waits, 0.5),
+                'p99': percentile(queue_waits, 0.99)
+            }
+        }
+
+    def to_dict(self) -> Dict:
+        return {'summary': self.summary(), 'files': [asdict(event) for event in self.events],
+                'hedge_overhead': asdict(self.hedge_overhead)}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'RunReport':
+        summary = data['summary']
+        report = cls(summary['service'], summary['model'], summary.get('mode', 'sync'), summary['started_at'],
+                     summary.get('finished_at'))
+        # Fields added in later versions keep their defaults
+        names = {metric_field.name for metric_field in fields(FileMetrics)}
+        report.events = [FileMetrics(**{key: value for key, value in event.items() if key in names})
+                         for event in data.get('files', [])]
+        if data.get('hedge_overhead'):
+            report.hedge_overhead = FileMetrics(**{key: value for key, value in data['hedge_overhead'].items()
+                                                   if key in names})
+        return report
+
+    def write_json(self, path: str):
+        write_atomically(path, json.dumps(self.to_dict(), indent=2))
+
+    def write_prometheus(self, path: str):
+        # Text exposition format for node_exporter's textfile collector, which needs atomic replacement
+        summary = self.summary()
+        labels = f'service="{self.service_name}",model="{self.model}",mode="{self.mode}"'
+        lines = []
+
+        def metric(name: str, metric_type: str, help_text: str, samples: List):
+            lines.append(f"# HELP aifmm_{name} {help_text}")
+            lines.append(f"# TYPE aifmm_{name} {metric_type}")
+            for extra, value in samples:
+                lines.append(f"aifmm_{name}{{{labels}{extra}}} {value}")
+
+        metric('files', 'gauge', 'Files in the last run by final status.',
+               [(f',status="{status}"', count) for status, count in sorted(summary['statuses'].items())])
+        metric('tokens', 'gauge', 'Tokens used by the last run.',
+               [(f',kind="{kind}"', summary['totals'][f'{kind}_tokens'])
+                for kind in ('input', 'output', 'cache_read', 'cache_write')])
+        metric('requests', 'gauge', 'API requests made by the last run.', [('', summary['totals']['requests'])])
+        metric('retries', 'gauge', 'Retried API requests in the last run.', [('', summary['totals']['retries'])])
+        metric('calls_saved', 'gauge', 'API requests saved by reusing responses for duplicate documents.',
+               [('', summary['calls_saved'])])
+        metric('bytes', 'gauge', 'Bytes read and written by the last run.',
+               [(',direction="in"', summary['totals']['bytes_in']),
+                (',direction="out"', summary['totals']['bytes_out'])])
+        if summary['estimated_cost'] is not None:
+            metric('estimated_cost_dollars', 'gauge', 'Estimated cost of the last run in US dollars.',
+                   [('', f"{summary['estimated_cost']:.6f}")])
+        metric('file_latency_seconds', 'gauge', 'Per-file processing time quantiles in the last run.',
+               [(f',quantile="{quantile}"', summary['latency_seconds'][key])
+                for quantile, key in (('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99'))])
+        metric('files_per_second', 'gauge', 'Throughput of the last run.', [('', summary['files_per_second'])])
+        metric('run_duration_seconds', 'gauge', 'Wall time of the last run.', [('', summary['elapsed_seconds'])])
+        metric('last_run_timestamp_seconds', 'gauge', 'When the last run finished.',
+               [('', summary['finished_at'] or time.time())])
+        write_atomically(path, "\n".join(lines) + "\n")
+
+    def describe(self) -> str:
+        summary = self.summary()
+        statuses = ", ".join(f"{count} {status}" for status, count in sorted(summary['statuses'].items()))
+        cost = summary['estimated_cost']
+        cost_text = f"${cost:.4f}" if cost is not None else "unknown"
+        duplicates_text = (f", {summary['duplicates']} duplicate(s) reused ({summary['calls_saved']} call(s) saved)"
+                           if summary['duplicates'] else "")
+        if summary['packed_files']:
+            duplicates_text += (f", {summary['packed_files']} small file(s) packed into "
+                                f"{summary['packed_requests']} request(s)")
+        if summary['hedge_overhead']['requests']:
+            duplicates_text += f", {summary['hedge_overhead']['requests']} hedged request(s) lost to their duplicate"
+        return (f"{summary['files']} file(s) ({statuses}) in {summary['elapsed_seconds']:.1f}s, "
+                f"{summary['files_per_second']:.2f} files/s, p50 {summary['latency_seconds']['p50']:.2f}s, "
+                f"p99 {summary['latency_seconds']['p99']:.2f}s, {summary['totals']['input_tokens']} tokens in, "
+                f"{summary['totals']['output_tokens']} out, estimated cost {cost_text}{duplicates_text}")
+
+def merge_reports(reports: List[RunReport]) -> RunReport:
+    # One report over the nodes' runs; throughput is measured from the first start to the last finish
+    finished = [report.finished_at for report in reports if report.finished_at]
+    merged = RunReport(reports[0].service_name, reports[0].model, 'sharded',
+                       min(report.started_at for report in reports), max(finished) if finished else None)
+    for report in reports:
+        merged.events.extend(report.events)
+        merged.add_overhead(report.hedge_overhead)
+    return merged
+
+def write_atomically(path: str, content: str):
+    # Readable by other users (e.g. a metrics collector) under the usual umask, unlike mkstemp's 0600
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
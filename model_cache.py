@@ -1,37 +1,159 @@
 import json
 import os
+import sys
+import threading
+import uuid
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
 
 CACHE_FILE = 'model_cache.json'
 CACHE_EXPIRY_DAYS = 7
+CACHE_DIR_ENV = 'AIFMM_CACHE_DIR'
+
+def user_cache_dir() -> str:
+    # Per-user cache location, so the model list no longer depends on the working directory
+    if os.environ.get(CACHE_DIR_ENV):
+        return os.environ[CACHE_DIR_ENV]
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~\\AppData\\Local')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'aifmm')
+
+@contextmanager
+def _file_lock(lock_path: str):
+    # Serializes read-modify-write cycles between application instances
+    with open(lock_path, 'a+b') as lock_file:
+        if sys.platform == 'win32':
+            import msvcrt
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+class ModelCache:
+    # Model lists per service, memoized in memory over a JSON file that is only re-read when another
+    # process has replaced it. Expired lists are still served while a background thread refreshes them.
+    def __init__(self, path: Optional[str] = None, max_age: timedelta = timedelta(days=CACHE_EXPIRY_DAYS)):
+        self.path = path or os.path.join(user_cache_dir(), CACHE_FILE)
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._data = {}
+        self._mtime = None
+        self._refreshing = set()
+
+    def _file_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _read_file(self) -> Dict:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _current(self) -> Dict:
+        mtime = self._file_mtime()
+        with self._lock:
+            if mtime != self._mtime:
+                self._data = self._read_file()
+                self._mtime = mtime
+            return self._data
+
+    def get(self, service_name: str) -> Tuple[Optional[List[str]], bool]:
+        # (models or None, whether they are still fresh)
+        entry = self._current().get(service_name)
+        if not entry:
+            return None, False
+        try:
+            last_updated = datetime.fromisoformat(entry['last_updated'])
+        except (KeyError, TypeError, ValueError):
+            return entry.get('models'), False
+        return entry.get('models'), datetime.now() - last_updated < self.max_age
+
+    def put(self, service_name: str, models: List[str]):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with _file_lock(self.path + '.lock'):
+            # Merge with what other instances wrote since we last looked
+            data = self._read_file()
+            data[service_name] = {'models': models, 'last_updated': datetime.now().isoformat()}
+            temp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+            try:
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f)
+                os.replace(temp_path, self.path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            mtime = self._file_mtime()
+        with self._lock:
+            self._data = data
+            self._mtime = mtime
+
+    def get_or_refresh(self, service_name: str, fetch: Callable[[], List[str]], fallback: List[str],
+                       on_update: Optional[Callable[[List[str]], None]] = None) -> List[str]:
+        # Never waits for the network: returns the cached list (or the fallback) right away and, when it is
+        # missing or expired, fetches a new one in the background and passes it to on_update if it changed
+        models, fresh = self.get(service_name)
+        current = models or fallback
+        if not fresh:
+            self.refresh_in_background(service_name, fetch, current, on_update)
+        return current
+
+    def refresh_in_background(self, service_name: str, fetch: Callable[[], List[str]], current: List[str],
+                              on_update: Optional[Callable[[List[str]], None]] = None):
+        with self._lock:
+            if service_name in self._refreshing:
+                return
+            self._refreshing.add(service_name)
+
+        def refresh():
+            try:
+                models = fetch()
+                if models:
+                    self.put(service_name, models)
+                    if on_update and models != current:
+                        on_update(models)
+            except Exception:
+                # Keep serving the cached or built-in list; the next lookup tries again
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing.discard(service_name)
+
+        threading.Thread(target=refresh, name=f"model-refresh-{service_name}", daemon=True).start()
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_model_cache() -> ModelCache:
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ModelCache()
+        return _default_cache
 
 def load_cached_models(service_name):
-    print(f"Loading cached models for {service_name}...")
-    if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, 'r') as f:
-            cache = json.load(f)
-        
-        if service_name in cache:
-            last_updated = datetime.fromisoformat(cache[service_name]['last_updated'])
-            if datetime.now() - last_updated < timedelta(days=CACHE_EXPIRY_DAYS):
-                print(f"Cache hit for {service_name}: {cache[service_name]['models']}")
-                return cache[service_name]['models']
-    
-    print(f"No valid cache found for {service_name}.")
-    return None
+    models, fresh = get_model_cache().get(service_name)
+    return models if fresh else None
 
 def save_cached_models(service_name, models):
-    print(f"Saving models to cache for {service_name}: {models}")
-    cache = {}
-    if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, 'r') as f:
-            cache = json.load(f)
-    
-    cache[service_name] = {
-        'models': models,
-        'last_updated': datetime.now().isoformat()
-    }
-    
-    with open(CACHE_FILE, 'w') as f:
-        json.dump(cache, f)
-    print(f"Cache updated for {service_name}.")
\ No newline at end of file
+    get_model_cache().put(service_name, models)
@@ -0,0 +1,63 @@
+import re
+from dataclasses import dataclass, replace
+from typing import List, Optional, Sequence
+from api_services import APIResponse
+
+# Documents up to DEFAULT_PACK_MAX_BYTES are sent several to a request, so the prompt's instructions
+# and the per-request overhead are paid once per pack instead of once per document
+DEFAULT_PACK_SIZE = 8
+DEFAULT_PACK_MAX_BYTES = 4096
+PACK_DOCUMENT_PATTERN = re.compile(r'<document id="(\d+)">\n(.*?)\n</document>', re.DOTALL)
+PACK_MARKER_PATTERN = re.compile(r'^=== DOCUMENT (\d+) ===[ \t]*$', re.MULTILINE)
+
+def pack_documents(texts: Sequence[str]) -> str:
+    return "\n\n".join(f'<document id="{number}">\n{text}\n</document>' for number, text in enumerate(texts, 1))
+
+def pack_instructions(count: int) -> str:
+    return (f"\n\nThe text above contains {count} separate documents, each wrapped in <document id=\"N\"> tags. "
+            f"Follow the instructions for each document on its own. Answer with {count} blocks, in document "
+            f"order, each starting with a line containing only \"=== DOCUMENT N ===\" (N being the document's id) "
+            f"followed by the output for that document only.")
+
+def split_packed_response(text: str, count: int) -> Optional[List[str]]:
+    # One part per document, or None unless every document has exactly one non-empty block, in order
+    markers = list(PACK_MARKER_PATTERN.finditer(text))
+    if [int(marker.group(1)) for marker in markers] != list(range(1, count + 1)):
+        return None
+    parts = []
+    for index, marker in enumerate(markers):
+        end = markers[index + 1].start() if index + 1 < len(markers) else len(text)
+        part = text[marker.end():end].strip()
+        if not part:
+            return None
+        parts.append(part)
+    return parts
+
+def share_usage(response: APIResponse, weights: Sequence[int]) -> List[APIResponse]:
+    # Splits a packed request's token usage (and cost, if known) over its documents in proportion to the
+    # weights; the shares add up to the whole
+    total = sum(weights) or 1
+    shares = []
+    fields = ('input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_write_tokens')
+    remaining = {name: getattr(response, name) for name in fields}
+    for index, weight in enumerate(weights):
+        last = index == len(weights) - 1
+        values = {name: remaining[name] if last else getattr(response, name) * weight // total for name in fields}
+        for name in fields:
+            remaining[name] -= values[name]
+        cost = None if response.cost is None else response.cost * weight / total
+        # Retries are counted once, against the first document
+        shares.append(replace(response, text='', cost=cost, retries=response.retries if index == 0 else 0,
+                              **values))
+    return shares
+
+@dataclass
+class PackedResponse:
+    # A document's part of a packed request; text is None when the response did not split cleanly and
+    # the document has to be sent on its own
+    text: Optional[str]
+    usage: APIResponse
+    api_time: float = 0.0
+    documents: int = 1
+    # The request itself is counted for the pack's first document only
+    requests: int = 1
@@ -0,0 +1,831 @@
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Sized, Tuple
+from api_services import APIService, APIResponse, StreamSink
+from chunking import (split_into_chunks, build_reduce_text, input_token_budget,
+                      DEFAULT_CHUNK_OVERLAP_TOKENS)
+from response_cache import ResponseCache, make_cache_key
+from journal import RunJournal, hash_file
+from config import DEFAULT_CONCURRENCY, DEFAULT_RETRIES
+from metrics import FileMetrics, RunReport, REPORT_FILE, NODE_REPORT_FILE
+from discovery import mirrored_output_path
+from dedup import DuplicateIndex
+from planner import RunPlan, plan_run, order_largest_first, file_size, EXPECTED_OUTPUT_TOKENS
+from packing import (pack_documents, pack_instructions, split_packed_response, share_usage, PackedResponse,
+                     DEFAULT_PACK_MAX_BYTES)
+from sharding import LeaseManager, merge_node_reports, CLAIMED, DONE, DEFAULT_LEASE_SECONDS
+from search_index import SearchIndex, open_index
+
+COPY_BLOCK_SIZE = 1024 * 1024
+# Files submitted ahead of the workers; discovery pauses once this many per worker are waiting
+QUEUED_FILES_PER_WORKER = 4
+
+def open_partial_output(output_file: str) -> Tuple[BinaryIO, str]:
+    # Outputs are written to a hidden temp file next to the final name and renamed into place, so a
+    # partial .md is never visible. Unlike mkstemp, os.open with 0o666 keeps the usual umask-based permissions.
+    directory, name = os.path.split(output_file)
+    temp_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex}.part")
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    return os.fdopen(fd, 'wb'), temp_path
+
+def remove_partial_output(temp_path: str):
+    try:
+        os.remove(temp_path)
+    except FileNotFoundError:
+        pass
+
+class PromptTemplate:
+    # Compiled once per run. The part of the template before {{TEXT}} is identical for every document and
+    # is sent as a cacheable prefix; the document and the rest of the template follow it.
+    def __init__(self, prompt: str, prompt_hash: str = ''):
+        self.prefix, marker, rest = prompt.partition('{{TEXT}}')
+        self.rest = rest if marker else None
+        self.hash = prompt_hash
+
+    def build_body(self, text: str) -> str:
+        if self.rest is None:
+            return ''
+        return text + self.rest.replace('{{TEXT}}', text)
+
+class StreamingOutput(StreamSink):
+    # Streams the front matter into a hidden temp file next to the output as tokens arrive. finish() adds
+    # the reference and original text and renames it into place, so a partial .md is never visible.
+    def __init__(self, output_file: str, keep_text: bool = False):
+        self.output_file = output_file
+        self.keep_text = keep_text
+        self.file = None
+        self.temp_path = None
+
+    def begin(self):
+        self.discard()
+        self.file, self.temp_path = open_partial_output(self.output_file)
+        self.started_at = time.perf_counter()
+        self.first_token_at = None
+        self.has_content = False
+        self.pending_whitespace = ''
+        self.chunks = []
+
+    def write(self, text: str):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        # Same result as convert_to_markdown's strip(): drop leading whitespace, and hold back
+        # trailing whitespace until more text follows it
+        if not self.has_content:
+            text = text.lstrip()
+            if not text:
+                return
+            self.has_content = True
+        stripped = text.rstrip()
+        if not stripped:
+            self.pending_whitespace += text
+            return
+        out = self.pending_whitespace + stripped
+        self.file.write(out.encode('utf-8'))
+        if self.keep_text:
+            self.chunks.append(out)
+        self.pending_whitespace = text[len(stripped):]
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+    def finish(self, write_tail: Callable) -> bool:
+        if not self.has_content:
+            self.discard()
+            return False
+        self.file.write(b"\n\n")
+        write_tail(self.file)
+        self.file.close()
+        self.file = None
+        os.replace(self.temp_path, self.output_file)
+        self.temp_path = None
+        return True
+
+    def discard(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        if self.temp_path:
+            remove_partial_output(self.temp_path)
+            self.temp_path = None
+
+@dataclass
+class RunState:
+    # Counters shared by the rounds of a run
+    total: int = 0
+    counted: bool = True
+    started: int = 0
+    completed: int = 0
+    skipped: int = 0
+    capped: bool = False
+
+class FrontMatterPipeline:
+    def __init__(self, service: APIService, service_name: str, model: str, max_tokens: int, temperature: float,
+                 reference: str = "", concurrency: int = DEFAULT_CONCURRENCY, cache: Optional[ResponseCache] = None,
+                 resume: bool = False, incremental: bool = False, retries: int = DEFAULT_RETRIES,
+                 chunk_tokens: Optional[int] = None, chunk_overlap_tokens: int = DEFAULT_CHUNK_OVERLAP_TOKENS,
+                 stream: bool = True, report_file: Optional[str] = None, prometheus_file: Optional[str] = None,
+                 input_roots: Optional[List[str]] = None, dedup_threshold: Optional[float] = None,
+                 spend_cap: Optional[float] = None, largest_first: bool = True, pack_size: int = 0,
+                 pack_max_bytes: int = DEFAULT_PACK_MAX_BYTES, node_id: Optional[str] = None, leases: bool = False,
+                 lease_seconds: float = DEFAULT_LEASE_SECONDS, search_index: bool = False,
+                 log: Callable[[str], None] = print,
+                 progress: Optional[Callable[[int, int], None]] = None,
+                 metrics: Optional[Callable[[FileMetrics], None]] = None):
+        self.service = service
+        self.service_name = service_name
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.reference = reference
+        self.concurrency = max(1, concurrency)
+        self.cache = cache
+        self.resume = resume
+        self.incremental = incremental
+        self.retries = max(0, retries)
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap_tokens = chunk_overlap_tokens
+        self.stream = stream
+        self.log = log
+        self.progress = progress or (lambda completed, total: None)
+        self.metrics = metrics or (lambda file_metrics: None)
+        # Defaults to REPORT_FILE in the output directory
+        self.report_file = report_file
+        self.prometheus_file = prometheus_file
+        # Input directories whose subdirectory layout is mirrored in the output directory
+        self.input_roots = input_roots or []
+        # Similarity from which a document reuses the response of an earlier one in the run; None turns it off
+        self.dedup_threshold = dedup_threshold
+        self.duplicates = None
+        # US dollars; checked against the estimate before a run and against the spend while it runs
+        self.spend_cap = spend_cap
+        self.largest_first = largest_first
+        # Small documents sent together in one request, up to pack_size per request; 0 or 1 for off
+        self.pack_size = pack_size
+        self.pack_max_bytes = pack_max_bytes
+        # Set for the nodes of a sharded run: each keeps its own journal and report. With leases, the
+        # nodes share the inputs and claim files through lease files in the output directory.
+        self.node_id = node_id
+        self.use_leases = leases
+        self.lease_seconds = lease_seconds
+        self.leases = None
+        # Front matter fields of the outputs are indexed for search in the output directory
+        self.search_index = search_index
+        self.index: Optional[SearchIndex] = None
+        self.spent = 0.0
+        self.spent_files = 0
+        self.pricing = service.get_pricing(model)
+        self.usage_lock = threading.Lock()
+        self.usage_totals = APIResponse("")
+        # Usage of lost hedged requests not yet added to a run report
+        self.hedge_overhead: List[FileMetrics] = []
+        if hasattr(service, 'on_hedge_usage'):
+            service.on_hedge_usage = self.record_hedge_usage
+        # Metrics of the files being processed, filled in by record_usage from whichever thread made the request
+        self.file_metrics = {}
+        # Front matter of the outputs just written, indexed from memory instead of read back from the file
+        self.front_matter: Dict[str, str] = {}
+
+    def run(self, prompt_file: str, text_files: Iterable[str], output_dir: str) -> bool:
+        # text_files may be a generator (see discovery.discover_files): files are submitted as they are
+        # found, and the total grows until discovery is finished
+        error = self.validate_input(prompt_file, text_files, output_dir)
+        if error:
+            self.log(f"Error: {error}")
+            return False
+
+        self.apply_output_limit()
+        template = self.read_prompt_template(prompt_file)
+        counted = isinstance(text_files, Sized)
+        if self.spend_cap is not None and not counted:
+            # The estimate needs every file, so discovery finishes before the first request
+            text_files = list(text_files)
+            counted = True
+        if counted and self.largest_first:
+            text_files = order_largest_first(text_files)
+        if counted and self.spend_cap is not None:
+            plan = plan_run(self, template, text_files, self.spend_cap)
+            self.log(plan.describe())
+            if plan.over_spend_cap():
+                self.log(f"Error: The expected cost is above the spend cap of ${self.spend_cap:.2f}.")
+                return False
+
+        self.log(f"Processing started ({self.concurrency} concurrent requests)...")
+        journal = RunJournal(output_dir, self.node_id)
+        report = RunReport(self.service_name, self.model)
+        if self.use_leases:
+            self.leases = LeaseManager(output_dir, self.node_id, self.lease_seconds, self.input_roots, self.log)
+        self.open_index(output_dir)
+        self.duplicates = DuplicateIndex(self.dedup_threshold) if self.dedup_threshold is not None else None
+        self.spent = 0.0
+        self.spent_files = 0
+        if self.spend_cap is not None and self.pricing is None:
+            self.log(f"No price is known for {self.model}, so the spend cap can't be enforced")
+        state = RunState(total=len(text_files) if counted else 0, counted=counted)
+        # With a spend cap, files are only handed to the executor when a worker is free, so the cap
+        # check sees the cost of every file but the ones in progress
+        max_queued = self.concurrency * (1 if self.spend_cap is not None else QUEUED_FILES_PER_WORKER)
+        pack_size = self.effective_pack_size(template)
+        self.progress(0, state.total)
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        if self.leases:
+            self.leases.start()
+        try:
+            failed, leased = self.run_round(executor, journal, template, iter(text_files), output_dir, report, state,
+                                            max_queued, new_files=True, pack_size=pack_size)
+            # A failing file never stops the batch; failures are journaled and retried in later rounds
+            for attempt in range(1, self.retries + 1):
+                if not failed or state.capped:
+                    break
+                self.log(f"Retrying {len(failed)} failed file(s) (attempt {attempt + 1} of {self.retries + 1})...")
+                failed, more_leased = self.run_round(executor, journal, template, iter(failed), output_dir, report,
+                                                     state, max_queued, retry=True)
+                leased += more_leased
+            # Files leased by other nodes are checked again until they are done there, or their lease
+            # expires because that node stopped, and they are taken over here
+            while leased and not state.capped:
+                self.log(f"Waiting for {len(leased)} file(s) leased by other nodes...")
+                time.sleep(self.leases.poll_seconds)
+                more_failed, leased = self.run_round(executor, journal, template, iter(leased), output_dir, report,
+                                                     state, max_queued)
+                failed += more_failed
+        except Exception as e:
+            self.log(f"Error: {str(e)}")
+            return False
+        finally:
+            executor.shutdown(wait=True)
+            if self.leases:
+                self.leases.stop()
+            self.close_index()
+            self.finish_report(report, output_dir)
+
+        total = state.total
+        if not total:
+            self.log("Error: No text files found.")
+            return False
+        if state.capped:
+            not_started = f"{total - state.started} file(s)"
+            self.log(f"Spend cap of ${self.spend_cap:.2f} reached after ${self.spent:.4f}; {not_started} not started.")
+            return False
+        if failed:
+            self.progress(total, total)
+            self.log(f"Processing finished with {len(failed)} failed file(s): " + ", ".join(failed))
+            return False
+        if state.skipped:
+            self.log(f"Skipped {state.skipped} file(s) already processed by a previous run or another node.")
+        self.log_usage_totals()
+        self.log("Processing complete!")
+        return True
+
+    def run_round(self, executor: ThreadPoolExecutor, journal: RunJournal, template: PromptTemplate,
+                  pending: Iterator[str], output_dir: str, report: RunReport, state: 'RunState', max_queued: int,
+                  new_files: bool = False, pack_size: int = 0, retry: bool = False) -> Tuple[List[str], List[str]]:
+        # Processes pending with at most max_queued submissions waiting; (failed, leased elsewhere) files.
+        # Only the first round finds new files, which are counted and may be packed.
+        futures = {}
+        failed = []
+        leased = []
+        pack = []
+        while True:
+            while len(futures) < max_queued and not state.capped:
+                if self.spend_cap_reached(len(futures)):
+                    state.capped = True
+                    state.started -= len(pack)
+                    break
+                text_file = next(pending, None)
+                if text_file is None:
+                    if not pack:
+                        break
+                    text_files, pack = pack, []
+                else:
+                    if new_files:
+                        state.started += 1
+                        if not state.counted:
+                            state.total += 1
+                    # Small files wait for a full pack; retries are always sent on their own
+                    if pack_size > 1 and 0 <= file_size(text_file) <= self.pack_max_bytes:
+                        pack.append(text_file)
+                        if len(pack) < pack_size:
+                            continue
+                        text_files, pack = pack, []
+                    else:
+                        text_files = [text_file]
+                future = executor.submit(self.process_tracked_pack, journal, template, text_files, output_dir,
+                                         retry, time.perf_counter())
+                futures[future] = text_files
+            if not futures:
+                break
+            # Results arrive in completion order, so progress counts finished files rather than list position
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                futures.pop(future)
+                for file_metrics in future.result():
+                    status = file_metrics.status
+                    if status == 'leased':
+                        leased.append(file_metrics.text_file)
+                        continue
+                    self.emit_metrics(report, file_metrics)
+                    if status == 'failed':
+                        failed.append(file_metrics.text_file)
+                        continue
+                    if status == 'skipped':
+                        state.skipped += 1
+                    state.completed += 1
+                    self.progress(state.completed, state.total)
+        return failed, leased
+
+    def process_tracked_pack(self, journal: RunJournal, template: PromptTemplate, text_files: List[str],
+                             output_dir: str, retry: bool = False,
+                             queued_at: Optional[float] = None) -> List[FileMetrics]:
+        # The members' latencies start with the shared request, which is not queue wait
+        started_at = time.perf_counter()
+        packed = self.request_pack(journal, template, text_files) if len(text_files) > 1 else {}
+        return [self.process_tracked_file(journal, template, text_file, output_dir, retry, queued_at,
+                                          packed.get(text_file), started_at) for text_file in text_files]
+
+    def process_tracked_file(self, journal: RunJournal, template: PromptTemplate, text_file: str, output_dir: str,
+                             retry: bool = False, queued_at: Optional[float] = None,
+                             packed: Optional[PackedResponse] = None,
+                             started_at: Optional[float] = None) -> FileMetrics:
+        started_at = started_at or time.perf_counter()
+        file_metrics = FileMetrics(text_file, queue_wait=started_at - queued_at if queued_at else 0.0)
+        with self.usage_lock:
+            self.file_metrics[text_file] = file_metrics
+        input_hash = ''
+        prompt_hash = template.hash
+        try:
+            input_hash = hash_file(text_file)
+            if not retry and self.is_skipped(journal, text_file, input_hash, prompt_hash):
+                file_metrics.status = 'skipped'
+                self.index_skipped(journal, text_file, input_hash)
+                return file_metrics
+            if self.leases:
+                claim = self.leases.claim(text_file, input_hash)
+                if claim != CLAIMED:
+                    # Finished by another node, or in progress there
+                    file_metrics.status = 'skipped' if claim == DONE else 'leased'
+                    return file_metrics
+            journal.record(text_file, 'started', input_hash, prompt_hash)
+            file_metrics.bytes_in = os.path.getsize(text_file)
+            output_file = self.process_single_file(template, text_file, output_dir, packed)
+            if not output_file:
+                raise ValueError("No valid content found in the API response")
+            if self.leases and not self.leases.complete(text_file, input_hash, output_file):
+                raise ValueError("The lease was taken over by another node before the file was completed")
+            journal.record(text_file, 'done', input_hash, prompt_hash, output_file)
+            self.index_output(text_file, input_hash, prompt_hash, output_file)
+            file_metrics.bytes_out = os.path.getsize(output_file)
+            file_metrics.status = 'done'
+        except Exception as e:
+            self.log(f"Error processing {text_file}: {str(e)}")
+            journal.record(text_file, 'failed', input_hash, prompt_hash, error=str(e))
+            if self.leases:
+                self.leases.release(text_file)
+            file_metrics.status = 'failed'
+            file_metrics.error = str(e)
+        finally:
+            file_metrics.duration = time.perf_counter() - started_at
+            with self.usage_lock:
+                self.file_metrics.pop(text_file, None)
+                self.front_matter.pop(text_file, None)
+        return file_metrics
+
+    def open_index(self, output_dir: str):
+        self.index = None
+        if not self.search_index:
+            return
+        if self.node_id:
+            # SQLite can't be shared over NFS; the index is built from the nodes' journals afterwards
+            self.log(f"Nodes of a sharded run don't update the search index; "
+                     f"run `python -m search_index build {output_dir}` once all nodes are done")
+            return
+        try:
+            self.index = open_index(output_dir)
+        except sqlite3.Error as e:
+            self.log(f"Warning: Search index disabled: {str(e)}")
+
+    def close_index(self):
+        if self.index:
+            self.index.close()
+            self.index = None
+
+    def index_output(self, text_file: str, input_hash: str, prompt_hash: str, output_file: str):
+        # An output that can't be indexed is still a finished file
+        with self.usage_lock:
+            front_matter = self.front_matter.pop(text_file, None)
+        if self.index is None:
+            return
+        try:
+            if self.index.index_output(text_file, input_hash, prompt_hash, output_file, front_matter) is None:
+                self.log(f"Warning: No front matter fields found in {output_file}; not added to the search index")
+        except (sqlite3.Error, OSError) as e:
+            self.log(f"Warning: Could not index {output_file}: {str(e)}")
+
+    def index_skipped(self, journal: RunJournal, text_file: str, input_hash: str):
+        # Files finished before indexing was turned on (or before the index was deleted) are added once
+        if self.index is None or self.index.is_current(text_file, input_hash):
+            return
+        entry = journal.last_entry(text_file)
+        if entry and entry['status'] == 'done' and entry['output_file'] and entry['input_hash'] == input_hash:
+            self.index_output(text_file, input_hash, entry['prompt_hash'], entry['output_file'])
+
+    def is_skipped(self, journal: RunJournal, text_file: str, input_hash: str, prompt_hash: str) -> bool:
+        return bool((self.incremental and journal.is_unchanged(text_file, input_hash, prompt_hash)) or
+                    (self.resume and journal.is_done(text_file)))
+
+    def process_single_file(self, template: PromptTemplate, text_file: str, output_dir: str,
+                            packed: Optional[PackedResponse] = None) -> Optional[str]:
+        self.log(f"Processing file: {text_file}")
+        # The request is built in memory from the compiled template; the original text is copied into the
+        # output from disk in blocks rather than held a second time.
+        text = self.read_text(text_file)
+        if packed is not None:
+            self.record_usage(text_file, packed.usage, packed.api_time, requests=packed.requests)
+            if packed.text is not None:
+                self.mark_packed(text_file, packed.documents)
+                if self.duplicates is not None and self.duplicates.add(text_file, text) is None:
+                    self.duplicates.resolve(text_file, packed.text)
+                return self.write_output(packed.text, text_file, output_dir)
+        if self.duplicates is None:
+            return self.generate(template, text_file, text, output_dir)[0]
+
+        duplicate = self.duplicates.add(text_file, text)
+        if duplicate is not None:
+            canonical, similarity = duplicate
+            api_response = self.duplicates.wait(canonical)
+            if api_response is not None:
+                self.log(f"{text_file} duplicates {canonical} ({similarity:.0%} similar), reusing its front matter")
+                self.mark_duplicate(text_file, canonical)
+                return self.write_output(api_response, text_file, output_dir)
+            self.log(f"{canonical} failed, processing its duplicate {text_file} separately")
+            return self.generate(template, text_file, text, output_dir)[0]
+        output_file, api_response = None, None
+        try:
+            output_file, api_response = self.generate(template, text_file, text, output_dir)
+            return output_file
+        finally:
+            # Duplicates waiting for this document get its response, or call the API themselves if it failed
+            self.duplicates.resolve(text_file, api_response if output_file else None)
+
+    def generate(self, template: PromptTemplate, text_file: str, text: str,
+                 output_dir: str) -> Tuple[Optional[str], Optional[str]]:
+        # (output file, response text)
+        body = template.build_body(text)
+        cache_key = make_cache_key((template.prefix, body), self.service_name, self.model, self.temperature,
+                                   self.max_tokens)
+        api_response = self.cache.get(cache_key) if self.cache else None
+        budget = self.chunk_token_budget(template)
+        if api_response is not None:
+            self.log(f"Using cached response for {text_file}")
+            self.mark_cached_response(text_file)
+        elif template.rest is not None and self.count_tokens(text) > budget:
+            api_response = self.map_reduce(text_file, text, template, budget)
+            if self.cache and api_response:
+                self.cache.put(cache_key, api_response)
+        elif self.stream:
+            return self.stream_to_output(body, template.prefix, text_file, output_dir, cache_key)
+        else:
+            request_started = time.perf_counter()
+            response = self.call_api(body, template.prefix)
+            api_response = response.text
+            self.record_usage(text_file, response, time.perf_counter() - request_started)
+            if self.cache and api_response:
+                self.cache.put(cache_key, api_response)
+
+        return self.write_output(api_response, text_file, output_dir), api_response
+
+    def stream_to_output(self, content: str, prefix: str, text_file: str, output_dir: str,
+                         cache_key: str) -> Tuple[Optional[str], str]:
+        output_file = self.output_path(text_file, output_dir)
+        sink = StreamingOutput(output_file, keep_text=(self.cache is not None or self.duplicates is not None
+                                                       or self.index is not None))
+        try:
+            response = self.service.stream_api(content, self.model, self.max_tokens, self.temperature, sink, prefix)
+            finished_at = time.perf_counter()
+            self.check_lease(text_file)
+            if not sink.finish(lambda output: self.write_reference_and_original(output, text_file)):
+                self.log(f"No valid content found in the API response for {text_file}.")
+                return None, sink.text
+        finally:
+            sink.discard()
+
+        self.record_usage(text_file, response, finished_at - sink.started_at,
+                          sink.first_token_at - sink.started_at if sink.first_token_at is not None else None)
+        if sink.first_token_at is not None:
+            generation_time = max(finished_at - sink.first_token_at, 1e-6)
+            self.log(f"Streamed {text_file}: first token after {sink.first_token_at - sink.started_at:.2f}s, "
+                     f"{response.output_tokens / generation_time:.1f} tokens/s")
+        if self.cache:
+            self.cache.put(cache_key, sink.text)
+        self.keep_front_matter(text_file, sink.text)
+        self.log(f"Markdown content appended to {output_file}")
+        return output_file, sink.text
+
+    def keep_front_matter(self, text_file: str, markdown_content: str):
+        if self.index is not None:
+            with self.usage_lock:
+                self.front_matter[text_file] = markdown_content
+
+    def effective_pack_size(self, template: PromptTemplate) -> int:
+        # A pack's answers have to fit in max_tokens together; without {{TEXT}} there is nothing to pack
+        if self.pack_size <= 1 or template.rest is None:
+            return 0
+        limit = self.max_tokens // EXPECTED_OUTPUT_TOKENS
+        if limit < self.pack_size:
+            self.log(f"Packing at most {max(limit, 1)} documents per request, as their answers have to fit in "
+                     f"{self.max_tokens} max tokens")
+        return limit if limit < self.pack_size else self.pack_size
+
+    def request_pack(self, journal: RunJournal, template: PromptTemplate,
+                     text_files: List[str]) -> Dict[str, PackedResponse]:
+        # Sends the documents of a pack in one request and splits the answer per document. Documents that
+        # are skipped, cached or unreadable are left out; if the answer doesn't split cleanly, every
+        # document is sent on its own instead.
+        members = []
+        for text_file in text_files:
+            try:
+                input_hash = hash_file(text_file)
+                if self.is_skipped(journal, text_file, input_hash, template.hash):
+                    continue
+                if self.leases and self.leases.claim(text_file, input_hash) != CLAIMED:
+                    continue
+                text = self.read_text(text_file)
+            except (OSError, UnicodeDecodeError):
+                continue
+            cache_key = make_cache_key((template.prefix, template.build_body(text)), self.service_name, self.model,
+                                       self.temperature, self.max_tokens)
+            if self.cache and self.cache.get(cache_key) is not None:
+                continue
+            members.append((text_file, text, cache_key))
+        if len(members) < 2:
+            return {}
+
+        body = template.build_body(pack_documents([text for _, text, _ in members])) + pack_instructions(len(members))
+        request_started = time.perf_counter()
+        try:
+            response = self.call_api(body, template.prefix)
+        except Exception as e:
+            self.log(f"Packed request for {len(members)} documents failed ({str(e)}); sending them one by one")
+            return {}
+        api_time = time.perf_counter() - request_started
+        shares = share_usage(response, [len(text) for _, text, _ in members])
+        parts = split_packed_response(response.text or '', len(members))
+        if parts is None:
+            self.log(f"The response for {len(members)} packed documents did not split into one answer per "
+                     f"document; sending them one by one")
+            parts = [None] * len(members)
+        else:
+            self.log(f"Packed {len(members)} documents into one request")
+        packed = {}
+        for index, ((text_file, _, cache_key), part, share) in enumerate(zip(members, parts, shares)):
+            if self.cache and part:
+                self.cache.put(cache_key, part)
+            packed[text_file] = PackedResponse(part, share, api_time, len(members), 1 if index == 0 else 0)
+        return packed
+
+    def output_path(self, text_file: str, output_dir: str) -> str:
+        output_file = mirrored_output_path(text_file, output_dir, self.input_roots)
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        return output_file
+
+    def write_output(self, api_response: str, text_file: str, output_dir: str) -> Optional[str]:
+        markdown_content = self.convert_to_markdown(api_response)
+        if markdown_content:
+            self.check_lease(text_file)
+            output_file = self.output_path(text_file, output_dir)
+            self.append_markdown_to_file(markdown_content, text_file, output_file)
+            self.keep_front_matter(text_file, markdown_content)
+            self.log(f"Markdown content appended to {output_file}")
+            return output_file
+        self.log(f"No valid content found in the API response for {text_file}.")
+        return None
+
+    def check_lease(self, text_file: str):
+        # Before an output is published: another node that took the file over writes it instead
+        if self.leases and self.leases.is_lost(text_file):
+            raise ValueError("The lease was taken over by another node; dropping the output")
+
+    def read_prompt_template(self, prompt_path: str) -> PromptTemplate:
+        with open(prompt_path, 'r', encoding='utf-8') as f:
+            prompt = f.read()
+        return PromptTemplate(prompt, hash_file(prompt_path))
+
+    def read_text(self, text_path: str) -> str:
+        with open(text_path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def split_prompt_and_text(self, prompt_path: str, text_path: str) -> Tuple[str, str]:
+        template = self.read_prompt_template(prompt_path)
+        return template.prefix, template.build_body(self.read_text(text_path))
+
+    def merge_prompt_and_text(self, prompt_path: str, text_path: str) -> str:
+        return "".join(self.split_prompt_and_text(prompt_path, text_path))
+
+    def call_api(self, content: str, prefix: str = "") -> APIResponse:
+        return self.service.call_api(content, self.model, self.max_tokens, self.temperature, prefix)
+
+    def count_tokens(self, text: str) -> int:
+        return self.service.count_tokens(text, self.model)
+
+    def chunk_token_budget(self, template: PromptTemplate) -> int:
+        if self.chunk_tokens:
+            return self.chunk_tokens
+        context_window = self.service.get_context_window(self.model)
+        template_tokens = self.count_tokens(template.prefix + (template.rest or ''))
+        return max(1, input_token_budget(context_window, self.max_tokens, template_tokens))
+
+    def request(self, text_file: str, prefix: str, body: str) -> str:
+        request_started = time.perf_counter()
+        response = self.call_api(body, prefix)
+        self.record_usage(text_file, response, time.perf_counter() - request_started)
+        return self.convert_to_markdown(response.text or '')
+
+    def request_all(self, text_file: str, prefix: str, bodies: List[str]) -> List[str]:
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(bodies))) as executor:
+            return list(executor.map(lambda body: self.request(text_file, prefix, body), bodies))
+
+    def map_reduce(self, text_file: str, text: str, template: PromptTemplate, budget: int) -> str:
+        # Documents larger than the context window are summarized chunk by chunk in parallel (map), then the
+        # partial front matter blocks are sent through the same prompt as one document (reduce).
+        chunks = split_into_chunks(text, budget, self.chunk_overlap_tokens, self.count_tokens)
+        self.log(f"{text_file} exceeds {budget} tokens; summarizing {len(chunks)} overlapping chunks in parallel")
+        prefix = template.prefix
+        partials = self.request_all(text_file, prefix, [template.build_body(chunk) for chunk in chunks])
+
+        # Very long documents can produce more partial results than fit in one request; reduce them in rounds
+        while len(partials) > 1 and self.count_tokens(build_reduce_text(partials)) > budget:
+            groups = [[]]
+            for partial in partials:
+                if groups[-1] and self.count_tokens(build_reduce_text(groups[-1] + [partial])) > budget:
+                    groups.append([])
+                groups[-1].append(partial)
+            if len(groups) == len(partials):
+                break
+            self.log(f"Reducing {len(partials)} partial results for {text_file} in {len(groups)} groups")
+            partials = self.request_all(text_file, prefix,
+                                        [template.build_body(build_reduce_text(group)) for group in groups])
+
+        self.log(f"Combining {len(partials)} partial results for {text_file}")
+        return self.request(text_file, prefix, template.build_body(build_reduce_text(partials)))
+
+    def record_usage(self, text_file: str, response: APIResponse, api_time: float = 0.0,
+                     first_token_time: Optional[float] = None, requests: int = 1):
+        with self.usage_lock:
+            totals = self.usage_totals
+            totals.input_tokens += response.input_tokens
+            totals.output_tokens += response.output_tokens
+            totals.cache_read_tokens += response.cache_read_tokens
+            totals.cache_write_tokens += response.cache_write_tokens
+            file_metrics = self.file_metrics.get(text_file)
+            if file_metrics:
+                file_metrics.add_response(response, api_time, self.pricing, requests)
+                if first_token_time is not None:
+                    file_metrics.first_token_time = first_token_time
+        self.log(f"Tokens for {text_file}: {response.input_tokens} in ({response.cache_read_tokens} cached, "
+                 f"{response.cache_write_tokens} written to cache), {response.output_tokens} out")
+        if response.retries:
+            self.log(f"Request for {text_file} succeeded after {response.retries} retries")
+
+    def record_hedge_usage(self, response: Optional[APIResponse]):
+        # A hedged request that lost still counts towards the spend; a lost stream is counted as a request
+        overhead = FileMetrics('', status='hedge_overhead')
+        if response is None:
+            overhead.requests = 1
+        else:
+            overhead.add_response(response, 0.0, self.pricing)
+        with self.usage_lock:
+            if response is not None:
+                totals = self.usage_totals
+                totals.input_tokens += response.input_tokens
+                totals.output_tokens += response.output_tokens
+                totals.cache_read_tokens += response.cache_read_tokens
+                totals.cache_write_tokens += response.cache_write_tokens
+            self.spent += overhead.cost or 0.0
+            self.hedge_overhead.append(overhead)
+
+    def mark_cached_response(self, text_file: str):
+        with self.usage_lock:
+            file_metrics = self.file_metrics.get(text_file)
+            if file_metrics:
+                file_metrics.cached_response = True
+
+    def mark_packed(self, text_file: str, documents: int):
+        with self.usage_lock:
+            file_metrics = self.file_metrics.get(text_file)
+            if file_metrics:
+                file_metrics.packed_with = documents
+
+    def mark_duplicate(self, text_file: str, canonical: str):
+        with self.usage_lock:
+            file_metrics = self.file_metrics.get(text_file)
+            if file_metrics:
+                file_metrics.duplicate_of = canonical
+
+    def apply_output_limit(self):
+        limit = self.service.get_max_tokens(self.model)
+        if self.max_tokens > limit:
+            self.log(f"Max tokens lowered from {self.max_tokens} to {limit}, the output limit of {self.model}")
+            self.max_tokens = limit
+
+    def plan(self, prompt_file: str, text_files: Iterable[str]) -> RunPlan:
+        # Dry run: token and cost estimates without calling the API
+        self.apply_output_limit()
+        return plan_run(self, self.read_prompt_template(prompt_file), text_files, self.spend_cap)
+
+    def spend_cap_reached(self, in_flight: int) -> bool:
+        # Files already sent are assumed to cost what finished files cost on average
+        if self.spend_cap is None:
+            return False
+        with self.usage_lock:
+            average = self.spent / self.spent_files if self.spent_files else 0.0
+            return self.spent + in_flight * average >= self.spend_cap
+
+    def emit_metrics(self, report: RunReport, file_metrics: FileMetrics):
+        if file_metrics.cost and file_metrics.requests:
+            with self.usage_lock:
+                self.spent += file_metrics.cost
+                self.spent_files += 1
+        self.report_overhead(report)
+        report.add(file_metrics)
+        self.metrics(file_metrics)
+
+    def report_overhead(self, report: RunReport):
+        with self.usage_lock:
+            overhead, self.hedge_overhead = self.hedge_overhead, []
+        for metrics in overhead:
+            report.add_overhead(metrics)
+
+    def finish_report(self, report: RunReport, output_dir: str):
+        self.report_overhead(report)
+        report.finish()
+        if not report.events:
+            return
+        default_file = NODE_REPORT_FILE.format(node=self.node_id) if self.node_id else REPORT_FILE
+        report_file = self.report_file or os.path.join(output_dir, default_file)
+        try:
+            report.write_json(report_file)
+            if self.prometheus_file:
+                report.write_prometheus(self.prometheus_file)
+        except OSError as e:
+            self.log(f"Could not write the run report: {str(e)}")
+            return
+        self.log(f"Run report: {report.describe()} (written to {report_file})")
+        if self.node_id and not self.report_file:
+            # The node finishing last leaves a merged report covering every node
+            try:
+                merged = merge_node_reports(output_dir)
+            except (OSError, ValueError, KeyError) as e:
+                self.log(f"Could not merge the node reports: {str(e)}")
+                return
+            if merged:
+                self.log(f"Merged report of all nodes so far: {merged.describe()}")
+
+    def log_usage_totals(self):
+        with self.usage_lock:
+            totals = self.usage_totals
+            self.usage_totals = APIResponse("")
+        if totals.input_tokens:
+            share = 100 * totals.cache_read_tokens / totals.input_tokens
+            self.log(f"Prompt cache: {totals.cache_read_tokens} of {totals.input_tokens} input tokens "
+                     f"read from cache ({share:.0f}%), {totals.cache_write_tokens} written")
+
+    def convert_to_markdown(self, content: str) -> str:
+        return content.strip()
+
+    def append_markdown_to_file(self, markdown_content: str, original_file: str, output_file: str):
+        output, temp_path = open_partial_output(output_file)
+        try:
+            with output:
+                output.write((markdown_content + "\n\n").encode('utf-8'))
+                self.write_reference_and_original(output, original_file)
+            os.replace(temp_path, output_file)
+        except BaseException:
+            remove_partial_output(temp_path)
+            raise
+
+    def write_reference_and_original(self, output: BinaryIO, original_file: str):
+        if self.reference and self.reference.strip():
+            output.write(f"Reference: {self.reference.strip()}\n\n".encode('utf-8'))
+        # Copied byte for byte in blocks, so the original never has to be decoded or held in memory again
+        with open(original_file, 'rb') as original:
+            shutil.copyfileobj(original, output, COPY_BLOCK_SIZE)
+
+    @staticmethod
+    def validate_input(prompt_file, text_files, output_dir) -> Optional[str]:
+        if not prompt_file or not text_files or not output_dir:
+            return "Please select all required files and directories."
+        if not os.path.exists(prompt_file):
+            return f"Prompt file not found: {prompt_file}"
+        # Generators are not checked up front; missing files then fail individually
+        for text_file in text_files if isinstance(text_files, (list, tuple)) else ():
+            if not os.path.exists(text_file):
+                return f"Text file not found: {text_file}"
+        if not os.path.exists(output_dir):
+            return f"Output directory not found: {output_dir}"
+        return None
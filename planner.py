@@ -0,0 +1,138 @@
+import math
+import os
+from dataclasses import dataclass, asdict, field
+from typing import Dict, Iterable, List, Optional
+from api_services import APIResponse, ModelPricing
+
+# Typical length of a front matter response, for the expected cost. The maximum cost assumes every
+# response uses all of max_tokens.
+EXPECTED_OUTPUT_TOKENS = 600
+
+@dataclass
+class FilePlan:
+    text_file: str
+    size: int = 0
+    input_tokens: int = 0
+    # More than one request when the document is split into chunks (map-reduce)
+    requests: int = 1
+    expected_cost: Optional[float] = 0.0
+    max_cost: Optional[float] = 0.0
+    error: Optional[str] = None
+
+@dataclass
+class RunPlan:
+    service_name: str
+    model: str
+    max_tokens: int
+    context_window: int
+    chunk_token_budget: int
+    spend_cap: Optional[float] = None
+    files: List[FilePlan] = field(default_factory=list)
+    issues: List[str] = field(default_factory=list)
+
+    def totals(self) -> Dict:
+        expected = [plan.expected_cost for plan in self.files]
+        maximum = [plan.max_cost for plan in self.files]
+        return {
+            'files': len(self.files),
+            'bytes': sum(plan.size for plan in self.files),
+            'input_tokens': sum(plan.input_tokens for plan in self.files),
+            'requests': sum(plan.requests for plan in self.files if not plan.error),
+            'split_files': sum(1 for plan in self.files if plan.requests > 1),
+            'errors': sum(1 for plan in self.files if plan.error),
+            # None when the model's price is unknown
+            'expected_cost': None if None in expected else sum(expected),
+            'max_cost': None if None in maximum else sum(maximum)
+        }
+
+    def over_spend_cap(self) -> bool:
+        expected_cost = self.totals()['expected_cost']
+        return self.spend_cap is not None and expected_cost is not None and expected_cost > self.spend_cap
+
+    def to_dict(self) -> Dict:
+        return dict(asdict(self), totals=self.totals())
+
+    def describe(self) -> str:
+        totals = self.totals()
+        expected, maximum = totals['expected_cost'], totals['max_cost']
+        cost_text = f"${expected:.4f} expected, at most ${maximum:.4f}" if expected is not None else "cost unknown"
+        text = (f"Estimate for {totals['files']} file(s) with {self.model}: {totals['input_tokens']} input tokens "
+                f"in {totals['requests']} request(s)")
+        if totals['split_files']:
+            text += f" ({totals['split_files']} file(s) split into chunks)"
+        text += f", {cost_text}"
+        if self.spend_cap is not None:
+            text += f" (spend cap ${self.spend_cap:.2f})"
+        return text
+
+    def table(self) -> str:
+        lines = [f"{'Tokens':>10} {'Requests':>8} {'Expected $':>11} {'Max $':>9}  File"]
+        for plan in self.files:
+            if plan.error:
+                lines.append(f"{'':>10} {'':>8} {'':>11} {'':>9}  {plan.text_file}: {plan.error}")
+                continue
+            expected = f"{plan.expected_cost:.4f}" if plan.expected_cost is not None else "?"
+            maximum = f"{plan.max_cost:.4f}" if plan.max_cost is not None else "?"
+            lines.append(f"{plan.input_tokens:>10} {plan.requests:>8} {expected:>11} {maximum:>9}  {plan.text_file}")
+        return "\n".join(lines)
+
+def file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return -1
+
+def order_largest_first(text_files: Iterable[str]) -> List[str]:
+    # The longest files start first, so the run doesn't end waiting on one large file picked up last
+    return sorted(text_files, key=file_size, reverse=True)
+
+def estimate_cost(pricing: Optional[ModelPricing], input_tokens: int, output_tokens: int) -> Optional[float]:
+    if pricing is None:
+        return None
+    return pricing.cost(APIResponse("", input_tokens=input_tokens, output_tokens=output_tokens))
+
+def plan_run(pipeline, template, text_files: Iterable[str], spend_cap: Optional[float] = None) -> RunPlan:
+    # Counts every file's tokens locally (with the provider's tokenizer where one is installed) and checks
+    # them against the model's limits, without calling the API
+    service = pipeline.service
+    max_tokens = pipeline.max_tokens
+    context_window = service.get_context_window(pipeline.model)
+    template_tokens = pipeline.count_tokens(template.prefix + (template.rest or ''))
+    budget = pipeline.chunk_token_budget(template)
+    pricing = service.get_pricing(pipeline.model)
+    plan = RunPlan(pipeline.service_name, pipeline.model, max_tokens, context_window, budget, spend_cap)
+
+    if template_tokens + max_tokens >= context_window:
+        plan.issues.append(f"The prompt ({template_tokens} tokens) and max tokens ({max_tokens}) leave no room for "
+                           f"text in the {context_window}-token context window")
+    if pricing is None:
+        plan.issues.append(f"No price is known for {pipeline.model}, so the cost can't be estimated or capped")
+    expected_output = min(EXPECTED_OUTPUT_TOKENS, max_tokens)
+
+    for text_file in order_largest_first(text_files):
+        file_plan = FilePlan(text_file, max(0, file_size(text_file)))
+        try:
+            text_tokens = pipeline.count_tokens(pipeline.read_text(text_file))
+        except (OSError, UnicodeDecodeError) as e:
+            file_plan.error = str(e)
+            plan.files.append(file_plan)
+            continue
+        if text_tokens <= budget or template.rest is None:
+            if template.rest is None and text_tokens + template_tokens + max_tokens > context_window:
+                file_plan.error = "exceeds the context window, and the prompt has no {{TEXT}} to split it at"
+            expected_input = maximum_input = text_tokens + template_tokens
+        else:
+            # Map-reduce: one request per chunk (with overlap), then one combining the partial results
+            chunks = math.ceil(text_tokens / budget)
+            chunk_input = text_tokens + pipeline.chunk_overlap_tokens * (chunks - 1) + (chunks + 1) * template_tokens
+            file_plan.requests = chunks + 1
+            expected_input = chunk_input + chunks * expected_output
+            maximum_input = chunk_input + chunks * max_tokens
+        file_plan.input_tokens = expected_input
+        file_plan.expected_cost = estimate_cost(pricing, expected_input, file_plan.requests * expected_output)
+        file_plan.max_cost = estimate_cost(pricing, maximum_input, file_plan.requests * max_tokens)
+        plan.files.append(file_plan)
+
+    if plan.over_spend_cap():
+        plan.issues.append(f"The expected cost is above the spend cap of ${spend_cap:.2f}")
+    return plan
@@ -0,0 +1,99 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional, Union
+
+CACHE_DIR = 'response_cache'
+DEFAULT_CACHE_SIZE_MB = 256
+
+def make_cache_key(content: Union[str, Iterable[str]], service_name: str, model: str, temperature: float,
+                   max_tokens: int) -> str:
+    digest = hashlib.sha256()
+    for part in (service_name, model, repr(float(temperature)), str(int(max_tokens))):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    # Content may be given in parts (e.g. prompt prefix and body) to avoid concatenating large documents
+    for part in ((content,) if isinstance(content, str) else content):
+        digest.update(part.encode('utf-8'))
+    return digest.hexdigest()
+
+class ResponseCache:
+    def __init__(self, cache_dir: str = CACHE_DIR, max_bytes: int = DEFAULT_CACHE_SIZE_MB * 1024 * 1024,
+                 log: Callable[[str], None] = print):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.log = log
+        self._lock = threading.Lock()
+        # key -> size in bytes, least recently used first
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        found = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith('.txt'):
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        # The file mtime is refreshed on every hit, so it doubles as the LRU timestamp across runs
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+        with self._lock:
+            self._evict()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.txt")
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = f.read()
+            os.utime(path)
+            return value
+        except FileNotFoundError:
+            with self._lock:
+                size = self._entries.pop(key, 0)
+                self._total_bytes -= size
+            return None
+
+    def put(self, key: str, value: str):
+        data = value.encode('utf-8')
+        if len(data) > self.max_bytes:
+            return
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self._path(key))
+        except BaseException as e:
+            # e.g. a full disk; no temp file is left behind in the cache directory
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            if isinstance(e, OSError):
+                self.log(f"Could not write to the response cache: {str(e)}")
+            raise
+        with self._lock:
+            self._total_bytes -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._total_bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,348 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from api_services import (APIService, APIResponse, APIServiceError, ModelPricing, RetryBudget, StreamSink,
+                          get_service)
+from metrics import percentile
+
+# A route that fails this many calls in a row is skipped for a cooldown that doubles while it keeps failing
+ROUTE_FAILURES_TO_OPEN = 3
+ROUTE_COOLDOWN_SECONDS = 30.0
+ROUTE_MAX_COOLDOWN_SECONDS = 300.0
+# Errors that are specific to one key or endpoint, so another route may still succeed
+FAILOVER_STATUS_CODES = (401, 403, 404)
+# A duplicate request is sent once a call has been running longer than this percentile of the route's
+# recent latencies. Duplicates may add at most HEDGE_BUDGET_RATIO extra requests.
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_BUDGET_RATIO = 0.1
+HEDGE_BUDGET_MIN = 2
+HEDGE_WORKERS = 128
+LATENCY_WINDOW = 200
+
+@dataclass
+class Route:
+    service_name: str
+    api_key: str
+    weight: int = 1
+    # None sends the model selected for the run
+    model: Optional[str] = None
+    base_url: Optional[str] = None
+
+def parse_routes(entries) -> List[Route]:
+    # The "routes" list in api_config.json, e.g.
+    # [{"service": "OpenAI", "api_key": "...", "model": "gpt-4o-mini", "weight": 2}]. The service may
+    # also name a configured endpoint, e.g. a local server taking part of the run; those need no key.
+    routes = []
+    for entry in entries or []:
+        service_name = entry.get('service', 'Anthropic')
+        if not entry.get('api_key') and service_name in ("Anthropic", "OpenAI"):
+            continue
+        routes.append(Route(service_name, entry.get('api_key', ''), max(1, int(entry.get('weight', 1))),
+                            entry.get('model') or None, entry.get('base_url') or None))
+    return routes
+
+class HedgeLost(Exception):
+    pass
+
+class SinkClaim:
+    def __init__(self, owner=None):
+        self.lock = threading.Lock()
+        self.owner = owner
+
+class RouteSink(StreamSink):
+    # Passes one route's stream through to the real sink. While a hedged duplicate is in flight, the
+    # first route to produce text claims the sink and the other one is stopped at its next chunk.
+    def __init__(self, target: StreamSink, claim: SinkClaim):
+        self.target = target
+        self.claim = claim
+        self.started_at = time.perf_counter()
+        self.first_token_at = None
+
+    def begin(self):
+        self.started_at = time.perf_counter()
+        self.first_token_at = None
+        if self.claim.owner is self:
+            self.target.begin()
+
+    def write(self, text: str):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        if self.claim.owner is not self:
+            with self.claim.lock:
+                if self.claim.owner is None:
+                    self.claim.owner = self
+            if self.claim.owner is not self:
+                raise HedgeLost()
+        self.target.write(text)
+
+class RouteState:
+    def __init__(self, route: Route, service: APIService):
+        self.route = route
+        self.service = service
+        self.name = f"{route.service_name}:{route.model or 'selected model'}"
+        if route.api_key:
+            self.name += f" (key ...{route.api_key[-4:]})"
+        self.current_weight = 0
+        self.failures = 0
+        self.down_until = 0.0
+        self.cooldown = ROUTE_COOLDOWN_SECONDS
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.first_token_latencies = deque(maxlen=LATENCY_WINDOW)
+        self.calls = 0
+        self.errors = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def model_for(self, model: str) -> str:
+        return self.route.model or model
+
+    def hedge_delay(self, streaming: bool) -> Optional[float]:
+        # Streams are hedged on the time to their first token, other calls on their whole duration
+        latencies = list(self.first_token_latencies if streaming else self.latencies)
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return percentile(latencies, HEDGE_PERCENTILE)
+
+class RoutedService(APIService):
+    # Spreads requests over several keys and providers by smooth weighted round-robin. A route that keeps
+    # failing is skipped for a while and its calls fail over to the next route; with hedging on, a call
+    # slower than the route's p95 gets a duplicate on another route and the first answer wins.
+    # Batch requests and model lists use the first route.
+    def __init__(self, routes: List[Tuple[Route, APIService]], hedge: bool = False):
+        if not routes:
+            raise ValueError("At least one route is required")
+        self.routes = [RouteState(route, service) for route, service in routes]
+        self.primary = self.routes[0]
+        # Configured rate limits apply to the primary key; other routes learn theirs from response headers
+        self.scheduler = self.primary.service.scheduler
+        self.hedge = hedge
+        self.hedge_budget = RetryBudget(HEDGE_BUDGET_RATIO, HEDGE_BUDGET_MIN)
+        self.lock = threading.Lock()
+        self._client_lock = threading.Lock()
+        self.executor = None
+        # Called with the response of every hedged call that lost, once it finishes, or with None for a lost
+        # stream cut off before its usage was known; those requests are paid for too
+        self.on_hedge_usage: Optional[Callable[[Optional[APIResponse]], None]] = None
+
+    def create_client(self):
+        return [state.service.client for state in self.routes]
+
+    def select(self, exclude: Sequence[RouteState] = ()) -> Optional[RouteState]:
+        with self.lock:
+            now = time.monotonic()
+            candidates = [state for state in self.routes if state not in exclude]
+            if not candidates:
+                return None
+            healthy = [state for state in candidates if state.down_until <= now]
+            if not healthy:
+                # Every route is cooling down: try the one that comes back first
+                return min(candidates, key=lambda state: state.down_until)
+            total = sum(state.route.weight for state in healthy)
+            for state in healthy:
+                state.current_weight += state.route.weight
+            chosen = max(healthy, key=lambda state: state.current_weight)
+            chosen.current_weight -= total
+            return chosen
+
+    def record_success(self, state: RouteState, latency: float, first_token_latency: Optional[float] = None):
+        with self.lock:
+            state.calls += 1
+            state.failures = 0
+            state.cooldown = ROUTE_COOLDOWN_SECONDS
+            state.latencies.append(latency)
+            if first_token_latency is not None:
+                state.first_token_latencies.append(first_token_latency)
+
+    def record_failure(self, state: RouteState):
+        with self.lock:
+            state.calls += 1
+            state.errors += 1
+            state.failures += 1
+            if state.failures >= ROUTE_FAILURES_TO_OPEN:
+                state.down_until = time.monotonic() + state.cooldown
+                state.cooldown = min(ROUTE_MAX_COOLDOWN_SECONDS, state.cooldown * 2)
+                state.failures = 0
+
+    @staticmethod
+    def should_fail_over(error: APIServiceError) -> bool:
+        return error.retryable or error.status_code in FAILOVER_STATUS_CODES
+
+    def with_failover(self, attempt: Callable[[RouteState, List[RouteState]], APIResponse]) -> APIResponse:
+        tried = []
+        last_error = None
+        while True:
+            state = self.select(tried)
+            if state is None:
+                raise last_error
+            tried.append(state)
+            try:
+                return attempt(state, tried)
+            except APIServiceError as e:
+                if not self.should_fail_over(e):
+                    raise
+                last_error = e
+
+    def hedged(self, state: RouteState, tried: List[RouteState], send: Callable[[RouteState], APIResponse],
+               streaming: bool) -> APIResponse:
+        self.hedge_budget.deposit()
+        delay = state.hedge_delay(streaming) if self.hedge else None
+        if delay is None:
+            return send(state)
+        primary = self.get_executor().submit(send, state)
+        try:
+            return primary.result(timeout=delay)
+        except FuturesTimeoutError:
+            pass
+        if not self.hedge_budget.withdraw():
+            return primary.result()
+        backup = self.select(tried) or state
+        tried.append(backup)
+        with self.lock:
+            state.hedges += 1
+        futures = {primary: state, self.get_executor().submit(send, backup): backup}
+        error = None
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                winner = futures.pop(future)
+                try:
+                    response = future.result()
+                except HedgeLost:
+                    self.account_loser(future)
+                    continue
+                except Exception as e:
+                    error = error or e
+                    continue
+                if winner is backup and backup is not state:
+                    with self.lock:
+                        state.hedge_wins += 1
+                for loser in futures:
+                    loser.add_done_callback(self.account_loser)
+                return response
+        raise error
+
+    def account_loser(self, future: Future):
+        listener = self.on_hedge_usage
+        if listener is None:
+            return
+        try:
+            response = future.result()
+        except HedgeLost:
+            response = None
+        except Exception:
+            # Failed requests are not billed
+            return
+        listener(response)
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+            return self.executor
+
+    def call_api(self, content: str, model: str, max_tokens: int, temperature: float,
+                 prefix: str = "") -> APIResponse:
+        def send(state: RouteState) -> APIResponse:
+            started_at = time.perf_counter()
+            try:
+                response = state.service.call_api(content, state.model_for(model), max_tokens, temperature, prefix)
+            except APIServiceError as e:
+                if self.should_fail_over(e):
+                    self.record_failure(state)
+                raise
+            self.record_success(state, time.perf_counter() - started_at)
+            return self.priced(state, model, response)
+
+        return self.with_failover(lambda state, tried: self.hedged(state, tried, send, streaming=False))
+
+    def stream_api(self, content: str, model: str, max_tokens: int, temperature: float, sink: StreamSink,
+                   prefix: str = "") -> APIResponse:
+        def attempt(state: RouteState, tried: List[RouteState]) -> APIResponse:
+            sink.begin()
+            claim = SinkClaim()
+
+            def send(route_state: RouteState) -> APIResponse:
+                route_sink = RouteSink(sink, claim)
+                try:
+                    response = route_state.service.stream_api(content, route_state.model_for(model), max_tokens,
+                                                              temperature, route_sink, prefix)
+                except APIServiceError as e:
+                    if self.should_fail_over(e):
+                        self.record_failure(route_state)
+                    raise
+                finished_at = time.perf_counter()
+                first_token_at = route_sink.first_token_at or finished_at
+                self.record_success(route_state, finished_at - route_sink.started_at,
+                                    first_token_at - route_sink.started_at)
+                return self.priced(route_state, model, response)
+
+            return self.hedged(state, tried, send, streaming=True)
+
+        return self.with_failover(attempt)
+
+    @staticmethod
+    def priced(state: RouteState, model: str, response: APIResponse) -> APIResponse:
+        # Routes may use other models and providers, so each response carries its own cost
+        pricing = state.service.get_pricing(state.model_for(model))
+        if pricing is not None:
+            response.cost = pricing.cost(response)
+        return response
+
+    def get_available_models(self, on_update: Optional[Callable[[List[str]], None]] = None) -> List[str]:
+        return self.primary.service.get_available_models(on_update)
+
+    def get_max_tokens(self, model: str) -> int:
+        return min(state.service.get_max_tokens(state.model_for(model)) for state in self.routes)
+
+    def get_context_window(self, model: str) -> int:
+        # Documents are split for the smallest context window, so any route can take any request
+        return min(state.service.get_context_window(state.model_for(model)) for state in self.routes)
+
+    def count_tokens(self, text: str, model: str) -> int:
+        return self.primary.service.count_tokens(text, model)
+
+    def get_pricing(self, model: str) -> Optional[ModelPricing]:
+        return self.primary.service.get_pricing(model)
+
+    def submit_batch(self, requests: List[Tuple[str, str]], model: str, max_tokens: int, temperature: float,
+                     prefix: str = "") -> str:
+        return self.primary.service.submit_batch(requests, self.primary.model_for(model), max_tokens,
+                                                 temperature, prefix)
+
+    def get_batch_status(self, batch_id: str) -> str:
+        return self.primary.service.get_batch_status(batch_id)
+
+    def get_batch_results(self, batch_id: str) -> Dict[str, Optional[str]]:
+        return self.primary.service.get_batch_results(batch_id)
+
+    def describe(self) -> str:
+        with self.lock:
+            parts = []
+            for state in self.routes:
+                p95 = percentile(list(state.latencies), HEDGE_PERCENTILE) if state.latencies else 0.0
+                part = f"{state.name}: {state.calls} call(s), {state.errors} failed, p95 {p95:.2f}s"
+                if self.hedge:
+                    part += f", {state.hedges} hedged ({state.hedge_wins} won by the duplicate)"
+                parts.append(part)
+        return "Routes: " + "; ".join(parts)
+
+def routed_service(config: dict, service: APIService, service_name: str, api_key: str,
+                   base_url: Optional[str] = None, pool_size: Optional[int] = None,
+                   timeout: Optional[float] = None) -> APIService:
+    # The selected service and key come first; the routes configured in api_config.json are added to it.
+    # Without configured routes the service is returned unchanged.
+    routes = parse_routes(config.get('routes'))
+    if not routes:
+        return service
+    for route in routes:
+        if route.model is None and route.service_name != service_name:
+            raise ValueError(f"Route to {route.service_name} needs a model, the selected one is for {service_name}")
+    primary = Route(service_name, api_key, max(1, int(config.get('primary_weight', 1))), base_url=base_url)
+    return RoutedService([(primary, service)] + [
+        (route, get_service(route.service_name, route.api_key, route.base_url, pool_size, timeout))
+        for route in routes
+    ], hedge=config.get('hedge_requests', False))
@@ -0,0 +1,338 @@
+import argparse
+import glob
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from typing import Dict, List, Optional
+from urllib.request import pathname2url
+from journal import RunJournal, NODE_JOURNAL_FILE
+
+# The front matter of every output, split into its fields and searchable with SQLite's FTS5, so a
+# keyword search over 100k documents is an index lookup instead of a scan of the .md files
+INDEX_FILE = '.aifmm_index.sqlite'
+# The front matter sits at the top of the output; the original text after it is never read
+FRONT_MATTER_MAX_BYTES = 64 * 1024
+DEFAULT_SEARCH_LIMIT = 20
+# Rows written per transaction when building the index; during a run every file is committed on its own
+BUILD_COMMIT_ROWS = 1000
+
+# (label in the output format of prompt.txt, column), in the order of the format
+FIELDS = [
+    ("Title", "title"),
+    ("Subtitle", "subtitle"),
+    ("Keywords", "keywords"),
+    ("Surprise Factor Keywords", "surprise_keywords"),
+    ("Abstract", "abstract"),
+    ("Author and Affiliation", "author"),
+    ("Surprise Factor", "surprise_factor"),
+    ("Table of Contents", "contents")
+]
+COLUMNS = [column for _, column in FIELDS]
+COLUMN_BY_LABEL = {label.lower(): column for label, column in FIELDS}
+# The second block of the format; a rule after one of these ends the front matter
+CLOSING_COLUMNS = {"abstract", "author", "surprise_factor", "contents"}
+# Ranking weights: matches in the title and keywords count most
+COLUMN_WEIGHTS = {"title": 10.0, "subtitle": 4.0, "keywords": 8.0, "surprise_keywords": 4.0, "abstract": 2.0,
+                  "author": 3.0, "surprise_factor": 1.5, "contents": 1.0}
+
+# "Title: ...", also as "**Title:**" or "## Title:", as models sometimes format the labels
+FIELD_PATTERN = re.compile(r'^[ \t]*(?:#+[ \t]*)?(?:\*\*)?(' + '|'.join(
+    re.escape(label) for label, _ in sorted(FIELDS, key=lambda field: -len(field[0]))) +
+    r')(?:\*\*)?[ \t]*:(?:\*\*)?[ \t]*(.*)$', re.IGNORECASE)
+RULE_PATTERN = re.compile(r'^[ \t]*-{3,}[ \t]*$')
+# Placeholders of the template that a model copied instead of filling in
+PLACEHOLDER_PATTERN = re.compile(r'^Insert .* here\b', re.IGNORECASE)
+QUERY_TERM_PATTERN = re.compile(r'\w+\*?')
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    file TEXT NOT NULL UNIQUE,
+    input_hash TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL DEFAULT '',
+    output_file TEXT,
+    {', '.join(f"{column} TEXT NOT NULL DEFAULT ''" for column in COLUMNS)},
+    indexed_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_input_hash ON documents (input_hash);
+CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+    {', '.join(COLUMNS)}, content='documents', content_rowid='id', tokenize='porter unicode61'
+);
+CREATE TRIGGER IF NOT EXISTS documents_fts_insert AFTER INSERT ON documents BEGIN
+    INSERT INTO documents_fts (rowid, {', '.join(COLUMNS)}) VALUES (new.id, {', '.join('new.' + c for c in COLUMNS)});
+END;
+CREATE TRIGGER IF NOT EXISTS documents_fts_delete AFTER DELETE ON documents BEGIN
+    INSERT INTO documents_fts (documents_fts, rowid, {', '.join(COLUMNS)})
+    VALUES ('delete', old.id, {', '.join('old.' + c for c in COLUMNS)});
+END;
+CREATE TRIGGER IF NOT EXISTS documents_fts_update AFTER UPDATE ON documents
+WHEN {' OR '.join(f'old.{c} IS NOT new.{c}' for c in COLUMNS)} BEGIN
+    INSERT INTO documents_fts (documents_fts, rowid, {', '.join(COLUMNS)})
+    VALUES ('delete', old.id, {', '.join('old.' + c for c in COLUMNS)});
+    INSERT INTO documents_fts (rowid, {', '.join(COLUMNS)}) VALUES (new.id, {', '.join('new.' + c for c in COLUMNS)});
+END;
+"""
+
+def parse_front_matter(text: str) -> Dict[str, str]:
+    # Fields of the format fixed by prompt.txt; labels that are missing are left out
+    lines = {}
+    current = None
+    for line in text.splitlines():
+        if RULE_PATTERN.match(line):
+            if CLOSING_COLUMNS & lines.keys():
+                break
+            current = None
+            continue
+        match = FIELD_PATTERN.match(line)
+        if match:
+            current = COLUMN_BY_LABEL[match.group(1).lower()]
+            if current in lines:
+                # A second Title: belongs to the original text
+                break
+            lines[current] = [match.group(2)]
+        elif current:
+            lines[current].append(line)
+    fields = {}
+    for column, value_lines in lines.items():
+        # Trailing double spaces are markdown line breaks
+        value = "\n".join(line.rstrip() for line in value_lines).strip()
+        if value and not PLACEHOLDER_PATTERN.match(value):
+            fields[column] = value
+    return fields
+
+def read_front_matter(output_file: str) -> Dict[str, str]:
+    with open(output_file, 'rb') as f:
+        head = f.read(FRONT_MATTER_MAX_BYTES)
+    return parse_front_matter(head.decode('utf-8', errors='ignore'))
+
+def build_match(query: str, column: Optional[str] = None, raw: bool = False) -> str:
+    # Words are quoted, so punctuation can't break the FTS5 syntax; every word has to match and a
+    # trailing * matches prefixes. raw passes FTS5 query syntax (OR, NEAR, "phrases") through.
+    if not raw:
+        terms = QUERY_TERM_PATTERN.findall(query)
+        query = " ".join(f'"{term.rstrip("*")}"' + ('*' if term.endswith('*') else '') for term in terms)
+    if not query:
+        raise ValueError("Empty search")
+    return f"{column} : ({query})" if column else query
+
+@dataclass
+class SearchResult:
+    file: str
+    output_file: Optional[str]
+    title: str
+    snippet: str
+    score: float
+
+class SearchIndex:
+    # One row per input file with its input hash, so re-runs only write the rows of changed files; the FTS
+    # index is only rewritten when a file's front matter changed. Writes come from the pipeline's worker
+    # threads and share one connection.
+    def __init__(self, path: str, read_only: bool = False):
+        self.path = path
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        if read_only:
+            # Searching never creates or changes the database
+            self.connection = sqlite3.connect(f"file:{pathname2url(os.path.abspath(path))}?mode=ro", uri=True,
+                                              check_same_thread=False)
+            return
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            # WAL lets searches run while a pipeline is writing
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            if not self.read_only:
+                # Out of WAL mode when no one else has it open, so read-only searches find no -wal/-shm
+                # files to create
+                try:
+                    self.connection.execute("PRAGMA journal_mode=DELETE")
+                except sqlite3.Error:
+                    pass
+            self.connection.close()
+
+    def indexed_hash(self, text_file: str) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute("SELECT input_hash FROM documents WHERE file = ?",
+                                          (os.path.abspath(text_file),)).fetchone()
+        return row[0] if row else None
+
+    def is_current(self, text_file: str, input_hash: str) -> bool:
+        return self.indexed_hash(text_file) == input_hash
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def upsert(self, text_file: str, input_hash: str, prompt_hash: str, output_file: Optional[str],
+               fields: Dict[str, str], commit: bool = True) -> bool:
+        # False when the row was already up to date. With commit=False the row is written by the next commit().
+        output_file = os.path.abspath(output_file) if output_file else None
+        values = (input_hash, prompt_hash, output_file) + tuple(fields.get(column, '') for column in COLUMNS)
+        text_file = os.path.abspath(text_file)
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT input_hash, prompt_hash, output_file, {', '.join(COLUMNS)} FROM documents WHERE file = ?",
+                (text_file,)).fetchone()
+            if row == values:
+                return False
+            self.connection.execute(
+                f"INSERT INTO documents (file, input_hash, prompt_hash, output_file, {', '.join(COLUMNS)}, indexed_at) "
+                f"VALUES ({', '.join('?' * (len(COLUMNS) + 5))}) ON CONFLICT (file) DO UPDATE SET "
+                f"{', '.join(f'{name} = excluded.{name}' for name in ['input_hash', 'prompt_hash', 'output_file'] + COLUMNS + ['indexed_at'])}",
+                (text_file,) + values + (datetime.now().isoformat(),))
+            if commit:
+                self.connection.commit()
+        return True
+
+    def index_output(self, text_file: str, input_hash: str, prompt_hash: str, output_file: str,
+                     front_matter: Optional[str] = None, commit: bool = True) -> Optional[bool]:
+        # Parses the front matter of an output, read from its file unless it is given; None when it has none
+        # of the fields
+        fields = parse_front_matter(front_matter) if front_matter is not None else read_front_matter(output_file)
+        if not fields:
+            return None
+        return self.upsert(text_file, input_hash, prompt_hash, output_file, fields, commit)
+
+    def remove(self, text_file: str, commit: bool = True):
+        with self.lock:
+            self.connection.execute("DELETE FROM documents WHERE file = ?", (os.path.abspath(text_file),))
+            if commit:
+                self.connection.commit()
+
+    def count(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def search(self, query: str, column: Optional[str] = None, limit: int = DEFAULT_SEARCH_LIMIT,
+               raw: bool = False) -> List[SearchResult]:
+        if column is not None and column not in COLUMNS:
+            raise ValueError(f"Unknown field {column!r}, expected one of {', '.join(COLUMNS)}")
+        weights = ", ".join(str(COLUMN_WEIGHTS[c]) for c in COLUMNS)
+        snippet_column = COLUMNS.index(column) if column else -1
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT d.file, d.output_file, d.title, "
+                f"snippet(documents_fts, {snippet_column}, '[', ']', '...', 12), bm25(documents_fts, {weights}) AS score "
+                f"FROM documents_fts JOIN documents d ON d.id = documents_fts.rowid "
+                f"WHERE documents_fts MATCH ? ORDER BY score LIMIT ?",
+                (build_match(query, column, raw), limit)).fetchall()
+        return [SearchResult(*row) for row in rows]
+
+def open_index(output_dir: str, read_only: bool = False) -> SearchIndex:
+    return SearchIndex(os.path.join(output_dir, INDEX_FILE), read_only)
+
+def journal_entries(output_dir: str) -> Dict[str, dict]:
+    # The latest entry per input file over the run's journal and the journals of a sharded run's nodes
+    pattern = os.path.join(glob.escape(output_dir), NODE_JOURNAL_FILE.format(node='*'))
+    prefix, suffix = NODE_JOURNAL_FILE.split('{node}')
+    node_ids = [os.path.basename(path)[len(prefix):-len(suffix)] for path in glob.glob(pattern)]
+    latest = {}
+    for node_id in [None] + sorted(node_ids):
+        for entry in RunJournal(output_dir, node_id).entries():
+            current = latest.get(entry['file'])
+            if current is None or entry['time'] >= current['time']:
+                latest[entry['file']] = entry
+    return latest
+
+def build_index(output_dir: str, log=print) -> Dict[str, int]:
+    # Brings the index up to date with the journals, e.g. after a sharded run or for outputs written
+    # before indexing was turned on. Files whose indexed input hash matches the journal are not read.
+    counts = {'indexed': 0, 'unchanged': 0, 'removed': 0, 'no_fields': 0}
+    pending = 0
+    index = open_index(output_dir)
+    try:
+        for text_file, entry in journal_entries(output_dir).items():
+            output_file = entry.get('output_file')
+            if entry['status'] != 'done' or not output_file:
+                continue
+            if not os.path.exists(output_file):
+                # Journals of older versions have output paths relative to the run's working directory,
+                # which may not be this one; those rows are kept
+                if not os.path.isabs(output_file) or index.indexed_hash(text_file) is None:
+                    continue
+                index.remove(text_file, commit=False)
+                counts['removed'] += 1
+            elif index.is_current(text_file, entry['input_hash']):
+                counts['unchanged'] += 1
+                continue
+            else:
+                try:
+                    indexed = index.index_output(text_file, entry['input_hash'], entry.get('prompt_hash', ''),
+                                                 output_file, commit=False)
+                except OSError as e:
+                    log(f"Could not read {output_file}: {str(e)}")
+                    continue
+                if not indexed:
+                    counts['unchanged' if indexed is False else 'no_fields'] += 1
+                    continue
+                counts['indexed'] += 1
+            pending += 1
+            if pending >= BUILD_COMMIT_ROWS:
+                index.commit()
+                pending = 0
+        index.commit()
+    finally:
+        index.close()
+    return counts
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="search_index", description="Search the front matter of generated files.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Index the outputs recorded in the journals that are missing or changed")
+    build.add_argument("output_dir", help="Output directory of the runs")
+    query = commands.add_parser("query", help="Search the index")
+    query.add_argument("output_dir", help="Output directory of the runs")
+    query.add_argument("query", help="Words that must all match; a trailing * matches prefixes")
+    query.add_argument("--field", choices=COLUMNS, help="Only search this field")
+    query.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="Results to show (default: %(default)s)")
+    query.add_argument("--raw", action="store_true", help="Pass the query to FTS5 as is (OR, NOT, NEAR, \"phrases\")")
+    query.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        started = time.perf_counter()
+        counts = build_index(args.output_dir, log=lambda message: print(message, file=sys.stderr))
+        print(f"Indexed {counts['indexed']} file(s), {counts['unchanged']} unchanged, {counts['removed']} removed, "
+              f"{counts['no_fields']} without front matter ({time.perf_counter() - started:.1f}s)")
+        return 0
+
+    try:
+        index = open_index(args.output_dir, read_only=True)
+        total = index.count()
+    except sqlite3.Error:
+        # Missing, or not a search index
+        print(f"No search index in {args.output_dir}; run `python -m search_index build {args.output_dir}`",
+              file=sys.stderr)
+        return 1
+    try:
+        started = time.perf_counter()
+        try:
+            results = index.search(args.query, args.field, args.limit, args.raw)
+        except (ValueError, sqlite3.OperationalError) as e:
+            print(f"Error: Invalid search: {str(e)}", file=sys.stderr)
+            return 2
+        elapsed = time.perf_counter() - started
+    finally:
+        index.close()
+    if args.json:
+        print(json.dumps([asdict(result) for result in results], indent=2))
+        return 0
+    for number, result in enumerate(results, 1):
+        print(f"{number}. {result.title or os.path.basename(result.file)}")
+        print(f"   {result.output_file or result.file}")
+        print(f"   {' '.join(result.snippet.split())}")
+    print(f"{len(results)} result(s) from {total} document(s) in {elapsed * 1000:.1f} ms", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
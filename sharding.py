@@ -0,0 +1,252 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from typing import Callable, Iterable, Iterator, Optional, Sequence, Tuple
+from metrics import RunReport, merge_reports, REPORT_FILE, NODE_REPORT_FILE, write_atomically
+
+# Several hosts can share one run over a shared filesystem (e.g. NFS): each takes a fixed slice of the
+# inputs (--shard K/N), or claims files one by one with lease files in the output directory (--lease).
+LEASE_DIR = '.aifmm_leases'
+DEFAULT_LEASE_SECONDS = 300
+LEASE_POLL_SECONDS = 30
+
+# claim() results
+CLAIMED = 'claimed'
+DONE = 'done'
+LEASED = 'leased'
+
+def default_node_id() -> str:
+    return socket.gethostname()
+
+def parse_shard(text: str) -> Tuple[int, int]:
+    # "K/N" with 1 <= K <= N
+    index, _, count = text.partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ValueError(f"Invalid shard {text!r}, expected K/N, e.g. 2/4")
+    if not 1 <= index <= count:
+        raise ValueError(f"Invalid shard {text!r}: K must be between 1 and N")
+    return index, count
+
+def shard_key(path: str, roots: Sequence[str] = ()) -> str:
+    # The path below its input directory, so hosts that mount the corpus at different places agree
+    absolute = os.path.abspath(path)
+    for root in sorted(roots, key=len, reverse=True):
+        if absolute.startswith(root.rstrip(os.sep) + os.sep):
+            return os.path.relpath(absolute, root).replace(os.sep, '/')
+    return os.path.normpath(path).replace(os.sep, '/')
+
+def key_digest(key: str) -> str:
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def in_shard(path: str, index: int, count: int, roots: Sequence[str] = ()) -> bool:
+    # Stable across hosts and runs, unlike Python's salted hash()
+    return int(key_digest(shard_key(path, roots))[:16], 16) % count == index - 1
+
+def shard_files(text_files: Iterable[str], index: int, count: int, roots: Sequence[str] = ()) -> Iterator[str]:
+    return (text_file for text_file in text_files if in_shard(text_file, index, count, roots))
+
+def read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def read_file(path: str) -> str:
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+class LeaseManager:
+    # One lease file per input file in LEASE_DIR, created with O_EXCL so only one node gets it. The holder
+    # renews its leases while it works; a lease that has not been renewed for lease_seconds belongs to a
+    # node that stopped, and is taken over by the next node that wants the file. A finished file leaves a
+    # .done marker with its input hash, so no node processes that version again. Clocks of the nodes
+    # should be synchronized (NTP), since lease ages compare file times with the local clock.
+    def __init__(self, output_dir: str, node_id: str, lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                 roots: Sequence[str] = (), log: Callable[[str], None] = print):
+        self.directory = os.path.join(output_dir, LEASE_DIR)
+        self.node_id = node_id
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = min(LEASE_POLL_SECONDS, max(1.0, lease_seconds / 3))
+        self.roots = roots
+        self.log = log
+        self.lock = threading.Lock()
+        # text file -> (lease path, content of the lease file written here)
+        self.held = {}
+        self.lost = set()
+        self.stopping = threading.Event()
+        self.thread = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def paths(self, text_file: str) -> Tuple[str, str, str]:
+        key = shard_key(text_file, self.roots)
+        base = os.path.join(self.directory, key_digest(key)[:32])
+        return key, base + '.lease', base + '.done'
+
+    def claim(self, text_file: str, input_hash: str) -> str:
+        key, lease_path, done_path = self.paths(text_file)
+        with self.lock:
+            if text_file in self.held:
+                return CLAIMED
+        done = read_json(done_path)
+        if done and done.get('input_hash') == input_hash:
+            return DONE
+        content = json.dumps({'node': self.node_id, 'file': key, 'input_hash': input_hash, 'time': time.time()})
+        for _ in range(3):
+            try:
+                fd = os.open(lease_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            except FileExistsError:
+                if not self.take_over(text_file, lease_path):
+                    return LEASED
+                continue
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(content)
+            with self.lock:
+                self.held[text_file] = (lease_path, content)
+                self.lost.discard(text_file)
+            return CLAIMED
+        return LEASED
+
+    def take_over(self, text_file: str, lease_path: str) -> bool:
+        # Moves an expired lease out of the way; False while it is held. Another node can take over the same
+        # lease and create a fresh one between the stat and the rename, so what was moved is checked against
+        # what was stat'ed, and a fresh lease moved by mistake is put back.
+        try:
+            stat = os.stat(lease_path)
+            lease = read_file(lease_path)
+        except FileNotFoundError:
+            # Released in the meantime
+            return True
+        if time.time() - stat.st_mtime < self.lease_seconds:
+            return False
+        stale_path = f"{lease_path}.{self.node_id}.{os.getpid()}.{threading.get_ident()}.stale"
+        try:
+            os.rename(lease_path, stale_path)
+        except FileNotFoundError:
+            return True
+        try:
+            moved = os.stat(stale_path)
+            if moved.st_mtime != stat.st_mtime or read_file(stale_path) != lease:
+                try:
+                    # link() fails if yet another lease appeared; its holder then finds its lease lost
+                    os.link(stale_path, lease_path)
+                except FileExistsError:
+                    pass
+                return False
+            holder = (read_json(stale_path) or {}).get('node', 'another node')
+        finally:
+            try:
+                os.remove(stale_path)
+            except FileNotFoundError:
+                pass
+        self.log(f"Taking over {text_file} from {holder}, whose lease expired")
+        return True
+
+    def is_lost(self, text_file: str) -> bool:
+        # True once another node took over a lease held here; the output of the file is dropped
+        with self.lock:
+            if text_file in self.lost:
+                return True
+            held = self.held.get(text_file)
+        return held is not None and not self.owns(*held)
+
+    def owns(self, lease_path: str, content: str) -> bool:
+        try:
+            return read_file(lease_path) == content
+        except FileNotFoundError:
+            return False
+
+    def complete(self, text_file: str, input_hash: str, output_file: Optional[str]) -> bool:
+        # False without a marker when the lease was lost; the node that took it over completes the file
+        if self.is_lost(text_file):
+            self.release(text_file)
+            return False
+        key, lease_path, done_path = self.paths(text_file)
+        write_atomically(done_path, json.dumps({'node': self.node_id, 'file': key, 'input_hash': input_hash,
+                                                'output_file': output_file, 'time': time.time()}))
+        self.release(text_file)
+        return True
+
+    def release(self, text_file: str):
+        with self.lock:
+            held = self.held.pop(text_file, None)
+            lost = text_file in self.lost
+            self.lost.discard(text_file)
+        if held and not lost and self.owns(*held):
+            try:
+                os.remove(held[0])
+            except FileNotFoundError:
+                pass
+
+    def renew(self):
+        with self.lock:
+            held = [(text_file, lease) for text_file, lease in self.held.items() if text_file not in self.lost]
+        for text_file, (lease_path, content) in held:
+            try:
+                if not self.owns(lease_path, content):
+                    raise FileNotFoundError(lease_path)
+                os.utime(lease_path)
+            except FileNotFoundError:
+                self.log(f"Warning: The lease on {text_file} was taken over by another node; its output is dropped")
+                with self.lock:
+                    self.lost.add(text_file)
+
+    def heartbeat(self):
+        while not self.stopping.wait(self.lease_seconds / 3):
+            self.renew()
+
+    def start(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.heartbeat, name="lease-heartbeat", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        for text_file in list(self.held):
+            self.release(text_file)
+
+def node_reports(output_dir: str) -> list:
+    return sorted(glob.glob(os.path.join(glob.escape(output_dir), NODE_REPORT_FILE.format(node='*'))))
+
+def merge_node_reports(output_dir: str, report_file: Optional[str] = None,
+                       prometheus_file: Optional[str] = None) -> Optional[RunReport]:
+    # Combines the nodes' reports in the output directory into one run report
+    reports = []
+    for path in node_reports(output_dir):
+        data = read_json(path)
+        if data:
+            reports.append(RunReport.from_dict(data))
+    if not reports:
+        return None
+    merged = merge_reports(reports)
+    merged.write_json(report_file or os.path.join(output_dir, REPORT_FILE))
+    if prometheus_file:
+        merged.write_prometheus(prometheus_file)
+    return merged
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="sharding", description="Merge the run reports of a sharded run.")
+    parser.add_argument("output_dir", help="Output directory shared by the nodes")
+    parser.add_argument("--report", help=f"Merged report (default: {REPORT_FILE} in the output directory)")
+    parser.add_argument("--prometheus", help="Also write the merged summary as a Prometheus textfile to this path")
+    args = parser.parse_args(argv)
+    merged = merge_node_reports(args.output_dir, args.report, args.prometheus)
+    if merged is None:
+        print(f"No node reports found in {args.output_dir}", file=sys.stderr)
+        return 1
+    print(f"Merged {len(node_reports(args.output_dir))} node report(s): {merged.describe()}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
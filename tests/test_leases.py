@@ -0,0 +1,84 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api_services import APIService, APIResponse
+from pipeline import FrontMatterPipeline
+from sharding import LEASE_DIR
+
+FRONT_MATTER = "Title: A Test\n\nKeywords: leases, streams\n"
+
+class TakeoverService(APIService):
+    # Streams the front matter in two halves; in between, another node takes over the lease of the file
+    def __init__(self, pipeline_ref: list):
+        self.pipeline_ref = pipeline_ref
+
+    def create_client(self):
+        return None
+
+    def call_api(self, content, model, max_tokens, temperature, prefix=""):
+        self.take_over()
+        return APIResponse(FRONT_MATTER)
+
+    def stream_api(self, content, model, max_tokens, temperature, sink, prefix=""):
+        sink.begin()
+        sink.write(FRONT_MATTER[:10])
+        self.take_over()
+        sink.write(FRONT_MATTER[10:])
+        return APIResponse("")
+
+    def take_over(self):
+        leases = self.pipeline_ref[0].leases
+        for text_file, (lease_path, _) in list(leases.held.items()):
+            with open(lease_path, 'w', encoding='utf-8') as f:
+                json.dump({'node': 'other-node', 'file': text_file}, f)
+
+    def get_available_models(self, on_update=None):
+        return ["test-model"]
+
+    def get_max_tokens(self, model):
+        return 1024
+
+    def get_context_window(self, model):
+        return 100000
+
+class LostLeaseTest(unittest.TestCase):
+    def run_pipeline(self, stream: bool):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        prompt_file = os.path.join(directory, 'prompt.txt')
+        text_file = os.path.join(directory, 'a.txt')
+        output_dir = os.path.join(directory, 'out')
+        os.makedirs(output_dir)
+        with open(prompt_file, 'w', encoding='utf-8') as f:
+            f.write("Summarize:\n{{TEXT}}")
+        with open(text_file, 'w', encoding='utf-8') as f:
+            f.write("Some text.")
+        pipeline_ref = []
+        pipeline = FrontMatterPipeline(TakeoverService(pipeline_ref), "Test", "test-model", 1024, 0.0,
+                                       retries=0, stream=stream, node_id='this-node', leases=True,
+                                       log=lambda message: None)
+        pipeline_ref.append(pipeline)
+        pipeline.run(prompt_file, [text_file], output_dir)
+        lease_dir = os.path.join(output_dir, LEASE_DIR)
+        return os.listdir(output_dir), os.listdir(lease_dir)
+
+    def test_streamed_output_is_dropped(self):
+        outputs, leases = self.run_pipeline(stream=True)
+        self.assertNotIn('a.md', outputs)
+        self.assertFalse([name for name in leases if name.endswith('.done')])
+        # The other node's lease is left in place
+        self.assertEqual(len([name for name in leases if name.endswith('.lease')]), 1)
+
+    def test_output_is_dropped(self):
+        outputs, leases = self.run_pipeline(stream=False)
+        self.assertNotIn('a.md', outputs)
+        self.assertFalse([name for name in leases if name.endswith('.done')])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,284 @@
+import heapq
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+from dedup import DuplicateIndex
+from discovery import walk_directory, matches, input_roots, DEFAULT_INCLUDE
+from journal import RunJournal
+from metrics import RunReport
+from pipeline import FrontMatterPipeline, QUEUED_FILES_PER_WORKER
+
+# A file is processed once it has had no events, and kept its size and modification time, for this long,
+# so files that are still being copied in are not picked up half written
+WATCH_DEBOUNCE_SECONDS = 2.0
+# Rescan interval when polling; with filesystem events, the rescan only catches events that were missed
+WATCH_POLL_SECONDS = 2.0
+WATCH_RESCAN_SECONDS = 60.0
+WATCH_TICK_SECONDS = 0.25
+WATCH_RETRY_DELAY_SECONDS = 30.0
+WATCH_REPORT_SECONDS = 300.0
+# The report of a watch that runs for weeks is rolled over once it holds this many files: it is written
+# and a new one starts, so the events kept in memory stay bounded
+WATCH_REPORT_MAX_EVENTS = 10000
+# Documents later files are compared with for duplicates; older ones are forgotten
+WATCH_DEDUP_MAX_DOCUMENTS = 100000
+
+def file_state(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+class WatchRunner:
+    # Runs a FrontMatterPipeline continuously over folders: new and changed files are processed as they
+    # arrive. Files are processed incrementally, so every version of a file is processed once, also across
+    # restarts. Events for the same file are coalesced while it waits, and at most a few files per worker
+    # are queued, however many arrive at once.
+    def __init__(self, pipeline: FrontMatterPipeline, include: Sequence[str] = DEFAULT_INCLUDE,
+                 exclude: Sequence[str] = (), debounce: float = WATCH_DEBOUNCE_SECONDS):
+        self.pipeline = pipeline
+        self.include = include
+        self.exclude = exclude
+        self.debounce = debounce
+        self.log = pipeline.log
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.rescan = threading.Event()
+        self.queue = queue.Queue(maxsize=pipeline.concurrency * QUEUED_FILES_PER_WORKER)
+        # Files waiting to settle: path -> [due time, (size, mtime)]
+        self.pending: Dict[str, list] = {}
+        # (due time, path) of the pending files, as a heap; entries replaced by a later touch are dropped
+        # when they come up
+        self.due: List[Tuple[float, str]] = []
+        # Queued or in progress; changes to these wait in pending until they are finished
+        self.active = set()
+        self.snapshot = {}
+        self.failures = {}
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self, prompt_file: str, inputs: Sequence[str], output_dir: str) -> bool:
+        pipeline = self.pipeline
+        roots = input_roots(inputs)
+        error = pipeline.validate_input(prompt_file, roots, output_dir)
+        if not error and not roots:
+            error = "Watch mode needs at least one folder to watch."
+        if error:
+            self.log(f"Error: {error}")
+            return False
+
+        pipeline.apply_output_limit()
+        self.template = pipeline.read_prompt_template(prompt_file)
+        self.output_dir = output_dir
+        self.roots = roots
+        self.journal = RunJournal(output_dir)
+        self.report = RunReport(pipeline.service_name, pipeline.model, mode='watch')
+        # Unchanged files are skipped by their journaled hashes
+        pipeline.incremental = True
+        pipeline.input_roots = roots
+        pipeline.duplicates = (DuplicateIndex(pipeline.dedup_threshold, max_documents=WATCH_DEDUP_MAX_DOCUMENTS)
+                               if pipeline.dedup_threshold is not None else None)
+        pipeline.spent = 0.0
+        pipeline.spent_files = 0
+        pipeline.open_index(output_dir)
+        self.queued = 0
+        self.completed = 0
+        self.skipped = 0
+        self.in_progress = 0
+        self.last_progress = None
+        self.stopping.clear()
+
+        observer = self.start_observer()
+        rescan_interval = WATCH_RESCAN_SECONDS if observer else WATCH_POLL_SECONDS
+        self.log(f"Watching {', '.join(roots)} for new and changed files "
+                 f"({'filesystem events' if observer else 'polling'}, {pipeline.concurrency} concurrent requests)...")
+        workers = [threading.Thread(target=self.work, name=f"watch-worker-{i}", daemon=True)
+                   for i in range(pipeline.concurrency)]
+        for worker in workers:
+            worker.start()
+        next_scan = next_report = 0.0
+        try:
+            while not self.stopping.is_set():
+                now = time.monotonic()
+                if now >= next_scan or self.rescan.is_set():
+                    self.rescan.clear()
+                    self.scan()
+                    next_scan = time.monotonic() + rescan_interval
+                if now >= next_report or len(self.report.events) >= WATCH_REPORT_MAX_EVENTS:
+                    if next_report:
+                        self.write_report()
+                    next_report = now + WATCH_REPORT_SECONDS
+                self.dispatch()
+                self.stopping.wait(WATCH_TICK_SECONDS)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # Files still waiting are picked up by the first scan of the next run
+            self.log("Stopping; waiting for the files in progress...")
+            self.stopping.set()
+            if observer:
+                observer.stop()
+                observer.join()
+            for worker in workers:
+                worker.join()
+            pipeline.close_index()
+            pipeline.finish_report(self.report, output_dir)
+        if self.skipped:
+            self.log(f"Skipped {self.skipped} file(s) already processed by a previous run.")
+        pipeline.log_usage_totals()
+        self.log(f"Watching stopped after {self.completed} file(s).")
+        return True
+
+    def write_report(self):
+        with self.lock:
+            report = self.report
+            if len(report.events) >= WATCH_REPORT_MAX_EVENTS:
+                self.report = RunReport(self.pipeline.service_name, self.pipeline.model, mode='watch')
+        self.pipeline.finish_report(report, self.output_dir)
+
+    def start_observer(self):
+        # watchdog (inotify on Linux) is optional; without it the folders are polled
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            return None
+        runner = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.event_type not in ('created', 'modified', 'moved', 'closed'):
+                    return
+                if event.is_directory:
+                    # Files in a folder moved into the tree get no events of their own
+                    if event.event_type != 'modified':
+                        runner.rescan.set()
+                    return
+                path = getattr(event, 'dest_path', '') or event.src_path
+                if runner.is_watched(os.fsdecode(path)):
+                    runner.touch(os.fsdecode(path))
+
+        observer = Observer()
+        for root in self.roots:
+            observer.schedule(Handler(), root, recursive=True)
+        observer.start()
+        return observer
+
+    def is_watched(self, path: str) -> bool:
+        for root in self.roots:
+            relative_path = os.path.relpath(path, root)
+            if relative_path.startswith(os.pardir):
+                continue
+            parts = relative_path.replace(os.sep, '/').split('/')
+            if self.exclude and any(matches('/'.join(parts[:i + 1]), self.exclude) for i in range(len(parts))):
+                return False
+            return not self.include or matches('/'.join(parts), self.include)
+        return False
+
+    def scan(self):
+        # Compares the folders with the previous scan; the first scan finds every file
+        snapshot = {}
+        for root in self.roots:
+            for path in walk_directory(root, self.include, self.exclude):
+                state = file_state(path)
+                if state is None:
+                    continue
+                snapshot[path] = state
+                if self.snapshot.get(path) != state:
+                    self.touch(path, state)
+        self.snapshot = snapshot
+
+    def touch(self, path: str, state: Optional[Tuple[int, int]] = None, delay: Optional[float] = None):
+        due = time.monotonic() + (self.debounce if delay is None else delay)
+        state = state or file_state(path)
+        with self.lock:
+            self.schedule(path, due, state)
+
+    def schedule(self, path: str, due: float, state: Optional[Tuple[int, int]]):
+        self.pending[path] = [due, state]
+        heapq.heappush(self.due, (due, path))
+
+    def dispatch(self):
+        now = time.monotonic()
+        # Due files still in progress, looked at again on the next tick
+        busy = []
+        with self.lock:
+            while self.due and self.due[0][0] <= now:
+                due, path = self.due[0]
+                entry = self.pending.get(path)
+                if entry is None or entry[0] != due:
+                    heapq.heappop(self.due)
+                    continue
+                if path in self.active:
+                    busy.append(heapq.heappop(self.due))
+                    continue
+                current = file_state(path)
+                if current is None:
+                    heapq.heappop(self.due)
+                    del self.pending[path]
+                    continue
+                if current != entry[1]:
+                    # Still being written
+                    heapq.heappop(self.due)
+                    self.schedule(path, now + self.debounce, current)
+                    continue
+                try:
+                    self.queue.put_nowait((path, time.perf_counter()))
+                except queue.Full:
+                    break
+                heapq.heappop(self.due)
+                del self.pending[path]
+                self.active.add(path)
+                self.queued += 1
+            for item in busy:
+                heapq.heappush(self.due, item)
+            progress = (self.completed, self.queued)
+        if progress != self.last_progress:
+            self.last_progress = progress
+            self.pipeline.progress(*progress)
+
+    def work(self):
+        pipeline = self.pipeline
+        while not self.stopping.is_set():
+            try:
+                text_file, queued_at = self.queue.get(timeout=WATCH_TICK_SECONDS)
+            except queue.Empty:
+                continue
+            with self.lock:
+                in_flight = self.in_progress
+                self.in_progress += 1
+            try:
+                if pipeline.spend_cap_reached(in_flight):
+                    self.log(f"Spend cap of ${pipeline.spend_cap:.2f} reached after ${pipeline.spent:.4f}; "
+                             f"watching stopped.")
+                    self.stop()
+                    continue
+                file_metrics = pipeline.process_tracked_file(self.journal, self.template, text_file,
+                                                             self.output_dir, queued_at=queued_at)
+                retry_delay = None
+                with self.lock:
+                    pipeline.emit_metrics(self.report, file_metrics)
+                    if file_metrics.status == 'failed':
+                        failures = self.failures.get(text_file, 0) + 1
+                        if failures <= pipeline.retries:
+                            self.failures[text_file] = failures
+                            retry_delay = WATCH_RETRY_DELAY_SECONDS * failures
+                        else:
+                            # Tried again when the file changes
+                            self.failures.pop(text_file, None)
+                    else:
+                        self.failures.pop(text_file, None)
+                        self.completed += 1
+                        if file_metrics.status == 'skipped':
+                            self.skipped += 1
+                if retry_delay is not None:
+                    self.log(f"Retrying {text_file} in {retry_delay:.0f}s")
+                    self.touch(text_file, delay=retry_delay)
+            finally:
+                with self.lock:
+                    self.in_progress -= 1
+                    self.active.discard(text_file)